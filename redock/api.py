@@ -1,13 +1,14 @@
 # Main API for Redock, a human friendly wrapper around Docker.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: September 30, 2013
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-redock
 
 """
-The :py:mod:`redock.api` module defines two classes and two exception types:
+The :py:mod:`redock.api` module defines three classes and two exception types:
 
 - :py:class:`Container`
+- :py:class:`AsyncContainer`
 - :py:class:`Image`
 - :py:class:`NoContainerRunning`
 - :py:class:`SecureShellTimeout`
@@ -20,23 +21,31 @@ import socket
 import subprocess
 import sys
 import textwrap
+import threading
 import time
 
 # External dependencies.
-import docker
 import humanfriendly
-import update_dotdee
 import verboselogs
 
 # Modules included in our package.
-from redock.base import BASE_IMAGE_NAME, find_base_image
+from redock.aptcache import PackageCache
+from redock.base import BASE_IMAGE_NAME, SUPERVISOR_COMMAND, find_base_image
+from redock.client import get_client
+from redock.inventory import Inventory, PrefixIndex
+from redock.parallel import Job, WorkerPool
+from redock.snapshots import SnapshotManager
 from redock.utils import (PRIVATE_SSH_KEY, Config, RemoteTerminal,
                           find_local_ip_addresses, quote_command_line,
-                          slug, summarize_id)
+                          slug, ssh_config, summarize_id, wait_for_ssh_banner)
+from redock.warmpool import WarmPool
 
 # Initialize a logger for this module.
 logger = verboselogs.VerboseLogger(__name__)
 
+# The number of worker threads shared by all AsyncContainer objects.
+ASYNC_CONCURRENCY = 32
+
 class Container(object):
 
     """
@@ -78,28 +87,38 @@ class Container(object):
         # Initialize some private variables.
         self.logger = logger
         self.config = Config()
+        self.cache = PackageCache()
         self.session = Session()
-        self.update_dotdee = update_dotdee.UpdateDotDee(os.path.expanduser('~/.ssh/config'))
         # Connect to the Docker API over HTTP.
         try:
             self.logger.debug("Connecting to Docker daemon ..")
-            self.client = docker.Client()
+            self.client = get_client()
             self.logger.debug("Successfully connected to Docker.")
         except Exception, e:
             self.logger.error("Failed to connect to Docker!")
             self.logger.exception(e)
             raise
+        # Cache the image and container listings reported by Docker.
+        self.inventory = Inventory(self.client)
 
-    def start(self):
+    def start(self, pool_size=0):
         """
         Create and start the Docker container. On the first run of Redock this
         creates a base image using :py:func:`redock.base.create_base_image()`.
+
+        :param pool_size: If this is a positive number a pre-started container
+                          is claimed from a :py:class:`redock.warmpool.WarmPool`
+                          (if one is available) and the warm pool is refilled
+                          to the given size in the background.
         """
+        self.inventory.invalidate()
         if not self.find_container():
-            if not self.find_image(self.image):
-                self.logger.info("Image doesn't exist yet, creating it: %r", self.image)
-                self.base.id = find_base_image(self.client)
-            self.start_supervisor()
+            pool = WarmPool(self, size=pool_size) if pool_size > 0 else None
+            if not (pool and pool.claim()):
+                self.ensure_image()
+                self.start_supervisor()
+            if pool:
+                pool.replenish_in_background()
         self.setup_ssh_access()
 
     def commit(self, message=None, author=None):
@@ -113,18 +132,24 @@ class Container(object):
         :param message: A short message describing the commit (a string).
         :param author: The name of the author (a string).
         """
+        self.inventory.invalidate()
         self.check_active()
         self.logger.info("Committing changes: %s", message or 'no description given')
         result = self.client.commit(self.session.container_id, repository=self.image.repository,
                                     tag=self.image.tag, message=message, author=author)
-        image_ids = [i['Id'] for i in self.client.images()]
-        self.image.id = self.expand_id(result['Id'], image_ids)
+        self.inventory.invalidate(containers=False)
+        self.image.id = self.expand_id(result['Id'], self.inventory.image_ids)
 
-    def kill(self):
+    def kill(self, revoke_ssh=True):
         """
         Kill and remove the container. All changes since the last time that
         :py:func:`Container.commit()` was called will be lost.
+
+        :param revoke_ssh: ``False`` to keep the container's SSH client
+                           configuration (used when the container is about to
+                           be replaced, see :py:func:`redock.snapshots.SnapshotManager.restore()`).
         """
+        self.inventory.invalidate()
         if self.find_container():
             if self.session.remote_terminal:
                 self.session.remote_terminal.detach()
@@ -132,10 +157,11 @@ class Container(object):
             self.client.kill(self.session.container_id)
             self.logger.info("Removing container ..")
             self.client.remove_container(self.session.container_id)
-            with self.config as state:
-                del state['containers'][self.image.key]
+            self.inventory.invalidate(images=False)
+            self.config.delete('containers', self.image.key)
             self.session.reset()
-        self.revoke_ssh_access()
+        if revoke_ssh:
+            self.revoke_ssh_access()
 
     def delete(self):
         """
@@ -144,6 +170,38 @@ class Container(object):
         """
         self.logger.info("Deleting image %s ..", self.image.name)
         self.client.remove_image(self.image.name)
+        self.inventory.invalidate(containers=False)
+
+    def perform(self, action, message=None, pool_size=0, snapshot=None):
+        """
+        Perform one of the actions supported by the ``redock`` program. This
+        is the common entry point used by :py:mod:`redock.cli` and
+        :py:mod:`redock.daemon`.
+
+        :param action: One of the strings ``start``, ``commit``, ``kill``,
+                       ``delete``, ``fill``, ``snapshot`` or ``restore``.
+        :param message: The commit message (optional).
+        :param pool_size: The size of the warm pool (optional).
+        :param snapshot: The name of the snapshot to create or restore
+                         (optional, see :py:mod:`redock.snapshots`).
+        """
+        if action == 'start':
+            self.start(pool_size=pool_size)
+        elif action == 'commit':
+            self.commit(message=message)
+        elif action == 'kill':
+            self.kill()
+        elif action == 'delete':
+            self.delete()
+        elif action == 'fill':
+            WarmPool(self, size=pool_size).fill()
+        elif action == 'snapshot':
+            SnapshotManager(self).create(name=snapshot, message=message)
+        elif action == 'restore':
+            SnapshotManager(self).restore(name=snapshot)
+        else:
+            msg = "Action not supported: %r"
+            raise ValueError, msg % action
 
     def find_container(self):
         """
@@ -155,10 +213,9 @@ class Container(object):
         """
         if not self.session.container_id:
             self.logger.verbose("Looking for running container ..")
-            state = self.config.load()
-            container_id = state['containers'].get(self.image.key)
+            container_id = self.config.get('containers', self.image.key)
             # Make sure the container is still running.
-            if container_id in [c['Id'] for c in self.client.containers()]:
+            if container_id and self.inventory.is_running(container_id):
                 self.session.container_id = container_id
                 self.logger.info("Found running container: %s", summarize_id(container_id))
         return bool(self.session.container_id)
@@ -171,46 +228,74 @@ class Container(object):
         :returns: The most recent :py:class:`Image` available, or ``None`` if
                   no images were matched.
         """
-        matches = []
-        for image in self.client.images():
-            if (image.get('Repository') == image_to_find.repository
-                    and image.get('Tag') == image_to_find.tag):
-                matches.append(image)
-        if matches:
-            matches.sort(key=lambda i: i['Created'])
-            image = matches[-1]
+        image = self.inventory.find_image(image_to_find.repository, image_to_find.tag)
+        if image:
             return Image(repository=image['Repository'],
                          tag=image['Tag'],
                          id=image['Id'])
 
-    def start_supervisor(self):
+    def ensure_image(self):
         """
-        Starts the container and runs Supervisor inside the container.
+        Make sure the image used to create new containers exists. If the
+        container's image doesn't exist yet the base image is used, which is
+        created on demand using :py:func:`redock.base.find_base_image()`.
+
+        :returns: The :py:class:`Image` that will be used to create the
+                  container.
         """
-        command = '/usr/bin/supervisord -n'
+        image = self.find_image(self.image)
+        if not image:
+            self.logger.info("Image doesn't exist yet, creating it: %r", self.image)
+            self.base.id = find_base_image(self.client, self.inventory, self.cache)
+            image = self.find_image(self.base)
+        return image
+
+    def start_supervisor(self, register=True, attach=True, host_port=None):
+        """
+        Starts the container and runs Supervisor inside the container.
+
+        :param register: ``True`` to record the association between the image
+                         and the new container in the runtime configuration,
+                         ``False`` to skip this (used for containers that are
+                         started ahead of time by :py:class:`redock.warmpool.WarmPool`).
+        :param attach: ``True`` to show the output of the container on the
+                       terminal, ``False`` otherwise.
+        :param host_port: The port number on the host system that should be
+                          connected to the SSH server inside the container
+                          (optional, by default Docker picks a free port).
+
+        The container is created from :py:attr:`Session.custom_image` if
+        it's set, otherwise from the container's image (if it exists) or the
+        base image.
+        """
+        command = SUPERVISOR_COMMAND
         self.logger.info("Starting process supervisor (and SSH server) ..")
         # Select the Docker image to use as a base for the container.
-        image = self.find_image(self.image) or self.find_image(self.base)
+        image = self.session.custom_image or self.find_image(self.image) or self.find_image(self.base)
         self.logger.verbose("Creating container from image: %r", image)
         # Start the container with the given command.
         result = self.client.create_container(image=image.unique_name,
                                               command=command,
                                               hostname=self.hostname,
-                                              ports=['22'])
-        container_ids = [c['Id'] for c in self.client.containers(all=True)]
-        self.session.container_id = self.expand_id(result['Id'], container_ids)
+                                              ports=['%i:22' % host_port if host_port else '22'],
+                                              volumes=self.cache.volumes)
+        self.inventory.invalidate(images=False)
+        self.session.container_id = self.expand_id(result['Id'], self.inventory.container_ids)
         self.logger.verbose("Created container: %s", summarize_id(self.session.container_id))
         for text in result.get('Warnings', []):
             logger.warn("%s", text)
         # Start the command inside the container.
         self.logger.verbose("Running command: %s", command)
-        self.client.start(self.session.container_id)
+        # The package cache on the host (if any) is bind mounted so that
+        # packages installed inside the container come from local disk.
+        self.client.start(self.session.container_id, binds=self.cache.binds)
         # Make the output from the container visible to the user.
-        self.session.remote_terminal = RemoteTerminal(self.session.container_id)
-        self.session.remote_terminal.attach()
+        if attach:
+            self.session.remote_terminal = RemoteTerminal(self.session.container_id, self.client, name=self.hostname)
+            self.session.remote_terminal.attach()
         # Persist association between (repository, tag) and container id.
-        with self.config as state:
-            state['containers'][self.image.key] = self.session.container_id
+        if register:
+            self.config.set('containers', self.image.key, self.session.container_id)
 
     def get_ssh_client_command(self, ip_address=None, port_number=None):
         """
@@ -261,14 +346,12 @@ class Container(object):
         over SSH_ from the host system. This generates a host definition to
         include in the SSH client configuration file and uses update-dotdee_ to
         merge the generated host definition with the user's existing SSH client
-        configuration file.
+        configuration file (see :py:class:`redock.utils.SecureShellConfig`).
 
         .. _update-dotdee: https://pypi.python.org/pypi/update-dotdee
         """
         self.logger.verbose("Configuring SSH access ..")
-        self.update_dotdee.create_directory()
-        with open(self.ssh_config_file, 'w') as handle:
-            handle.write(textwrap.dedent("""
+        ssh_config.update_fragment(self.ssh_config_name, textwrap.dedent("""
                 Host {alias}
                   Hostname {address}
                   Port {port}
@@ -282,7 +365,6 @@ class Container(object):
                        key=PRIVATE_SSH_KEY,
                        redock=pipes.quote(os.path.abspath(sys.argv[0])),
                        container=pipes.quote(self.image.name))))
-        self.update_dotdee.update_file()
         self.logger.info("Successfully configured SSH access. Use this command: ssh %s", self.ssh_alias)
 
     def revoke_ssh_access(self):
@@ -291,16 +373,22 @@ class Container(object):
         ``~/.ssh/config``.
         """
         self.logger.info("Removing SSH client configuration ..")
-        if os.path.isfile(self.ssh_config_file):
-            os.unlink(self.ssh_config_file)
-        self.update_dotdee.update_file()
+        ssh_config.remove_fragment(self.ssh_config_name)
+
+    @property
+    def ssh_config_name(self):
+        """
+        Get the name of the SSH_ client configuration fragment for the
+        container (see :py:class:`redock.utils.SecureShellConfig`).
+        """
+        return 'redock:%s' % self.image.name
 
     @property
     def ssh_config_file(self):
         """
         Get the pathname of the SSH_ client configuration for the container.
         """
-        return os.path.expanduser('~/.ssh/config.d/redock:%s' % self.image.name)
+        return ssh_config.fragment_file(self.ssh_config_name)
 
     @property
     def ssh_endpoint(self):
@@ -324,27 +412,36 @@ class Container(object):
         global_timeout = time.time() + self.timeout
         ssh_timer = humanfriendly.Timer()
         while time.time() < global_timeout:
-            for ip_address in find_local_ip_addresses():
-                # Try to open an SSH connection to the container.
-                self.logger.debug("Connecting to container over SSH at %s:%s ..", ip_address, host_port)
-                command = self.get_ssh_client_command(ip_address, host_port) + ['true']
-                ssh_client = subprocess.Popen(command, stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                # Give this attempt at most 10 seconds to succeed.
-                inner_timeout = time.time() + 10
-                while time.time() < inner_timeout:
-                    if ssh_client.poll() is not None:
-                        break
-                    time.sleep(0.1)
-                else:
-                    self.logger.debug("Attempt to connect timed out!")
-                if ssh_client.returncode == 0:
-                    # At this point we have successfully connected!
-                    self.session.ssh_endpoint = (ip_address, host_port)
-                    self.logger.debug("Connected to %s at %s using SSH in %s.",
-                                      self.image.name, self.session.ssh_endpoint,
-                                      ssh_timer)
-                    return self.session.ssh_endpoint
-                time.sleep(1)
+            # Wait for the SSH server to send its banner (cheap).
+            result = wait_for_ssh_banner(find_local_ip_addresses(), host_port,
+                                         timeout=global_timeout - time.time())
+            if not result:
+                break
+            ip_address, banner = result
+            self.logger.debug("SSH server at %s:%i is up (%s) after %s.",
+                              ip_address, host_port, banner, ssh_timer)
+            # Confirm that we can actually login (expensive).
+            self.logger.debug("Connecting to container over SSH at %s:%s ..", ip_address, host_port)
+            command = self.get_ssh_client_command(ip_address, host_port) + ['true']
+            ssh_client = subprocess.Popen(command, stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            while time.time() < global_timeout:
+                if ssh_client.poll() is not None:
+                    break
+                time.sleep(0.05)
+            else:
+                self.logger.debug("Attempt to connect timed out!")
+                ssh_client.kill()
+                ssh_client.wait()
+            if ssh_client.returncode == 0:
+                # At this point we have successfully connected!
+                self.session.ssh_endpoint = (ip_address, host_port)
+                self.logger.debug("Connected to %s at %s using SSH in %s.",
+                                  self.image.name, self.session.ssh_endpoint,
+                                  ssh_timer)
+                return self.session.ssh_endpoint
+            # The SSH server sends its banner before it's willing to accept
+            # our key; this shouldn't take long.
+            time.sleep(0.1)
         msg = "Time ran out while waiting to connect to container %s over SSH! (Most likely something went wrong while initializing the container..)"
         raise SecureShellTimeout, msg % self.image.name
 
@@ -373,24 +470,175 @@ class Container(object):
         while :py:func:`docker.Client.containers()` and
         :py:func:`docker.Client.images()` report long ids (65 characters). I'd
         rather use the full ids where possible. This method translates short
-        ids into long ids at the expense of an additional API call (who
-        cares).
+        ids into long ids using a :py:class:`redock.inventory.PrefixIndex`
+        (the index is built once per inventory snapshot).
 
-        Raises :py:exc:`exceptions.Exception` if no long id corresponding to
-        the short id can be matched (this might well be a purely theoretical
-        problem, it certainly shouldn't happen during regular use).
+        Raises :py:exc:`redock.inventory.UnknownId` if no long id corresponding
+        to the short id can be matched (this might well be a purely theoretical
+        problem, it certainly shouldn't happen during regular use) and
+        :py:exc:`redock.inventory.AmbiguousId` if more than one long id
+        matches.
 
         :param short_id: A short id of 12 characters.
-        :param candidate_ids: A list of available long ids.
+        :param candidate_ids: A :py:class:`redock.inventory.PrefixIndex` or a
+                              list of available long ids.
         :returns: The long id corresponding to the given short id.
         """
-        self.logger.debug("Translation short id %s into long id ..", short_id)
-        for long_id in candidate_ids:
-            self.logger.debug("Checking candidate: %s", long_id)
-            if long_id.startswith(short_id):
-                return long_id
-        msg = "Failed to translate short id (%s) into long id!"
-        raise Exception, msg % short_id
+        if not isinstance(candidate_ids, PrefixIndex):
+            candidate_ids = PrefixIndex(candidate_ids)
+        self.logger.debug("Translating short id %s into long id (%i candidates) ..",
+                          short_id, len(candidate_ids))
+        return candidate_ids.resolve(short_id)
+
+class AsyncContainer(object):
+
+    """
+    Non-blocking counterpart of :py:class:`Container`. Each method schedules
+    the corresponding :py:class:`Container` method on a pool of worker threads
+    (shared by all :py:class:`AsyncContainer` objects) and immediately returns
+    a :py:class:`redock.parallel.Job` object. This makes it possible to manage
+    lots of containers from a single (e.g. event driven) thread:
+
+    >>> containers = [AsyncContainer('redock:test%i' % i) for i in range(50)]
+    >>> jobs = [c.start() for c in containers]
+    >>> for job in jobs:
+    ...   job.wait()
+
+    Instead of waiting you can also use :py:func:`redock.parallel.Job.add_callback()`
+    to be notified when an operation finishes. Operations on the same container
+    are performed one at a time, in the order they were scheduled.
+
+    .. note:: Redock targets Python 2 which doesn't have :py:mod:`asyncio`, so
+              this class uses threads instead of an event loop. Most of the
+              time spent by Redock is spent waiting for Docker and SSH (which
+              releases the GIL) so this scales well in practice.
+    """
+
+    # The WorkerPool shared by all AsyncContainer objects (created on demand).
+    shared_pool = None
+    shared_pool_lock = threading.Lock()
+
+    def __init__(self, image, hostname=None, timeout=10, pool=None):
+        """
+        Initialize an :py:class:`AsyncContainer` from the given arguments.
+
+        :param image: The repository and tag of the container's image (in the
+                      format expected by :py:class:`Image.coerce()`).
+        :param hostname: The host name to use inside the container. If none is
+                         given, the image's tag is used.
+        :param timeout: The timeout in seconds while waiting for a container to
+                        become reachable over SSH_.
+        :param pool: The :py:class:`redock.parallel.WorkerPool` to use
+                     (optional, defaults to a pool shared by all
+                     :py:class:`AsyncContainer` objects).
+        """
+        self.container = Container(image=image, hostname=hostname, timeout=timeout)
+        self.pool = pool or self.get_shared_pool()
+        self.lock = threading.Lock()
+        self.previous_job = None
+
+    @classmethod
+    def get_shared_pool(cls):
+        """
+        Get the :py:class:`redock.parallel.WorkerPool` shared by all
+        :py:class:`AsyncContainer` objects.
+        """
+        with cls.shared_pool_lock:
+            if cls.shared_pool is None:
+                cls.shared_pool = WorkerPool(concurrency=ASYNC_CONCURRENCY)
+            return cls.shared_pool
+
+    def start(self, pool_size=0):
+        """
+        Schedule :py:func:`Container.start()`.
+
+        :returns: A :py:class:`redock.parallel.Job` object.
+        """
+        return self.submit(self.container.start, pool_size=pool_size)
+
+    def commit(self, message=None, author=None):
+        """
+        Schedule :py:func:`Container.commit()`.
+
+        :returns: A :py:class:`redock.parallel.Job` object.
+        """
+        return self.submit(self.container.commit, message=message, author=author)
+
+    def kill(self):
+        """
+        Schedule :py:func:`Container.kill()`.
+
+        :returns: A :py:class:`redock.parallel.Job` object.
+        """
+        return self.submit(self.container.kill)
+
+    def delete(self):
+        """
+        Schedule :py:func:`Container.delete()`.
+
+        :returns: A :py:class:`redock.parallel.Job` object.
+        """
+        return self.submit(self.container.delete)
+
+    def snapshot(self, name=None, message=None):
+        """
+        Schedule :py:func:`redock.snapshots.SnapshotManager.create()`.
+
+        :returns: A :py:class:`redock.parallel.Job` object.
+        """
+        return self.submit(lambda: SnapshotManager(self.container).create(name=name, message=message))
+
+    def restore(self, name=None):
+        """
+        Schedule :py:func:`redock.snapshots.SnapshotManager.restore()`.
+
+        :returns: A :py:class:`redock.parallel.Job` object.
+        """
+        return self.submit(lambda: SnapshotManager(self.container).restore(name=name))
+
+    @property
+    def ssh_endpoint(self):
+        """
+        Schedule a lookup of :py:attr:`Container.ssh_endpoint`.
+
+        :returns: A :py:class:`redock.parallel.Job` object whose result is a
+                  tuple with an IP address and port number.
+        """
+        return self.submit(lambda: self.container.ssh_endpoint)
+
+    @property
+    def ssh_alias(self):
+        """
+        Get the SSH_ alias that should be used to connect to the container
+        (this doesn't block).
+        """
+        return self.container.ssh_alias
+
+    def submit(self, function, *args, **kw):
+        """
+        Schedule a call to one of the methods of the wrapped
+        :py:class:`Container` so that calls for the same container don't
+        overlap. When a previous call for the same container hasn't finished
+        yet, the new call is only handed to the worker pool when the previous
+        call finishes (using :py:func:`redock.parallel.Job.add_callback()`),
+        so no worker thread is blocked waiting for it.
+
+        :returns: A :py:class:`redock.parallel.Job` object.
+        """
+        job = Job(function, *args, **kw)
+        with self.lock:
+            previous_job, self.previous_job = self.previous_job, job
+        if previous_job:
+            previous_job.add_callback(lambda finished_job: self.pool.schedule(job))
+        else:
+            self.pool.schedule(job)
+        return job
+
+    def __repr__(self):
+        """
+        Pretty print an :py:class:`AsyncContainer` object.
+        """
+        return "Async%r" % self.container
 
 class Image(object):
 
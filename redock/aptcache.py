@@ -0,0 +1,249 @@
+# Host side cache of Ubuntu packages for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.aptcache` module implements an optional cache of Ubuntu
+packages on the host system. Without the cache every build of the base image
+(see :py:func:`redock.base.create_base_image()`) and every container that
+installs packages (see :py:func:`redock.bootstrap.Bootstrap.install_packages()`)
+downloads the same package lists and ``*.deb`` archives from the Ubuntu
+mirror over and over again.
+
+The cache is enabled by creating the directory ``~/.redock/apt-cache`` (or the
+directory given by the environment variable ``$REDOCK_APT_CACHE``):
+
+.. code-block:: sh
+
+   $ mkdir ~/.redock/apt-cache
+
+When the cache is enabled the directory is bind mounted into the containers
+created by Redock and apt-get_ is configured to store downloaded packages in
+the cache. The package lists fetched by ``apt-get update`` are also stored in
+the cache.
+
+The apt-get_ configuration that enables the cache is specific to the host
+system, so it's never stored in images (where it would break apt-get_ in
+containers created after the cache was removed or on other hosts, see
+:py:func:`redock.base.export_base_image()`). Instead it's written to a file
+on the host system which is bind mounted into each container (see
+:py:attr:`PackageCache.binds`); the base image only contains a symbolic link
+to this file. Two more environment variables are supported:
+
+``$REDOCK_APT_PROXY``
+  The URL of an HTTP proxy (e.g. apt-cacher-ng_) to be used by apt-get_.
+
+``$REDOCK_OFFLINE``
+  If this is ``true`` then ``apt-get update`` isn't run and apt-get_ won't
+  download packages; everything has to come from a pre-populated cache.
+  Building the base image or creating containers in offline mode without a
+  cache raises :py:exc:`PackageCacheMissing` (other actions like ``redock
+  kill`` don't need the cache).
+
+.. _apt-cacher-ng: http://www.unix-ag.uni-kl.de/~bloch/acng/
+.. _apt-get: http://manpages.ubuntu.com/manpages/precise/man8/apt-get.8.html
+"""
+
+# Standard library modules.
+import hashlib
+import os
+
+# External dependencies.
+from humanfriendly import format_path
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from redock.utils import REDOCK_CONFIG_DIR, coerce_boolean
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The default location of the package cache on the host system.
+APT_CACHE_DIR = os.path.join(REDOCK_CONFIG_DIR, 'apt-cache')
+
+# The location where the package cache is mounted inside containers.
+CONTAINER_CACHE_DIR = '/var/cache/redock/apt'
+
+# The location of the package lists inside containers.
+APT_LISTS_DIR = '/var/lib/apt/lists'
+
+# The location of the generated apt-get configuration on the host system.
+APT_CONFIG_DIR = os.path.join(REDOCK_CONFIG_DIR, 'apt-config')
+
+# The location where the generated configuration is mounted inside containers.
+CONTAINER_CONFIG_DIR = '/etc/apt/redock'
+
+# The generated configuration file inside containers.
+CONTAINER_CONFIG_FILE = CONTAINER_CONFIG_DIR + '/redock.conf'
+
+# The symbolic link (stored in the base image) to the generated configuration.
+APT_CONFIG_LINK = '/etc/apt/apt.conf.d/91redock-cache'
+
+# The shell command that creates the symbolic link when the generated
+# configuration is mounted into the container and removes the link otherwise
+# (so that it never dangles, e.g. when an image is used without Redock).
+APT_LINK_COMMAND = 'if [ -e {target} ]; then ln -sf {target} {link}; else rm -f {link}; fi'.format(
+        target=CONTAINER_CONFIG_FILE, link=APT_CONFIG_LINK)
+
+class PackageCache(object):
+
+    """
+    Configuration of the host side package cache. The defaults of all
+    parameters are taken from environment variables (see above).
+    """
+
+    def __init__(self, directory=None, proxy=None, offline=None, config_directory=APT_CONFIG_DIR):
+        """
+        Initialize a :py:class:`PackageCache` object.
+
+        :param directory: The pathname of the cache on the host system.
+        :param proxy: The URL of an HTTP proxy for apt-get_ (a string).
+        :param offline: ``True`` to use only packages that are already cached.
+        :param config_directory: The directory where the generated apt-get_
+                                 configuration is stored (see
+                                 :py:func:`write_apt_config()`).
+        """
+        self.logger = logger
+        self.config_directory = config_directory
+        self.directory = directory or os.environ.get('REDOCK_APT_CACHE', APT_CACHE_DIR)
+        self.proxy = proxy if proxy is not None else os.environ.get('REDOCK_APT_PROXY')
+        self.offline = offline if offline is not None else coerce_boolean(os.environ.get('REDOCK_OFFLINE', ''))
+
+    def check_offline(self):
+        """
+        Make sure packages can be installed: Raises :py:exc:`PackageCacheMissing`
+        when offline mode is enabled but the cache doesn't exist.
+        """
+        if self.offline and not self.enabled:
+            msg = "Offline mode requires a package cache! (%s doesn't exist)"
+            raise PackageCacheMissing, msg % format_path(self.directory)
+
+    @property
+    def enabled(self):
+        """
+        ``True`` if the package cache exists, ``False`` otherwise.
+        """
+        return os.path.isdir(self.directory)
+
+    @property
+    def volumes(self):
+        """
+        The ``volumes`` argument for :py:func:`docker.Client.create_container()`
+        (a dictionary).
+        """
+        volumes = {CONTAINER_CONFIG_DIR: {}}
+        if self.enabled:
+            volumes[CONTAINER_CACHE_DIR] = {}
+        return volumes
+
+    @property
+    def binds(self):
+        """
+        The ``binds`` argument for :py:func:`docker.Client.start()` (a
+        dictionary). The generated apt-get_ configuration is always mounted
+        (even if it's empty) so that the symbolic link in the base image
+        resolves. Makes sure the directories expected by apt-get_ exist.
+        Raises :py:exc:`PackageCacheMissing` (see :py:func:`check_offline()`).
+        """
+        self.check_offline()
+        binds = {self.write_apt_config(): CONTAINER_CONFIG_DIR}
+        if self.enabled:
+            for name in ('archives', 'lists'):
+                directory = os.path.join(self.directory, name, 'partial')
+                if not os.path.isdir(directory):
+                    self.logger.verbose("Creating directory: %s", format_path(directory))
+                    os.makedirs(directory)
+            binds[os.path.abspath(self.directory)] = CONTAINER_CACHE_DIR
+        return binds
+
+    @property
+    def apt_config(self):
+        """
+        The apt-get_ configuration that enables the cache (a string, empty if
+        the cache is disabled and no proxy is configured).
+        """
+        lines = []
+        if self.enabled:
+            lines.append('Dir::Cache::archives "%s/archives";' % CONTAINER_CACHE_DIR)
+        if self.proxy:
+            lines.append('Acquire::http::Proxy "%s";' % self.proxy)
+        if self.offline:
+            lines.append('APT::Get::Download "false";')
+        return '\n'.join(lines)
+
+    def write_apt_config(self):
+        """
+        Write the apt-get_ configuration (see :py:attr:`apt_config`) to a file
+        on the host system. Every distinct configuration gets a directory of
+        its own (named after the hash of the configuration), so concurrent
+        ``redock`` processes with different settings don't overwrite each
+        other's configuration.
+
+        :returns: The absolute pathname of the directory that contains the
+                  configuration file (a string).
+        """
+        contents = '%s\n' % self.apt_config if self.apt_config else ''
+        directory = os.path.abspath(os.path.join(self.config_directory, hashlib.sha1(contents).hexdigest()[:12]))
+        pathname = os.path.join(directory, 'redock.conf')
+        if not os.path.isfile(pathname):
+            self.logger.verbose("Writing apt-get configuration to %s ..", format_path(pathname))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            temporary_file = '%s.%i.tmp' % (pathname, os.getpid())
+            with open(temporary_file, 'w') as handle:
+                handle.write(contents)
+            os.rename(temporary_file, pathname)
+        return directory
+
+    def link_commands(self):
+        """
+        Get the shell commands that link the apt-get_ configuration of the
+        base image to the configuration that's mounted into containers (see
+        :py:attr:`binds`). The same command runs whenever a container built
+        from the base image starts (see :py:data:`redock.base.SUPERVISOR_CONFIG`),
+        so containers started without the configuration don't end up with a
+        dangling link.
+
+        :returns: A list of strings.
+        """
+        return [APT_LINK_COMMAND]
+
+    def update_commands(self):
+        """
+        Get the shell commands that update the package lists inside a
+        container. When the cache is enabled the package lists are copied
+        from the cache before ``apt-get update`` and back to the cache
+        afterwards, so that only changed lists are downloaded. In offline
+        mode ``apt-get update`` is skipped. Raises :py:exc:`PackageCacheMissing`
+        (see :py:func:`check_offline()`).
+
+        :returns: A list of strings.
+        """
+        self.check_offline()
+        if not self.enabled:
+            return ['apt-get update']
+        commands = ['cp -a %s/lists/. %s/' % (CONTAINER_CACHE_DIR, APT_LISTS_DIR)]
+        if not self.offline:
+            commands.append('apt-get update')
+            commands.append('cp -a %s/. %s/lists/' % (APT_LISTS_DIR, CONTAINER_CACHE_DIR))
+        return commands
+
+    def clean_commands(self):
+        """
+        Get the shell commands that remove downloaded packages after
+        installation. When the cache is enabled the packages are kept (they
+        live on the host system so they don't end up in images anyway).
+
+        :returns: A list of strings.
+        """
+        return [] if self.enabled else ['apt-get clean']
+
+class PackageCacheMissing(Exception):
+    """
+    Raised by :py:func:`PackageCache.check_offline()` when offline mode is
+    enabled but the package cache doesn't exist.
+    """
+
+# vim: ts=4 sw=4 et
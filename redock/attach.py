@@ -0,0 +1,365 @@
+# In-process multiplexing of container output for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.attach` module shows the output of running Docker
+containers on the terminal of the host system. Older versions of Redock
+started a ``docker attach`` subprocess for every container (one long lived
+process per container, plus the startup cost of the Docker command line
+interface). Now the attach sockets exposed by the Docker remote API (see
+:py:func:`docker.Client.attach_socket()`) are read by a single thread using
+:py:func:`select.select()` and the output of all containers is merged into
+lines prefixed with the name of the container they came from.
+
+The lines are written to the terminal by a second thread through a bounded
+buffer: When the terminal can't keep up (e.g. a slow SSH connection) the
+oldest lines are dropped instead of blocking the reader thread, because a
+blocked reader would eventually block the processes inside the containers
+(once the kernel's socket buffers fill up).
+"""
+
+# Standard library modules.
+import collections
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+# External dependencies.
+from verboselogs import VerboseLogger
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The maximum number of lines that are buffered for the terminal.
+DEFAULT_BUFFER_SIZE = 1000
+
+# The maximum length of a line (longer lines are split).
+MAX_LINE_LENGTH = 1024 * 16
+
+# The number of bytes read from an attach socket at once.
+READ_SIZE = 1024 * 4
+
+# The number of seconds to wait for remaining output when detaching.
+DETACH_TIMEOUT = 1
+
+# The stream types used in the multiplexed output of the Docker remote API.
+STREAM_TYPES = ('\x00', '\x01', '\x02')
+
+class OutputMultiplexer(object):
+
+    """
+    Merge the output of any number of attach sockets into a single stream of
+    lines. The reader and writer threads are started when the first socket
+    is added (see :py:func:`add()`).
+    """
+
+    def __init__(self, stream=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        """
+        Initialize an :py:class:`OutputMultiplexer` object.
+
+        :param stream: The file-like object to write lines to (defaults to
+                       :py:data:`sys.stderr` at the time of writing).
+        :param buffer_size: The maximum number of lines to buffer before the
+                            oldest lines are dropped.
+        """
+        self.logger = logger
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.buffer = collections.deque()
+        self.sources = {}
+        self.condition = threading.Condition()
+        self.writing = False
+        self.stopping = False
+        self.lines_received = 0
+        self.lines_dropped = 0
+        self.reader = None
+        self.writer = None
+        self.wakeup_pipe = None
+
+    def add(self, key, name, sock):
+        """
+        Start reading the output of a container.
+
+        :param key: A unique identifier for the socket (e.g. the container id).
+        :param name: The prefix for lines from this socket (a string).
+        :param sock: A connected :py:class:`socket.socket` object (as returned
+                     by :py:func:`docker.Client.attach_socket()`).
+        """
+        with self.condition:
+            if key in self.sources:
+                self.sources[key].close()
+            self.sources[key] = OutputSource(name, sock)
+            self.start()
+        self.wakeup()
+
+    def remove(self, key, timeout=0):
+        """
+        Stop reading the output of a container.
+
+        :param key: The identifier given to :py:func:`add()`.
+        :param timeout: The number of seconds to wait for the remaining output
+                        (i.e. until the container closes the socket).
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while key in self.sources and time.time() < deadline:
+                self.condition.wait(min(0.1, deadline - time.time()))
+            source = self.sources.pop(key, None)
+            if source:
+                for line in source.flush():
+                    self.emit(line)
+        if source:
+            source.close()
+            self.wakeup()
+
+    def flush(self, timeout=DETACH_TIMEOUT):
+        """
+        Wait for the buffered lines to be written to the terminal.
+
+        :param timeout: The maximum number of seconds to wait.
+        :returns: ``True`` if the buffer was flushed, ``False`` otherwise.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while (self.buffer or self.writing) and time.time() < deadline:
+                self.condition.wait(min(0.1, deadline - time.time()))
+            return not (self.buffer or self.writing)
+
+    def start(self):
+        """
+        Start the reader and writer threads (if they're not running yet).
+        """
+        if not self.reader:
+            self.wakeup_pipe = os.pipe()
+            self.reader = threading.Thread(target=self.read_loop)
+            self.reader.daemon = True
+            self.reader.start()
+            self.writer = threading.Thread(target=self.write_loop)
+            self.writer.daemon = True
+            self.writer.start()
+
+    def stop(self):
+        """
+        Stop the reader and writer threads (after the buffered lines have been
+        written) and close the remaining sockets. The threads are started
+        again when another socket is added (see :py:func:`add()`).
+        """
+        with self.condition:
+            if not self.reader:
+                return
+            self.stopping = True
+            self.condition.notify_all()
+        self.wakeup()
+        self.reader.join()
+        self.writer.join()
+        with self.condition:
+            for source in self.sources.values():
+                source.close()
+            self.sources = {}
+            for fd in self.wakeup_pipe:
+                os.close(fd)
+            self.wakeup_pipe = None
+            self.reader = None
+            self.writer = None
+            self.stopping = False
+
+    def wakeup(self):
+        """
+        Interrupt the reader thread so that it notices added or removed sockets.
+        """
+        if self.wakeup_pipe:
+            os.write(self.wakeup_pipe[1], 'x')
+
+    def read_loop(self):
+        """
+        The main loop of the reader thread.
+        """
+        while True:
+            with self.condition:
+                if self.stopping:
+                    break
+                sources = dict((s.fileno(), (k, s)) for k, s in self.sources.items())
+            try:
+                readable = select.select([self.wakeup_pipe[0]] + sources.keys(), [], [])[0]
+            except (select.error, socket.error), e:
+                # A socket was closed by remove() while we were waiting.
+                if e.args[0] not in (errno.EBADF, errno.EINTR):
+                    raise
+                continue
+            for fd in readable:
+                if fd == self.wakeup_pipe[0]:
+                    os.read(fd, READ_SIZE)
+                    continue
+                key, source = sources[fd]
+                try:
+                    data = source.sock.recv(READ_SIZE)
+                except socket.error, e:
+                    self.logger.debug("Failed to read output of %s! (%s)", source.name, e)
+                    data = ''
+                with self.condition:
+                    if self.sources.get(key) is not source:
+                        # The socket was removed in the mean time.
+                        continue
+                    for line in source.feed(data):
+                        self.emit(line)
+                    if not data:
+                        for line in source.flush():
+                            self.emit(line)
+                        del self.sources[key]
+                        source.close()
+                        self.condition.notify_all()
+
+    def emit(self, line):
+        """
+        Add a line to the buffer (the caller must hold :py:attr:`condition`).
+        When the buffer is full the oldest line is dropped.
+
+        :param line: The line to write to the terminal (a string).
+        """
+        self.lines_received += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.buffer.popleft()
+            self.lines_dropped += 1
+        self.buffer.append(line)
+        self.condition.notify_all()
+
+    def write_loop(self):
+        """
+        The main loop of the writer thread.
+        """
+        reported = 0
+        while True:
+            with self.condition:
+                self.writing = False
+                self.condition.notify_all()
+                while not (self.buffer or self.stopping):
+                    self.condition.wait(1)
+                if not self.buffer:
+                    break
+                lines = list(self.buffer)
+                self.buffer.clear()
+                dropped = self.lines_dropped - reported
+                reported = self.lines_dropped
+                self.writing = True
+            if dropped > 0:
+                lines.insert(0, "(%i lines of container output dropped, terminal is too slow)\n" % dropped)
+            stream = self.stream or sys.stderr
+            try:
+                stream.write(''.join(lines))
+                stream.flush()
+            except Exception, e:
+                self.logger.debug("Failed to write container output! (%s)", e)
+
+class OutputSource(object):
+
+    """
+    The state of a single attach socket registered with an
+    :py:class:`OutputMultiplexer`. Supports both the raw output of containers
+    with a pseudo-tty and the multiplexed stream format of the Docker remote
+    API (where stdout and stderr are sent as frames with an 8 byte header).
+    """
+
+    def __init__(self, name, sock):
+        """
+        Initialize an :py:class:`OutputSource` object.
+
+        :param name: The prefix for lines from this socket (a string).
+        :param sock: A connected :py:class:`socket.socket` object.
+        """
+        self.name = name
+        self.sock = sock
+        self.pending = ''
+        self.multiplexed = None
+        self.partial_lines = {}
+
+    def fileno(self):
+        """
+        Get the file descriptor of the socket (for :py:func:`select.select()`).
+        """
+        return self.sock.fileno()
+
+    def feed(self, data):
+        """
+        Process data received from the socket.
+
+        :param data: The received data (a string).
+        :returns: A list of complete lines (strings ending in a newline).
+        """
+        self.pending += data
+        if self.multiplexed is None:
+            if len(self.pending) < 4 and data:
+                # Wait for enough data to recognize the stream format.
+                return []
+            self.multiplexed = (self.pending[:1] in STREAM_TYPES and self.pending[1:4] == '\x00\x00\x00')
+        lines = []
+        if not self.multiplexed:
+            lines.extend(self.split_lines(1, self.pending))
+            self.pending = ''
+        else:
+            while len(self.pending) >= 8:
+                size = struct.unpack('>I', self.pending[4:8])[0]
+                if len(self.pending) < 8 + size:
+                    break
+                stream_type = ord(self.pending[0])
+                lines.extend(self.split_lines(stream_type, self.pending[8:8 + size]))
+                self.pending = self.pending[8 + size:]
+        return lines
+
+    def split_lines(self, stream_type, text):
+        """
+        Split received text into complete lines, remembering any partial line
+        until more text is received.
+
+        :param stream_type: The stream the text was received on (an integer).
+        :param text: The received text (a string).
+        :returns: A list of complete lines (strings ending in a newline).
+        """
+        lines = (self.partial_lines.pop(stream_type, '') + text).split('\n')
+        remainder = lines.pop()
+        while len(remainder) > MAX_LINE_LENGTH:
+            lines.append(remainder[:MAX_LINE_LENGTH])
+            remainder = remainder[MAX_LINE_LENGTH:]
+        if remainder:
+            self.partial_lines[stream_type] = remainder
+        return [self.format_line(l) for l in lines]
+
+    def flush(self):
+        """
+        Get any partial lines that haven't been returned by :py:func:`feed()`.
+
+        :returns: A list of lines (strings ending in a newline).
+        """
+        lines = [self.format_line(l) for k, l in sorted(self.partial_lines.items())]
+        self.partial_lines = {}
+        return lines
+
+    def format_line(self, line):
+        """
+        Prefix a line of output with the name of the container.
+
+        :param line: The line without a trailing newline (a string).
+        :returns: The prefixed line including a trailing newline (a string).
+        """
+        return '%s: %s\n' % (self.name, line.rstrip('\r'))
+
+    def close(self):
+        """
+        Close the socket.
+        """
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+# The multiplexer shared by all containers in the current process.
+multiplexer = OutputMultiplexer()
+
+# vim: ts=4 sw=4 et
@@ -1,7 +1,7 @@
 # Initialization of the base image used by Redock.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: September 30, 2013
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-redock
 
 """
@@ -9,18 +9,35 @@ The :py:mod:`redock.base` module implements the initialization of the base
 image used by Redock. You'll probably never need to use this module directly
 because :py:func:`redock.api.Container.start()` calls
 :py:func:`find_base_image()` and :py:func:`create_base_image()` as needed.
+
+Building the base image takes a few minutes, so when you provision several
+hosts you can build it once, save it to a tarball using ``redock
+export-base`` (see :py:func:`export_base_image()`) and copy the tarball to
+``~/.redock/base-images`` on the other hosts (or point the environment
+variable ``$REDOCK_BASE_IMAGES`` to a shared directory). When the base image
+doesn't exist :py:func:`find_base_image()` imports the most recent tarball
+instead of building the image (see :py:func:`import_base_image()`).
 """
 
 # Standard library modules.
+import gzip
+import hashlib
+import os
 import pipes
+import re
+import threading
 
 # External dependencies.
-from humanfriendly import Timer
+from humanfriendly import Timer, format_path, format_size
 from verboselogs import VerboseLogger
 
 # Modules included in our package.
-from redock.utils import (RemoteTerminal, get_ssh_public_key,
-                          select_ubuntu_mirror, summarize_id)
+from redock.aptcache import APT_LINK_COMMAND, PackageCache
+from redock.inventory import Inventory
+from redock.pull import import_tarball, pull_image
+from redock.utils import (REDOCK_CONFIG_DIR, RemoteTerminal,
+                          get_ssh_public_key, select_ubuntu_mirror,
+                          summarize_id)
 
 # Initialize a logger for this module.
 logger = VerboseLogger(__name__)
@@ -31,6 +48,35 @@ BASE_IMAGE_TAG = 'base'
 BASE_IMAGE_NAME = '%s:%s' % (BASE_IMAGE_REPO, BASE_IMAGE_TAG)
 SSHD_LOG_FILE = '/var/log/sshd.log'
 
+# The repository of the intermediate images created by create_base_image() and
+# the number of hexadecimal digits of the cache keys included in their tags.
+BASE_STAGE_REPO = 'redock-stage'
+STAGE_KEY_LENGTH = 12
+
+# The host name of the containers that run the stages of the build.
+BUILD_HOSTNAME = 'redock-template'
+
+# The environment variable that passes the selected Ubuntu mirror to the
+# stages of the build (so that the mirror isn't part of the stage keys).
+MIRROR_VARIABLE = 'UBUNTU_MIRROR'
+
+# The command that runs inside the containers started by Redock.
+SUPERVISOR_COMMAND = '/usr/bin/supervisord -n'
+
+# The default directory with tarballs of the base image.
+BASE_EXPORT_DIR = os.path.join(REDOCK_CONFIG_DIR, 'base-images')
+
+# The filenames of the tarballs contain the SHA-1 hash of their contents.
+BASE_EXPORT_PATTERN = re.compile(r'^redock-base-([0-9a-f]{40})\.tar\.gz$')
+
+# The number of bytes copied at once while exporting and hashing tarballs.
+EXPORT_CHUNK_SIZE = 1024 * 64
+
+# Locks that make sure concurrent callers of download_image() don't download
+# the same image more than once.
+download_locks = {}
+download_locks_lock = threading.Lock()
+
 APT_CONFIG = '''
 # /etc/apt/apt.conf.d/90redock:
 # Disable automatic installation of recommended packages. Debian doesn't do
@@ -60,28 +106,45 @@ command = bash -c 'mkdir -p -m0755 /var/run/sshd && /usr/sbin/sshd -eD'
 # redirect_stderr = true
 autorestart = true
 
+# Link the configuration of the package cache on the host system when it's
+# mounted into the container, otherwise remove the link (see redock.aptcache).
+[program:apt-config]
+command = bash -c {apt_link_command}
+autorestart = false
+startsecs = 0
+
 # vim: ft=dosini
-'''.format(log_file=SSHD_LOG_FILE)
+'''.format(log_file=SSHD_LOG_FILE, apt_link_command=pipes.quote(APT_LINK_COMMAND))
 
-def find_base_image(client):
+def find_base_image(client, inventory=None, cache=None):
     """
     Find the id of the base image that's used by Redock to create new
-    containers. If the image doesn't exist yet it will be created using
-    :py:func:`create_base_image()`.
+    containers. If the image doesn't exist yet it will be imported from a
+    tarball created by :py:func:`export_base_image()` (if one is available)
+    or created using :py:func:`create_base_image()`.
 
     :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param inventory: A :py:class:`redock.inventory.Inventory` object
+                      (optional, one is created if not given).
+    :param cache: A :py:class:`redock.aptcache.PackageCache` object
+                  (optional, one is created if not given).
     :returns: The unique id of the base image.
     """
+    inventory = inventory or Inventory(client)
     logger.verbose("Looking for base image ..")
-    image_id = find_named_image(client, BASE_IMAGE_REPO, BASE_IMAGE_TAG)
+    image_id = find_named_image(client, BASE_IMAGE_REPO, BASE_IMAGE_TAG, inventory)
     if image_id:
         logger.verbose("Found base image: %s", summarize_id(image_id))
         return image_id
-    else:
-        logger.verbose("No base image found, creating it ..")
-        return create_base_image(client)
-
-def create_base_image(client):
+    for pathname in find_base_tarballs():
+        try:
+            return import_base_image(client, pathname, inventory, cache)
+        except Exception, e:
+            logger.warn("Failed to import base image from %s! (%s)", format_path(pathname), e)
+    logger.verbose("No base image found, creating it ..")
+    return create_base_image(client, inventory, cache)
+
+def create_base_image(client, inventory=None, cache=None):
     """
     Create the base image that's used by Redock to create new containers. This
     base image differs from the ubuntu:precise_ image (on which it is based) on
@@ -124,7 +187,25 @@ def create_base_image(client):
 
     - Supervisor_ is configured to automatically start the SSH_ server.
 
+    The image is built in stages (see :py:func:`get_build_stages()`) and the
+    result of each stage is committed as an intermediate image in the
+    ``redock-stage`` repository. The tag of an intermediate image contains a
+    hash of the stage's command and the stages before it, so when only the
+    SSH_ key changes the package installation isn't repeated. The selected
+    Ubuntu mirror is passed to the stages in an environment variable instead
+    of being part of their commands, so a change in the ranking of mirrors
+    doesn't invalidate any stages; the image keeps using the mirror that was
+    selected when the ``apt`` stage was run.
+
+    If the package cache on the host system is enabled (see
+    :py:mod:`redock.aptcache`) it's used to avoid downloading package lists
+    and packages that were downloaded before.
+
     :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param inventory: A :py:class:`redock.inventory.Inventory` object
+                      (optional, one is created if not given).
+    :param cache: A :py:class:`redock.aptcache.PackageCache` object
+                  (optional, one is created if not given).
     :returns: The unique id of the base image.
 
     .. _apt-get: http://manpages.ubuntu.com/manpages/precise/man8/apt-get.8.html
@@ -138,73 +219,356 @@ def create_base_image(client):
     .. _ubuntu:precise: https://index.docker.io/_/ubuntu/
     .. _upstart: http://packages.ubuntu.com/precise/upstart
     """
-    download_image(client, 'ubuntu', 'precise')
+    inventory = inventory or Inventory(client)
+    cache = cache or PackageCache()
+    download_image(client, 'ubuntu', 'precise', inventory)
     creation_timer = Timer()
     logger.info("Initializing base image (this can take a few minutes but you only have to do it once) ..")
-    command = ' && '.join([
-        'echo %s > /etc/apt/apt.conf.d/90redock' % pipes.quote(APT_CONFIG.strip()),
-        'echo %s > /etc/apt/sources.list' % pipes.quote(SOURCES_LIST.format(mirror=select_ubuntu_mirror()).strip()),
-        'apt-get update',
-        'DEBIAN_FRONTEND=noninteractive apt-get install -q -y language-pack-en-base openssh-server supervisor',
-        'apt-get clean', # Don't keep the +/- 20 MB of *.deb archives after installation.
-        # Make it possible to run `apt-get dist-upgrade'.
-        # https://help.ubuntu.com/community/PinningHowto#Introduction_to_Holding_Packages
-        'apt-mark hold initscripts upstart',
+    image_id = find_named_image(client, 'ubuntu', 'precise', inventory)
+    image_id = run_build_stages(client, inventory, image_id, get_build_stages(cache), cache)
+    tag_base_image(client, inventory, image_id)
+    logger.info("Done! Initialized base image %s in %s.", summarize_id(image_id), creation_timer)
+    return image_id
+
+def export_base_image(client, directory=None, inventory=None):
+    """
+    Save the base image to a gzip compressed tarball so that it can be
+    imported on other hosts using :py:func:`import_base_image()`. The
+    filename of the tarball contains the SHA-1 hash of its contents. The
+    image is streamed from the Docker daemon to disk, it's never buffered in
+    memory.
+
+    Docker can only export the file system of a container, so the tarball
+    contains a flattened copy of the base image (this also means the
+    imported image consists of a single layer).
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param directory: The directory where the tarball is created (defaults
+                      to ``$REDOCK_BASE_IMAGES`` or ``~/.redock/base-images``).
+    :param inventory: A :py:class:`redock.inventory.Inventory` object
+                      (optional, one is created if not given).
+    :returns: The pathname of the tarball (a string).
+    """
+    inventory = inventory or Inventory(client)
+    directory = directory or get_export_directory()
+    image_id = find_named_image(client, BASE_IMAGE_REPO, BASE_IMAGE_TAG, inventory)
+    if not image_id:
+        msg = "The base image %s doesn't exist yet, so it can't be exported!"
+        raise BaseImageMissing, msg % BASE_IMAGE_NAME
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    export_timer = Timer()
+    logger.info("Exporting base image %s to %s ..", summarize_id(image_id), format_path(directory))
+    result = client.create_container(image=image_id, command='true')
+    container_id = result['Id']
+    inventory.invalidate(images=False)
+    temporary_file = os.path.join(directory, '.redock-base-%i.tar.gz.tmp' % os.getpid())
+    try:
+        stream = client.export(container_id)
+        with open(temporary_file, 'wb') as handle:
+            # An empty filename and mtime make the output deterministic.
+            compressor = gzip.GzipFile(filename='', mode='wb', fileobj=handle, mtime=0)
+            while True:
+                chunk = stream.read(EXPORT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                compressor.write(chunk)
+            compressor.close()
+        pathname = os.path.join(directory, 'redock-base-%s.tar.gz' % hash_file(temporary_file))
+        os.rename(temporary_file, pathname)
+    finally:
+        if os.path.exists(temporary_file):
+            os.unlink(temporary_file)
+        client.remove_container(container_id)
+        inventory.invalidate(images=False)
+    logger.info("Exported base image to %s (%s) in %s.", format_path(pathname),
+                format_size(os.path.getsize(pathname)), export_timer)
+    return pathname
+
+def import_base_image(client, pathname=None, inventory=None, cache=None):
+    """
+    Import the base image from a tarball created by :py:func:`export_base_image()`.
+
+    The contents of the tarball are checked against the hash in its filename
+    before the tarball is streamed to the Docker daemon. Afterwards the
+    ``config`` stage of the build (see :py:func:`get_build_stages()`) is run
+    on top of the imported image, because the SSH key generated by Redock
+    differs between hosts.
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param pathname: The pathname of the tarball (defaults to the most recent
+                     tarball found by :py:func:`find_base_tarballs()`).
+    :param inventory: A :py:class:`redock.inventory.Inventory` object
+                      (optional, one is created if not given).
+    :param cache: A :py:class:`redock.aptcache.PackageCache` object
+                  (optional, one is created if not given).
+    :returns: The unique id of the base image.
+    """
+    inventory = inventory or Inventory(client)
+    cache = cache or PackageCache()
+    if not pathname:
+        tarballs = find_base_tarballs()
+        if not tarballs:
+            msg = "No exported base images found in %s!"
+            raise BaseImageMissing, msg % format_path(get_export_directory())
+        pathname = tarballs[0]
+    import_timer = Timer()
+    logger.verbose("Verifying contents of %s ..", format_path(pathname))
+    digest = hash_file(pathname)
+    match = BASE_EXPORT_PATTERN.match(os.path.basename(pathname))
+    if not match:
+        logger.warn("Can't verify contents of %s! (the filename doesn't contain a hash)", format_path(pathname))
+    elif match.group(1) != digest:
+        msg = "The contents of %s don't match the hash in its filename! (truncated copy?)"
+        raise CorruptTarball, msg % format_path(pathname)
+    tag = 'import-%s' % digest[:STAGE_KEY_LENGTH]
+    image_id = find_named_image(client, BASE_STAGE_REPO, tag, inventory)
+    if image_id:
+        logger.verbose("Tarball was previously imported as %s.", summarize_id(image_id))
+    else:
+        logger.info("Importing base image from %s (%s) ..", format_path(pathname),
+                    format_size(os.path.getsize(pathname)))
+        with open(pathname, 'rb') as handle:
+            # The file is streamed to the Docker daemon, which decompresses it.
+            import_tarball(client, handle, BASE_STAGE_REPO, tag)
+        inventory.invalidate(containers=False)
+        image_id = find_named_image(client, BASE_STAGE_REPO, tag, inventory)
+        if not image_id:
+            msg = "Docker didn't create the image %s:%s while importing %s!"
+            raise BaseImageMissing, msg % (BASE_STAGE_REPO, tag, format_path(pathname))
+    image_id = run_build_stages(client, inventory, image_id, [get_config_stage()], cache)
+    tag_base_image(client, inventory, image_id)
+    logger.info("Imported base image %s in %s.", summarize_id(image_id), import_timer)
+    return image_id
+
+def find_base_tarballs(directory=None):
+    """
+    Find the tarballs created by :py:func:`export_base_image()`.
+
+    :param directory: The directory to search (defaults to
+                      ``$REDOCK_BASE_IMAGES`` or ``~/.redock/base-images``).
+    :returns: A list of pathnames (strings), most recent first.
+    """
+    directory = directory or get_export_directory()
+    if not os.path.isdir(directory):
+        return []
+    pathnames = [os.path.join(directory, fn) for fn in os.listdir(directory) if BASE_EXPORT_PATTERN.match(fn)]
+    return sorted(pathnames, key=os.path.getmtime, reverse=True)
+
+def get_export_directory():
+    """
+    Get the directory with tarballs of the base image.
+
+    :returns: The value of ``$REDOCK_BASE_IMAGES`` or ``~/.redock/base-images``.
+    """
+    return os.environ.get('REDOCK_BASE_IMAGES', BASE_EXPORT_DIR)
+
+def hash_file(pathname):
+    """
+    Calculate the SHA-1 hash of a file without reading the whole file into
+    memory.
+
+    :param pathname: The pathname of the file (a string).
+    :returns: The hexadecimal digest (a string).
+    """
+    context = hashlib.sha1()
+    with open(pathname, 'rb') as handle:
+        while True:
+            chunk = handle.read(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            context.update(chunk)
+    return context.hexdigest()
+
+def tag_base_image(client, inventory, image_id):
+    """
+    Tag an image as the base image (``redock:base``).
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param inventory: A :py:class:`redock.inventory.Inventory` object.
+    :param image_id: The id of the image (a string).
+    """
+    logger.verbose("Tagging %s as %s ..", summarize_id(image_id), BASE_IMAGE_NAME)
+    client.tag(image_id, BASE_IMAGE_REPO, BASE_IMAGE_TAG, force=True)
+    inventory.invalidate(containers=False)
+
+def get_build_stages(cache):
+    """
+    Get the stages of the build of the base image (see
+    :py:func:`create_base_image()`). Stages that are expensive and rarely
+    change come first, so that changes to later stages (e.g. a new SSH key)
+    don't invalidate earlier stages (e.g. the installation of system packages).
+
+    :param cache: A :py:class:`redock.aptcache.PackageCache` object.
+    :returns: A list of tuples with two strings each: The name of the stage
+              and the shell command that performs the stage.
+    """
+    # The mirror is expanded by the shell inside the container (see
+    # MIRROR_VARIABLE and run_build_stage()).
+    sources_list = SOURCES_LIST.strip().split('{mirror}')
+    # The configuration of the package cache is specific to the host system,
+    # so it's not stored in the image (see redock.aptcache).
+    return [
+        ('apt', ' && '.join([
+            'echo %s > /etc/apt/apt.conf.d/90redock' % pipes.quote(APT_CONFIG.strip())]
+            + cache.link_commands() + [
+            'echo %s"$%s"%s > /etc/apt/sources.list' % (pipes.quote(sources_list[0]), MIRROR_VARIABLE,
+                                                         pipes.quote(sources_list[1]))]
+            + cache.update_commands())),
+        ('packages', ' && '.join([
+            'DEBIAN_FRONTEND=noninteractive apt-get install -q -y language-pack-en-base openssh-server supervisor']
+            # Don't keep the +/- 20 MB of *.deb archives after installation.
+            + cache.clean_commands() + [
+            # Make it possible to run `apt-get dist-upgrade'.
+            # https://help.ubuntu.com/community/PinningHowto#Introduction_to_Holding_Packages
+            'apt-mark hold initscripts upstart'])),
+        get_config_stage(),
+    ]
+
+def get_config_stage():
+    """
+    Get the last stage of the build of the base image, which contains the
+    configuration that's specific to the host system (see
+    :py:func:`get_build_stages()` and :py:func:`import_base_image()`).
+
+    :returns: A tuple with two strings: The name of the stage and the shell
+              command that performs the stage.
+    """
+    return ('config', ' && '.join([
         # Install the generated SSH public key.
         'mkdir -p /root/.ssh',
         'echo %s > /root/.ssh/authorized_keys' % pipes.quote(get_ssh_public_key()),
         # Create the Supervisor configuration for the SSH server.
-        'echo %s > /etc/supervisor/conf.d/ssh-server.conf' % pipes.quote(SUPERVISOR_CONFIG.strip())])
+        'echo %s > /etc/supervisor/conf.d/ssh-server.conf' % pipes.quote(SUPERVISOR_CONFIG.strip())]))
+
+def run_build_stages(client, inventory, image_id, stages, cache):
+    """
+    Run stages of the build of the base image, reusing the intermediate
+    images of stages that were run before (see :py:func:`create_base_image()`).
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param inventory: A :py:class:`redock.inventory.Inventory` object.
+    :param image_id: The id of the image to start from (a string).
+    :param stages: A list of tuples like the ones returned by
+                   :py:func:`get_build_stages()`.
+    :param cache: A :py:class:`redock.aptcache.PackageCache` object.
+    :returns: The id of the image created by the last stage (a string).
+    """
+    cache_key = image_id
+    for name, command in stages:
+        cache_key = hashlib.sha1('\n'.join([cache_key, name, command])).hexdigest()
+        tag = '%s-%s' % (name, cache_key[:STAGE_KEY_LENGTH])
+        cached_id = find_named_image(client, BASE_STAGE_REPO, tag, inventory)
+        if cached_id:
+            logger.verbose("Reusing %s stage of base image: %s", name, summarize_id(cached_id))
+            image_id = cached_id
+        else:
+            image_id = run_build_stage(client, inventory, image_id, name, command, tag, cache)
+    return image_id
+
+def run_build_stage(client, inventory, image_id, name, command, tag, cache):
+    """
+    Run one stage of the build of the base image in a new container and
+    commit the result as an intermediate image.
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param inventory: A :py:class:`redock.inventory.Inventory` object.
+    :param image_id: The id of the image created by the previous stage.
+    :param name: The name of the stage (a string).
+    :param command: The shell command that performs the stage (a string).
+    :param tag: The tag of the intermediate image (a string).
+    :param cache: A :py:class:`redock.aptcache.PackageCache` object.
+    :returns: The unique id of the intermediate image.
+    """
+    stage_timer = Timer()
+    logger.info("Running %s stage of base image ..", name)
     logger.debug("Generated command line: %s", command)
-    result = client.create_container(image='ubuntu:precise',
+    environment = []
+    if '$%s' % MIRROR_VARIABLE in command:
+        environment.append('%s=%s' % (MIRROR_VARIABLE, select_ubuntu_mirror()))
+    result = client.create_container(image=image_id,
                                      command='bash -c %s' % pipes.quote(command),
-                                     hostname='redock-template',
-                                     ports=['22'])
+                                     hostname=BUILD_HOSTNAME,
+                                     ports=['22'],
+                                     environment=environment,
+                                     volumes=cache.volumes)
     container_id = result['Id']
+    inventory.invalidate(images=False)
     for text in result.get('Warnings', []):
       logger.warn("%s", text)
     logger.verbose("Created container %s.", summarize_id(container_id))
-    client.start(container_id)
-    with RemoteTerminal(container_id):
-        logger.info("Waiting for initialization to finish ..")
-        client.wait(container_id)
-        logger.info("Finished initialization in %s.", creation_timer)
-    commit_timer = Timer()
-    logger.info("Saving initialized container as new base image ..")
-    result = client.commit(container_id, repository='redock', tag='base')
-    logger.info("Done! Committed base image as %s in %s.", summarize_id(result['Id']), commit_timer)
-    return result['Id']
-
-def find_named_image(client, repository, tag):
+    try:
+        client.start(container_id, binds=cache.binds)
+        with RemoteTerminal(container_id, client, name=name):
+            status = client.wait(container_id)
+        if status != 0:
+            # Never cache the result of a failed stage.
+            msg = "The %s stage of the base image failed! (exit status %i)"
+            raise BuildStageFailed, msg % (name, status)
+        logger.verbose("Finished %s stage in %s, saving intermediate image ..", name, stage_timer)
+        result = client.commit(container_id, repository=BASE_STAGE_REPO, tag=tag)
+        inventory.invalidate(containers=False)
+        logger.verbose("Committed %s stage as %s:%s (%s).", name,
+                       BASE_STAGE_REPO, tag, summarize_id(result['Id']))
+        return result['Id']
+    finally:
+        client.remove_container(container_id)
+        inventory.invalidate(images=False)
+
+def find_named_image(client, repository, tag, inventory=None):
     """
     Find the most recent Docker image with the given repository and tag.
 
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
     :param repository: The name of the image's repository.
     :param tag: The name of the image's tag.
+    :param inventory: A :py:class:`redock.inventory.Inventory` object
+                      (optional, one is created if not given).
     :returns: The unique id of the most recent image available, or ``None`` if
               no images were matched.
     """
-    matches = []
-    for image in client.images():
-        if image.get('Repository') == repository and image.get('Tag') == tag:
-            matches.append(image)
-    if matches:
-        matches.sort(key=lambda i: i['Created'])
-        return matches[-1]['Id']
+    image = (inventory or Inventory(client)).find_image(repository, tag)
+    if image:
+        return image['Id']
 
-def download_image(client, repository, tag):
+def download_image(client, repository, tag, inventory=None):
     """
     Download the requested image. If the image is already available locally it
-    won't be downloaded again.
+    won't be downloaded again. The progress of the download is reported while
+    it's running (see :py:func:`redock.pull.pull_image()`). When several
+    threads request the same image at the same time it's downloaded once.
 
     :param client: Connection to Docker (instance of :py:class:`docker.Client`)
     :param repository: The name of the image's repository.
     :param tag: The name of the image's tag.
+    :param inventory: A :py:class:`redock.inventory.Inventory` object
+                      (optional, one is created if not given).
+    """
+    inventory = inventory or Inventory(client)
+    with download_locks_lock:
+        lock = download_locks.setdefault((repository, tag), threading.Lock())
+    with lock:
+        if not find_named_image(client, repository, tag, inventory):
+            pull_image(client, repository, tag)
+            inventory.invalidate(containers=False)
+
+class BaseImageMissing(Exception):
+    """
+    Raised by :py:func:`export_base_image()` when the base image doesn't
+    exist and by :py:func:`import_base_image()` when there's nothing to
+    import.
+    """
+
+class CorruptTarball(Exception):
+    """
+    Raised by :py:func:`import_base_image()` when the contents of a tarball
+    don't match the hash in its filename.
+    """
+
+class BuildStageFailed(Exception):
+    """
+    Raised by :py:func:`run_build_stage()` when the command of a stage exits
+    with a nonzero exit status.
     """
-    if not find_named_image(client, repository, tag):
-        download_timer = Timer()
-        logger.info("Downloading image %s:%s (please be patient, this can take a while) ..", repository, tag)
-        client.pull(repository=repository, tag=tag)
-        logger.info("Finished downloading image in %s.", download_timer)
 
 # vim: ts=4 sw=4 et
@@ -1,7 +1,7 @@
 # Minimal configuration management specialized to Ubuntu (Debian).
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: September 30, 2013
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-redock
 
 """
@@ -19,7 +19,9 @@ commands. Here is the design rationale behind Bootstrap (in its current form):
 **Based on SSH connections**
   SSH_ is used to connect to remote hosts because it's the lowest common
   denominator that works with Docker_, VirtualBox_, XenServer_ and physical
-  servers while being secure and easy to use.
+  servers while being secure and easy to use. All SSH sessions to a host
+  (including the ones used by execnet_ and rsync) share a single SSH master
+  connection (see :py:class:`Connection`).
 
 **Remote code execution using Python**
   The execnet_ package is used to execute Python code on remote systems because
@@ -39,21 +41,38 @@ commands. Here is the design rationale behind Bootstrap (in its current form):
 """
 
 # Standard library modules.
+import atexit
+import contextlib
+import hashlib
 import os
 import os.path
 import pipes
+import StringIO
 import subprocess
+import sys
+import tempfile
+import threading
 
 # External dependencies.
 from execnet import makegateway
-from humanfriendly import Timer
+from humanfriendly import Timer, format_size, format_timespan
 from verboselogs import VerboseLogger
 
 # Modules included in our package.
-from redock.utils import quote_command_line
+from redock.parallel import DEFAULT_CONCURRENCY, WorkerPool
+from redock.utils import (REDOCK_CONFIG_DIR, SSH_CONFIG_FILE, Config,
+                          create_configuration_directory,
+                          quote_command_line, slug)
 
 MIRROR_FILE = os.path.expanduser('~/.redock/ubuntu-mirror.txt')
 
+# The size of the chunks in which Bootstrap.upload_files() sends files.
+UPLOAD_CHUNK_SIZE = 1024 * 64
+
+# The number of seconds that SSH master connections stay open after the last
+# session ends.
+SSH_CONTROL_PERSIST = 60
+
 # Initialize a logger for this module.
 logger = VerboseLogger(__name__)
 
@@ -64,70 +83,221 @@ class Bootstrap(object):
     :py:class:`Bootstrap`.
     """
 
-    def __init__(self, ssh_alias):
+    def __init__(self, ssh_alias, interactive=None):
         """
         Initialize the configuration management system by creating an execnet_
         gateway over an SSH connection. First we make sure the ``python2.7``
-        package is installed; without it execnet_ won't work.
+        package is installed; without it execnet_ won't work. The connection
+        is taken from :py:data:`connection_pool` so :py:class:`Bootstrap`
+        objects for the same host share a single connection (and the check
+        for ``python2.7`` is only done once).
 
         :param ssh_alias: Alias of remote host in SSH client configuration.
+        :param interactive: ``False`` to never allocate a pseudo-tty_ for
+                            remote commands (see :py:func:`execute()`).
         """
         self.logger = logger
         self.ssh_alias = ssh_alias
-        # TODO Weaken requirement to just having "some version" of Python installed?
-        self.logger.info("%s: Making sure the `python2.7' package is installed ..", self.ssh_alias)
-        self.install_packages('python2.7')
-        self.logger.info("%s: Initializing execnet over SSH connection ..", self.ssh_alias)
-        # TODO Support sudo using makegateway('ssh=%s//python=sudo python')
-        self.gateway = makegateway("ssh=%s" % self.ssh_alias)
+        self.interactive = interactive
+        self.config = Config()
+        self.connection = connection_pool.get(ssh_alias)
+        self.pending_packages = []
+        self.batch_depth = 0
+        if not self.connection.has_gateway:
+            # TODO Weaken requirement to just having "some version" of Python installed?
+            self.logger.info("%s: Making sure the `python2.7' package is installed ..", self.ssh_alias)
+            # Only run apt-get when python2.7 is missing (using a single SSH session).
+            self.execute('dpkg -s python2.7 >/dev/null 2>&1 || apt-get install -q -y python2.7')
+        self.gateway = self.connection.gateway
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Create a context manager that coalesces the calls to
+        :py:func:`install_packages()` in the ``with`` block into a single
+        ``apt-get install`` command. Other remote operations (e.g.
+        :py:func:`execute()`) first install the pending packages so that
+        operations still happen in the order they were requested.
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.flush_packages()
 
     def upload_file(self, pathname, contents):
         """
-        Create a file on the remote file system.
+        Create a file on the remote file system (see :py:func:`upload_files()`).
 
         :param pathname: The absolute pathname on the remote system.
         :param contents: The contents of the file (a string).
         """
-        def remote_function(channel, pathname, contents):
+        self.upload_files([(pathname, StringIO.StringIO(contents))])
+
+    def upload_files(self, files):
+        """
+        Create or update files on the remote file system using a single
+        execnet_ channel. The contents of each file are streamed in chunks of
+        :py:data:`UPLOAD_CHUNK_SIZE` bytes so that large files don't have to
+        fit in memory. Files whose remote contents are identical (based on
+        their SHA1 hash) are skipped. Remote files are replaced atomically by
+        writing to a temporary file and renaming it into place.
+
+        :param files: An iterable of tuples with two values each: The absolute
+                      pathname on the remote system and a (seekable) file
+                      like object with the contents of the file.
+        :returns: A list with the remote pathnames of the files that were
+                  written (the files that were unchanged are not included).
+        """
+        self.flush_packages()
+        def remote_function(channel):
             """
-            Pure function that's executed remotely to create/update the file.
+            Pure function that's executed remotely to create/update the files.
             """
-            import os.path
-            directory = os.path.dirname(pathname)
-            if not os.path.isdir(directory):
-                os.makedirs(directory)
-            handle = open(pathname, 'w')
-            handle.write(contents)
-            bytes_written = handle.tell()
-            handle.close()
-            channel.send(bytes_written)
-        channel = self.gateway.remote_exec(remote_function, pathname=pathname, contents=contents)
-        bytes_written = channel.receive()
-        if len(contents) != bytes_written:
-            msg = "Remote side reported %i bytes written, but local side expected %i bytes!"
-            raise Exception, msg % (bytes_written, len(contents))
+            import hashlib
+            import os
+            import tempfile
+            umask = os.umask(0)
+            os.umask(umask)
+            for pathname, checksum in channel:
+                mode = 0666 & ~umask
+                if os.path.isfile(pathname):
+                    mode = os.stat(pathname).st_mode & 07777
+                    context = hashlib.sha1()
+                    handle = open(pathname, 'rb')
+                    while True:
+                        chunk = handle.read(1024 * 64)
+                        if not chunk:
+                            break
+                        context.update(chunk)
+                    handle.close()
+                    if context.hexdigest() == checksum:
+                        channel.send(('unchanged', 0))
+                        continue
+                channel.send(('send', 0))
+                directory = os.path.dirname(pathname)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                fd, temporary_file = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(pathname))
+                context = hashlib.sha1()
+                handle = os.fdopen(fd, 'wb')
+                for chunk in iter(channel.receive, ''):
+                    handle.write(chunk)
+                    context.update(chunk)
+                bytes_written = handle.tell()
+                handle.close()
+                if context.hexdigest() != checksum:
+                    os.unlink(temporary_file)
+                    channel.send(('corrupted', bytes_written))
+                else:
+                    os.chmod(temporary_file, mode)
+                    os.rename(temporary_file, pathname)
+                    channel.send(('written', bytes_written))
+        upload_timer = Timer()
+        written = []
+        channel = self.gateway.remote_exec(remote_function)
+        try:
+            for pathname, handle in files:
+                context = hashlib.sha1()
+                for chunk in iter(lambda: handle.read(UPLOAD_CHUNK_SIZE), ''):
+                    context.update(chunk)
+                handle.seek(0)
+                channel.send((pathname, context.hexdigest()))
+                status, bytes_written = channel.receive()
+                if status == 'unchanged':
+                    self.logger.debug("%s: File %s is unchanged.", self.ssh_alias, pathname)
+                    continue
+                for chunk in iter(lambda: handle.read(UPLOAD_CHUNK_SIZE), ''):
+                    channel.send(chunk)
+                channel.send('')
+                status, bytes_written = channel.receive()
+                if status != 'written':
+                    msg = "Upload of %s to %s was corrupted! (checksum mismatch after %i bytes)"
+                    raise Exception, msg % (pathname, self.ssh_alias, bytes_written)
+                self.logger.verbose("%s: Uploaded %s (%s).", self.ssh_alias, pathname, format_size(bytes_written))
+                written.append(pathname)
+        finally:
+            channel.close()
+            channel.waitclose()
+        self.logger.debug("%s: Uploaded %i file(s) in %s.", self.ssh_alias, len(written), upload_timer)
+        return written
 
     def install_packages(self, *packages):
         """
-        Install the given system packages on the remote system.
+        Install the given system packages on the remote system. Packages that
+        are already installed are skipped (see
+        :py:func:`Connection.get_installed_packages()`). Inside a
+        :py:func:`batch()` the packages are installed when the batch ends.
 
         :param packages: The names of one or more packages to install (strings).
         """
-        self.execute('apt-get', 'install', '-q', '-y', *packages)
+        with self.connection.package_lock:
+            installed = self.connection.get_installed_packages()
+            for package in packages:
+                if package in installed:
+                    self.logger.debug("%s: Package %s is already installed.", self.ssh_alias, package)
+                elif package not in self.pending_packages:
+                    self.pending_packages.append(package)
+            if self.batch_depth == 0:
+                self.flush_packages()
+
+    def flush_packages(self):
+        """
+        Install the packages requested by :py:func:`install_packages()` that
+        haven't been installed yet using a single ``apt-get install`` command.
+        Package installation is serialized per host because apt-get_ doesn't
+        support concurrent use.
+
+        .. _apt-get: http://manpages.ubuntu.com/manpages/precise/man8/apt-get.8.html
+        """
+        with self.connection.package_lock:
+            packages, self.pending_packages = self.pending_packages, []
+            if packages:
+                try:
+                    self.execute('apt-get', 'install', '-q', '-y', *packages)
+                except Exception:
+                    self.connection.invalidate_packages()
+                    raise
+                self.connection.mark_installed(packages)
+
+    def apply(self, tasks, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Apply a graph of tasks to the remote system (see :py:mod:`redock.tasks`).
+
+        :param tasks: An iterable of :py:class:`redock.tasks.Task` objects.
+        :param concurrency: The maximum number of tasks to apply at the same time.
+        :returns: The dictionary returned by :py:func:`redock.tasks.TaskEngine.run()`.
+        """
+        # The tasks module builds on this module so it's imported on demand.
+        from redock.tasks import TaskEngine
+        return TaskEngine(self, tasks, concurrency=concurrency).run()
 
     def update_system_packages(self):
         """
         Perform a full upgrade of all system packages on the remote system.
         """
         self.execute('apt-get', 'dist-upgrade', '-q', '-y', '--no-install-recommends')
+        self.connection.invalidate_packages()
 
     def execute(self, *command, **kw):
         """
-        Execute a remote command over SSH so that the output of the remote
-        command (the standard output and standard error streams) is immediately
-        visible on the local terminal. If no standard input is given, this
-        allocates a pseudo-tty_ (using ``ssh -t``) which means the operator can
-        interact with the remote system should it prompt for input.
+        Execute a remote command so that the output of the remote command (the
+        standard output and standard error streams) is immediately visible on
+        the local terminal. If no standard input is given and the local
+        standard input is a terminal, this allocates a pseudo-tty_ (using ``ssh
+        -t``) which means the operator can interact with the remote system
+        should it prompt for input. Otherwise the command is executed through
+        the existing execnet_ gateway (if any) to avoid starting an ``ssh``
+        process.
+
+        The arguments are joined with spaces and the result is interpreted by
+        the remote shell (on both code paths, using ``sh -c``), just like the
+        arguments of ``ssh``. This means shell syntax works (e.g.
+        ``execute('cd /srv && make')``) but arguments that contain spaces or
+        shell metacharacters have to be quoted by the caller (e.g. using
+        :py:func:`pipes.quote()`).
 
         Raises :py:exc:`ExternalCommandFailed` if the remote command ends with a
         nonzero exit code.
@@ -136,30 +306,56 @@ class Bootstrap(object):
         :param input: The standard input for the command (expected to be a
                       string). This is an optional keyword argument. If this
                       argument is given, no pseudo-tty_ will be allocated.
+        :param interactive: ``False`` to never allocate a pseudo-tty_ (the
+                            default is given to the constructor).
 
         .. _pseudo-tty: http://en.wikipedia.org/wiki/Pseudo_terminal
         """
+        if self.pending_packages:
+            self.flush_packages()
         has_input = kw.get('input') is not None
-        ssh_command = ['ssh']
-        if not has_input:
-            ssh_command.append('-t')
-        ssh_command.append(self.ssh_alias)
-        ssh_command.extend(command)
-        self.logger.info("%s: Executing command %s", self.ssh_alias, ' '.join(ssh_command))
-        options = dict()
-        if has_input:
-            options['stdin'] = subprocess.PIPE
-        process = subprocess.Popen(ssh_command, **options)
-        process.communicate(kw.get('input'))
-        self.logger.debug("%s: Command exited with status %i.", self.ssh_alias, process.returncode)
-        if process.returncode != 0:
+        interactive = kw.get('interactive', self.interactive)
+        if interactive is None:
+            interactive = not has_input and sys.stdin.isatty()
+        shell_command = ' '.join(command)
+        if self.connection.has_gateway and not interactive:
+            self.logger.info("%s: Executing command %s", self.ssh_alias, shell_command)
+            returncode = self.connection.execute('sh', '-c', shell_command, input=kw.get('input'))
+        else:
+            ssh_command = self.connection.ssh_command('sh', '-c', shell_command, tty=interactive)
+            self.logger.info("%s: Executing command %s", self.ssh_alias, ' '.join(ssh_command))
+            options = dict()
+            if has_input:
+                options['stdin'] = subprocess.PIPE
+            process = subprocess.Popen(ssh_command, **options)
+            process.communicate(kw.get('input'))
+            returncode = process.returncode
+        self.logger.debug("%s: Command exited with status %i.", self.ssh_alias, returncode)
+        if returncode != 0:
             msg = "Remote command on %s failed with exit status %i! (command: %s)"
-            raise ExternalCommandFailed, msg % (self.ssh_alias, process.returncode, ' '.join(command))
+            raise ExternalCommandFailed, msg % (self.ssh_alias, returncode, shell_command)
 
-    def rsync(self, local_directory, remote_directory, cvs_exclude=True, delete=True):
+    def rsync(self, local_directory, remote_directory, cvs_exclude=True, delete=True, force=False):
         """
         Copy a directory on the host to the container using rsync over SSH.
 
+        A manifest of the local directory (the path, size, modification time
+        and inode of each file) is saved in the runtime configuration after
+        each successful upload (see :py:func:`create_manifest()`). On the
+        next upload to the same remote system and directory:
+
+        - If nothing changed, rsync isn't run at all.
+        - If files were added or changed, rsync only considers those files
+          (using ``--files-from``) instead of scanning the whole tree.
+        - If files were deleted (and `delete` is ``True``) the whole tree is
+          synchronized.
+
+        The manifest is associated with the identity of the remote system
+        (see :py:func:`get_remote_identity()`) so that a container that
+        replaced an earlier container with the same SSH alias gets a full
+        upload. Other changes made on the remote side are not detected; use
+        `force` to synchronize the whole tree regardless of the manifest.
+
         Raises :py:exc:`ExternalCommandFailed` if the remote command ends with a
         nonzero exit code.
 
@@ -167,31 +363,616 @@ class Bootstrap(object):
         :param remote_directory: The pathname of the target directory in the container.
         :param cvs_exclude: Exclude version control files (enabled by default).
         :param delete: Delete remote files that don't exist locally (enabled by default).
+        :param force: ``True`` to ignore the manifest of the previous upload.
         """
         rsync_timer = Timer()
-        self.install_packages('rsync')
         def normalize(directory):
             """ Make sure a directory path ends with a trailing slash. """
             return "%s/" % directory.rstrip('/')
         location = "%s:%s" % (self.ssh_alias, normalize(remote_directory))
+        manifest_key = (self.ssh_alias, self.get_remote_identity(), remote_directory)
+        options = dict(local_directory=os.path.abspath(local_directory),
+                       cvs_exclude=cvs_exclude, delete=delete)
+        manifest = create_manifest(local_directory)
+        previous = None if force else self.config.get('rsync', manifest_key)
+        changed_files = None
+        if previous and previous['options'] == options:
+            changed_files, deleted_files = compare_manifests(previous['files'], manifest)
+            if not (changed_files or deleted_files):
+                self.logger.verbose("%s: Nothing changed in %s since the last upload, skipping rsync.",
+                                    self.ssh_alias, local_directory)
+                return
+            if deleted_files and delete:
+                self.logger.debug("%s: Files were deleted from %s, synchronizing the whole tree.",
+                                  self.ssh_alias, local_directory)
+                changed_files = None
+            else:
+                self.logger.debug("%s: Uploading %i changed files from %s.",
+                                  self.ssh_alias, len(changed_files), local_directory)
+        self.install_packages('rsync')
+        self.flush_packages()
         self.logger.debug("Uploading %s to %s ..", local_directory, location)
         command = ['rsync', '-a']
+        command.extend(['-e', quote_command_line(['ssh'] + self.connection.ssh_options)])
         command.extend(['--rsync-path', 'mkdir -p %s && rsync' % pipes.quote(remote_directory)])
         if cvs_exclude:
             command.append('--cvs-exclude')
             command.extend(['--exclude', '.hgignore'])
         if delete:
             command.append('--delete')
-        command.append(normalize(local_directory))
-        command.append(location)
-        self.logger.debug("Generated rsync command: %s", quote_command_line(command))
-        exit_code = os.spawnvp(os.P_WAIT, command[0], command)
+        with tempfile.NamedTemporaryFile(prefix='redock-rsync-') as files_from:
+            if changed_files is not None:
+                files_from.write(''.join('%s\n' % f for f in changed_files))
+                files_from.flush()
+                command.append('--files-from=%s' % files_from.name)
+            command.append(normalize(local_directory))
+            command.append(location)
+            self.logger.debug("Generated rsync command: %s", quote_command_line(command))
+            exit_code = os.spawnvp(os.P_WAIT, command[0], command)
         if exit_code == 0:
             self.logger.debug("Finished upload using rsync in %s.", rsync_timer)
         self.logger.debug("rsync exited with status %d.", exit_code)
         if exit_code != 0:
             msg = "Failed to upload directory %s to %s, rsync exited with nonzero status %d! (command: %s)"
             raise ExternalCommandFailed, msg % (local_directory, location, exit_code, quote_command_line(command))
+        self.config.set('rsync', manifest_key, dict(options=options, files=manifest))
+
+    def get_remote_identity(self):
+        """
+        Identify the currently running remote system. The identity combines
+        the boot id of the kernel with the start time of process 1. Docker
+        containers share the kernel of the host system but process 1 is the
+        container's own init process, so containers that replace each other
+        (e.g. after ``redock kill`` and ``redock start``) get different
+        identities.
+
+        :returns: A string.
+        """
+        def remote_function(channel):
+            """
+            Pure function that's executed remotely to identify the system.
+            """
+            boot_id = open('/proc/sys/kernel/random/boot_id').read().strip()
+            # The process name can contain spaces, the fields after it can't.
+            fields = open('/proc/1/stat').read().rsplit(')', 1)[1].split()
+            # The start time is field 22 (see proc(5)), the state is field 3.
+            channel.send('%s-%s' % (boot_id, fields[22 - 3]))
+        return self.gateway.remote_exec(remote_function).receive()
+
+class Fleet(object):
+
+    """
+    Applies the same :py:class:`Bootstrap` operations to a group of hosts. The
+    hosts are configured concurrently using a bounded
+    :py:class:`redock.parallel.WorkerPool`:
+
+    >>> fleet = Fleet(['redock:web1', 'redock:web2', 'redock:db'], concurrency=10)
+    >>> fleet.install_packages('git', 'rsync')
+    >>> fleet.rsync('/home/peter/project', '/srv/project')
+
+    Each operation returns a :py:class:`FleetResult` with the result and timing
+    of each host. When ``fail_fast`` is ``True`` the first failure cancels the
+    hosts that haven't started yet and :py:exc:`FleetError` is raised,
+    otherwise all hosts are processed and the failures are reported in the
+    :py:class:`FleetResult`.
+    """
+
+    def __init__(self, ssh_aliases, concurrency=DEFAULT_CONCURRENCY, fail_fast=False):
+        """
+        Initialize a :py:class:`Fleet`.
+
+        :param ssh_aliases: The aliases of the remote hosts in the SSH client
+                            configuration (an iterable of strings).
+        :param concurrency: The maximum number of hosts to configure at the
+                            same time.
+        :param fail_fast: ``True`` to stop at the first failure, ``False`` to
+                          continue with the other hosts.
+        """
+        self.logger = logger
+        self.ssh_aliases = []
+        for ssh_alias in ssh_aliases:
+            if ssh_alias not in self.ssh_aliases:
+                self.ssh_aliases.append(ssh_alias)
+        self.concurrency = concurrency
+        self.fail_fast = fail_fast
+        self.hosts = {}
+
+    def execute(self, *command, **kw):
+        """
+        Execute a remote command on all hosts (see :py:func:`Bootstrap.execute()`).
+        """
+        return self.run('execute', *command, **kw)
+
+    def apply(self, tasks):
+        """
+        Apply a graph of tasks to all hosts (see :py:func:`Bootstrap.apply()`).
+        """
+        return self.run('apply', tasks)
+
+    def install_packages(self, *packages):
+        """
+        Install system packages on all hosts (see :py:func:`Bootstrap.install_packages()`).
+        """
+        return self.run('install_packages', *packages)
+
+    def update_system_packages(self):
+        """
+        Upgrade the system packages on all hosts (see :py:func:`Bootstrap.update_system_packages()`).
+        """
+        return self.run('update_system_packages')
+
+    def upload_file(self, pathname, contents):
+        """
+        Create a file on all hosts (see :py:func:`Bootstrap.upload_file()`).
+        """
+        return self.run('upload_file', pathname, contents)
+
+    def rsync(self, local_directory, remote_directory, **kw):
+        """
+        Copy a directory to all hosts (see :py:func:`Bootstrap.rsync()`).
+        """
+        return self.run('rsync', local_directory, remote_directory, **kw)
+
+    def run(self, operation, *args, **kw):
+        """
+        Call a method of :py:class:`Bootstrap` for each of the hosts.
+
+        Raises :py:exc:`FleetError` when ``fail_fast`` is ``True`` and the
+        operation failed on any of the hosts.
+
+        :param operation: The name of the method (a string).
+        :param args: The positional arguments for the method.
+        :param kw: The keyword arguments for the method.
+        :returns: A :py:class:`FleetResult` object.
+        """
+        timer = Timer()
+        self.logger.info("Running %s on %i hosts ..", operation, len(self.ssh_aliases))
+        with WorkerPool(concurrency=self.concurrency) as pool:
+            def check_failure(job):
+                if self.fail_fast and not job.succeeded and not job.cancelled:
+                    pool.cancel()
+            jobs = []
+            for ssh_alias in self.ssh_aliases:
+                job = pool.submit(self.call, ssh_alias, operation, *args, **kw)
+                job.add_callback(check_failure)
+                jobs.append((ssh_alias, job))
+        result = FleetResult(operation, [HostResult(a, j) for a, j in jobs], timer.elapsed_time)
+        for host in result.failed:
+            self.logger.error("%s: %s failed! (%s)", host.ssh_alias, operation, host.exception)
+        self.logger.info("%s", result)
+        if self.fail_fast and result.failed:
+            raise FleetError(result)
+        return result
+
+    def call(self, ssh_alias, operation, *args, **kw):
+        """
+        Call a method of :py:class:`Bootstrap` for a single host (called by
+        the worker threads started by :py:func:`run()`).
+
+        :param ssh_alias: The alias of the remote host (a string).
+        :param operation: The name of the method (a string).
+        :param args: The positional arguments for the method.
+        :param kw: The keyword arguments for the method.
+        :returns: The return value of the method.
+        """
+        return getattr(self.get_bootstrap(ssh_alias), operation)(*args, **kw)
+
+    def get_bootstrap(self, ssh_alias):
+        """
+        Get the :py:class:`Bootstrap` object for a host (creating it if needed).
+
+        :param ssh_alias: The alias of the remote host (a string).
+        :returns: A :py:class:`Bootstrap` object.
+        """
+        # Each host is only used by one worker thread at a time. Concurrent
+        # commands can't share the terminal so pseudo-ttys are disabled.
+        if ssh_alias not in self.hosts:
+            self.hosts[ssh_alias] = Bootstrap(ssh_alias, interactive=False)
+        return self.hosts[ssh_alias]
+
+class FleetResult(object):
+
+    """
+    The aggregated results of an operation performed by :py:class:`Fleet`.
+    """
+
+    def __init__(self, operation, hosts, elapsed_time):
+        """
+        Initialize a :py:class:`FleetResult`.
+
+        :param operation: The name of the operation (a string).
+        :param hosts: A list of :py:class:`HostResult` objects.
+        :param elapsed_time: The total time of the operation (in seconds).
+        """
+        self.operation = operation
+        self.hosts = hosts
+        self.elapsed_time = elapsed_time
+
+    @property
+    def succeeded(self):
+        """
+        The :py:class:`HostResult` objects of the hosts where the operation succeeded.
+        """
+        return [h for h in self.hosts if h.succeeded]
+
+    @property
+    def failed(self):
+        """
+        The :py:class:`HostResult` objects of the hosts where the operation failed.
+        """
+        return [h for h in self.hosts if not (h.succeeded or h.cancelled)]
+
+    @property
+    def cancelled(self):
+        """
+        The :py:class:`HostResult` objects of the hosts that were skipped
+        because another host failed (only in fail-fast mode).
+        """
+        return [h for h in self.hosts if h.cancelled]
+
+    def __getitem__(self, ssh_alias):
+        """
+        Get the :py:class:`HostResult` of a host.
+
+        :param ssh_alias: The alias of the remote host (a string).
+        """
+        for host in self.hosts:
+            if host.ssh_alias == ssh_alias:
+                return host
+        raise KeyError, ssh_alias
+
+    def __str__(self):
+        """
+        Summarize the results in a human readable string.
+        """
+        summary = "Finished %s on %i hosts in %s: %i succeeded, %i failed"
+        summary %= (self.operation, len(self.hosts), format_timespan(self.elapsed_time),
+                    len(self.succeeded), len(self.failed))
+        if self.cancelled:
+            summary += ", %i cancelled" % len(self.cancelled)
+        return summary + "."
+
+class HostResult(object):
+
+    """
+    The result of an operation performed by :py:class:`Fleet` on a single host.
+    """
+
+    def __init__(self, ssh_alias, job):
+        """
+        Initialize a :py:class:`HostResult`.
+
+        :param ssh_alias: The alias of the remote host (a string).
+        :param job: The finished :py:class:`redock.parallel.Job`.
+        """
+        self.ssh_alias = ssh_alias
+        self.result = job.result
+        self.exception = job.exception
+        self.exc_info = job.exc_info
+        self.cancelled = job.cancelled
+        self.succeeded = job.succeeded
+        self.elapsed_time = job.elapsed_time
+
+    def __repr__(self):
+        """
+        Get a human readable representation of the result.
+        """
+        status = 'succeeded' if self.succeeded else ('cancelled' if self.cancelled else 'failed')
+        return "HostResult(ssh_alias=%r, status=%r, elapsed_time=%r)" % (self.ssh_alias, status, self.elapsed_time)
+
+class ConnectionPool(object):
+
+    """
+    Pool of :py:class:`Connection` objects keyed by SSH alias. All
+    :py:class:`Bootstrap` objects in the current process share the pool
+    :py:data:`connection_pool`, so configuring a host with several
+    :py:class:`Bootstrap` objects (or from several threads) still uses a
+    single SSH connection.
+    """
+
+    def __init__(self):
+        """
+        Initialize an empty :py:class:`ConnectionPool`.
+        """
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, ssh_alias):
+        """
+        Get the connection to a remote host (creating it if needed).
+
+        :param ssh_alias: Alias of remote host in SSH client configuration.
+        :returns: A :py:class:`Connection` object.
+        """
+        with self.lock:
+            if ssh_alias not in self.connections:
+                self.connections[ssh_alias] = Connection(ssh_alias)
+            return self.connections[ssh_alias]
+
+    def close_all(self):
+        """
+        Close all connections in the pool.
+        """
+        with self.lock:
+            connections = self.connections.values()
+            self.connections = {}
+        for connection in connections:
+            connection.close()
+
+class Connection(object):
+
+    """
+    A connection to a remote host that consists of an OpenSSH_ master
+    connection (see ``ControlMaster`` in ssh_config_) and an execnet_ gateway
+    that's created on demand. Every ``ssh`` process started for the host
+    (including the ones started by execnet_ and rsync) multiplexes its
+    session over the master connection, so only the first connection pays for
+    the SSH handshake.
+
+    .. _OpenSSH: http://www.openssh.org/
+    .. _ssh_config: http://manpages.ubuntu.com/manpages/precise/man5/ssh_config.5.html
+    """
+
+    def __init__(self, ssh_alias):
+        """
+        Initialize a :py:class:`Connection`.
+
+        :param ssh_alias: Alias of remote host in SSH client configuration.
+        """
+        self.logger = logger
+        self.ssh_alias = ssh_alias
+        self.lock = threading.Lock()
+        self.cached_gateway = None
+        self.cached_packages = None
+        self.package_lock = threading.RLock()
+
+    @property
+    def control_path(self):
+        """
+        The pathname of the UNIX socket of the SSH master connection.
+        """
+        return os.path.join(REDOCK_CONFIG_DIR, 'ssh-%s.sock' % slug(self.ssh_alias))
+
+    @property
+    def ssh_options(self):
+        """
+        The command line options that make ``ssh`` use the master connection
+        (a list of strings).
+        """
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % self.control_path,
+                '-o', 'ControlPersist=%i' % SSH_CONTROL_PERSIST]
+
+    @property
+    def ssh_config_file(self):
+        """
+        The pathname of the SSH client configuration used by the execnet_
+        gateway (see :py:func:`write_ssh_config()`).
+        """
+        return os.path.join(REDOCK_CONFIG_DIR, 'ssh-%s.config' % slug(self.ssh_alias))
+
+    def write_ssh_config(self):
+        """
+        Generate the SSH client configuration used by the execnet_ gateway.
+        execnet 1.1 passes the ``ssh=...`` part of a gateway specification to
+        ``ssh`` as a single argument, so the options that make ``ssh`` use
+        the master connection (see :py:attr:`ssh_options`) can't be given on
+        the command line. Instead they're written to a configuration file
+        (which is passed to ``ssh -F``) followed by the contents of
+        ``~/.ssh/config`` (because ``ssh -F`` ignores ``~/.ssh/config``).
+        Options from the first matching ``Host`` block take precedence.
+
+        :returns: The pathname of the generated configuration file.
+        """
+        create_configuration_directory()
+        lines = ['# Generated by Redock, edits will be lost.',
+                 'Host %s' % self.ssh_alias,
+                 '  ControlMaster auto',
+                 '  ControlPath %s' % self.control_path,
+                 '  ControlPersist %i' % SSH_CONTROL_PERSIST,
+                 '']
+        if os.path.isfile(SSH_CONFIG_FILE):
+            with open(SSH_CONFIG_FILE) as handle:
+                lines.append(handle.read())
+        temporary_file = '%s.%i.tmp' % (self.ssh_config_file, os.getpid())
+        with open(temporary_file, 'w') as handle:
+            handle.write('\n'.join(lines))
+        os.rename(temporary_file, self.ssh_config_file)
+        return self.ssh_config_file
+
+    @property
+    def gateway_spec(self):
+        """
+        The execnet_ specification of the gateway to the remote host (a
+        string). Generates the SSH client configuration as a side effect (see
+        :py:func:`write_ssh_config()`).
+        """
+        # TODO Support sudo using makegateway('ssh=%s//python=sudo python')
+        return 'ssh=%s//ssh_config=%s' % (self.ssh_alias, self.write_ssh_config())
+
+    def ssh_command(self, *command, **kw):
+        """
+        Generate an ``ssh`` command line that uses the master connection.
+
+        :param command: The remote command and its arguments (strings).
+        :param tty: ``True`` to allocate a pseudo-tty (optional).
+        :returns: A list of strings.
+        """
+        ssh_command = ['ssh'] + self.ssh_options
+        if kw.get('tty'):
+            ssh_command.append('-t')
+        ssh_command.append(self.ssh_alias)
+        if command:
+            # The remote shell parses the command, so quote the arguments.
+            ssh_command.append(quote_command_line(command))
+        return ssh_command
+
+    @property
+    def gateway(self):
+        """
+        The execnet_ gateway to the remote host (created on demand).
+        """
+        with self.lock:
+            if self.cached_gateway is None:
+                self.logger.info("%s: Initializing execnet over SSH connection ..", self.ssh_alias)
+                self.cached_gateway = makegateway(self.gateway_spec)
+            return self.cached_gateway
+
+    @property
+    def has_gateway(self):
+        """
+        ``True`` if the execnet_ gateway has been created, ``False`` otherwise.
+        """
+        return self.cached_gateway is not None
+
+    def get_installed_packages(self):
+        """
+        Get the system packages installed on the remote host. The first call
+        queries dpkg_ through the execnet_ gateway, after that the result is
+        cached and kept up to date by :py:class:`Bootstrap`. As long as there's
+        no gateway an empty set is returned.
+
+        :returns: A :py:class:`set` of package names (strings).
+
+        .. _dpkg: http://manpages.ubuntu.com/manpages/precise/man1/dpkg.1.html
+        """
+        if self.cached_packages is None:
+            if not self.has_gateway:
+                return set()
+            def remote_function(channel):
+                """
+                Pure function that's executed remotely to query dpkg.
+                """
+                import subprocess
+                dpkg_query = subprocess.Popen(['dpkg-query', '-W', '-f=${Package} ${Status}\n'],
+                                              stdout=subprocess.PIPE)
+                channel.send(dpkg_query.communicate()[0])
+            timer = Timer()
+            output = self.gateway.remote_exec(remote_function).receive()
+            packages = set()
+            for line in output.splitlines():
+                tokens = line.split()
+                if tokens[-1:] == ['installed']:
+                    packages.add(tokens[0])
+            self.logger.debug("%s: Found %i installed packages in %s.", self.ssh_alias, len(packages), timer)
+            self.cached_packages = packages
+        return self.cached_packages
+
+    def mark_installed(self, packages):
+        """
+        Record that packages were installed on the remote host.
+
+        :param packages: An iterable of package names (strings).
+        """
+        if self.cached_packages is not None:
+            self.cached_packages.update(packages)
+
+    def invalidate_packages(self):
+        """
+        Forget the cached package state (it will be queried again when
+        needed).
+        """
+        self.cached_packages = None
+
+    def execute(self, *command, **kw):
+        """
+        Execute a remote command through the execnet_ gateway. The output of
+        the remote command (the standard output and standard error streams)
+        is copied to the standard output stream of the local process.
+
+        :param command: A list with the remote command and its arguments.
+        :param input: The standard input for the command (a string, optional).
+        :returns: The exit status of the remote command (an integer).
+        """
+        def remote_function(channel, command, input):
+            """
+            Pure function that's executed remotely to run the command.
+            """
+            import os
+            import subprocess
+            process = subprocess.Popen(command,
+                                       stdin=subprocess.PIPE if input is not None else open(os.devnull),
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            if input is not None:
+                process.stdin.write(input)
+                process.stdin.close()
+            for line in iter(process.stdout.readline, ''):
+                channel.send(line)
+            channel.send(process.wait())
+        channel = self.gateway.remote_exec(remote_function, command=list(command), input=kw.get('input'))
+        for item in channel:
+            if isinstance(item, int):
+                return item
+            sys.stdout.write(item)
+            sys.stdout.flush()
+
+    def close(self):
+        """
+        Close the execnet_ gateway and the SSH master connection.
+        """
+        with self.lock:
+            if self.cached_gateway is not None:
+                self.logger.debug("%s: Closing execnet gateway ..", self.ssh_alias)
+                self.cached_gateway.exit()
+                self.cached_gateway = None
+        if os.path.exists(self.control_path):
+            self.logger.debug("%s: Closing SSH master connection ..", self.ssh_alias)
+            with open(os.devnull, 'w') as null:
+                subprocess.call(['ssh'] + self.ssh_options + ['-O', 'exit', self.ssh_alias],
+                                stdout=null, stderr=null)
+
+# The connections shared by all Bootstrap objects in the current process.
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close_all)
+
+def create_manifest(directory):
+    """
+    Create a manifest of the files and directories in a directory tree (used
+    by :py:func:`Bootstrap.rsync()` to detect changes).
+
+    :param directory: The pathname of the directory (a string).
+    :returns: A dictionary that maps relative pathnames to lists with the
+              size, modification time and inode number of each file.
+    """
+    manifest = {}
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            pathname = os.path.join(root, name)
+            stat = os.lstat(pathname)
+            manifest[os.path.relpath(pathname, directory)] = [stat.st_size, stat.st_mtime, stat.st_ino]
+    return manifest
+
+def compare_manifests(old, new):
+    """
+    Compare two manifests created by :py:func:`create_manifest()`.
+
+    :param old: The previous manifest (a dictionary).
+    :param new: The current manifest (a dictionary).
+    :returns: A tuple with two sorted lists of relative pathnames: The files
+              that were added or changed and the files that were deleted.
+    """
+    changed = sorted(p for p, v in new.iteritems() if old.get(p) != v)
+    deleted = sorted(p for p in old if p not in new)
+    return changed, deleted
+
+class FleetError(Exception):
+
+    """
+    Raised by :py:class:`Fleet` in fail-fast mode when an operation failed on
+    one or more hosts. The :py:class:`FleetResult` is available as the
+    :py:attr:`result` attribute.
+    """
+
+    def __init__(self, result):
+        """
+        Initialize a :py:exc:`FleetError`.
+
+        :param result: A :py:class:`FleetResult` object.
+        """
+        failed = ', '.join(h.ssh_alias for h in result.failed)
+        super(FleetError, self).__init__("%s failed on %s!" % (result.operation, failed))
+        self.result = result
 
 class ExternalCommandFailed(Exception):
     """
@@ -1,7 +1,7 @@
 # Command line interface for Redock, a human friendly wrapper around Docker.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: September 30, 2013
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-redock
 
 # Standard library modules.
@@ -16,12 +16,19 @@ import textwrap
 import coloredlogs
 from humanfriendly import Timer
 
-# Modules included in our package.
-from redock.api import Container, Image
+# Modules included in our package. Note that redock.api is imported on demand
+# because it pulls in heavy dependencies like docker-py (see test_import_time()
+# in redock.tests).
+from redock.daemon import DaemonClient
+from redock.parallel import DEFAULT_CONCURRENCY, WorkerPool
+from redock.utils import ssh_config
 
 # Initialize a logger for this module.
 logger = logging.getLogger(__name__)
 
+# Actions that operate on the base image instead of containers.
+BASE_IMAGE_ACTIONS = ('export-base', 'import-base')
+
 def main():
     """
     Command line interface for the ``redock`` program.
@@ -33,14 +40,34 @@ def main():
         # Command line option defaults.
         hostname = None
         message = None
+        concurrency = None
+        pool_size = 0
+        snapshot = None
+        dry_run = False
         # Parse the command line options.
-        options, arguments = getopt.getopt(sys.argv[1:], 'b:n:m:vh',
-                                          ['hostname=', 'message=', 'verbose', 'help'])
+        options, arguments = getopt.getopt(sys.argv[1:], 'b:n:m:j:p:s:vh',
+                                          ['hostname=', 'message=', 'jobs=',
+                                           'pool=', 'snapshot=', 'dry-run',
+                                           'verbose', 'help'])
         for option, value in options:
             if option in ('-n', '--hostname'):
                 hostname = value
             elif option in ('-m', '--message'):
                 message = value
+            elif option in ('-j', '--jobs'):
+                concurrency = int(value)
+                if concurrency < 1:
+                    msg = "The number of jobs should be a positive integer! (got %r)"
+                    raise Exception, msg % value
+            elif option in ('-p', '--pool'):
+                pool_size = int(value)
+                if pool_size < 0:
+                    msg = "The size of the warm pool can't be negative! (got %r)"
+                    raise Exception, msg % value
+            elif option in ('-s', '--snapshot'):
+                snapshot = value
+            elif option == '--dry-run':
+                dry_run = True
             elif option in ('-v', '--verbose'):
                 coloredlogs.increase_verbosity()
             elif option in ('-h', '--help'):
@@ -50,48 +77,131 @@ def main():
                 # Programming error...
                 assert False, "Unhandled option!"
         # Handle the positional arguments.
-        if len(arguments) < 2:
+        if not arguments:
             usage()
             return
-        supported_actions = ('start', 'commit', 'kill', 'delete')
+        supported_actions = ('start', 'commit', 'kill', 'delete', 'fill',
+                             'snapshot', 'restore', 'gc') + BASE_IMAGE_ACTIONS
         action = arguments.pop(0)
         if action not in supported_actions:
             msg = "Action not supported: %r (supported actions are: %s)"
             raise Exception, msg % (action, ', '.join(supported_actions))
+        if action in BASE_IMAGE_ACTIONS:
+            if len(arguments) > 1:
+                msg = "The %s action takes at most one argument! (got %i)"
+                raise Exception, msg % (action, len(arguments))
+        elif action == 'gc':
+            if arguments:
+                msg = "The gc action doesn't take any arguments! (got %i)"
+                raise Exception, msg % len(arguments)
+        elif not arguments:
+            usage()
+            return
     except Exception, e:
         logger.error("Failed to parse command line arguments!")
         logger.exception(e)
         usage()
         sys.exit(1)
-    # Start the container and connect to it over SSH.
-    try:
-        for image_name in arguments:
-            container = Container(image=Image.coerce(image_name),
-                                  hostname=hostname)
-            if action == 'start':
-                container.start()
-                if len(arguments) == 1 and all(os.isatty(n) for n in range(3)):
-                    ssh_timer = Timer()
-                    logger.info("Detected interactive terminal, connecting to container ..")
-                    ssh_client = subprocess.Popen(['ssh', container.ssh_alias])
-                    ssh_client.wait()
-                    if ssh_client.returncode == 0:
-                        logger.info("SSH client exited after %s.", ssh_timer)
-                    else:
-                        logger.warn("SSH client exited with status %i after %s.",
-                                    ssh_client.returncode, ssh_timer)
-            elif action == 'commit':
-                container.commit(message=message)
-            elif action == 'kill':
-                container.kill()
-            elif action == 'delete':
-                container.delete()
-            else:
-                # Programming error...
-                assert False, "Unhandled action!"
-    except Exception, e:
-        logger.exception(e)
+    if action in BASE_IMAGE_ACTIONS:
+        try:
+            manage_base_image(action, arguments[0] if arguments else None)
+        except Exception, e:
+            logger.error("Failed to %s base image!", action.split('-')[0])
+            logger.exception(e)
+            sys.exit(1)
+        return
+    if action == 'gc':
+        from redock.garbage import collect_garbage
+        try:
+            report = collect_garbage(concurrency=concurrency or DEFAULT_CONCURRENCY, dry_run=dry_run)
+        except Exception, e:
+            logger.error("Failed to collect garbage!")
+            logger.exception(e)
+            sys.exit(1)
+        if report.failures:
+            sys.exit(1)
+        return
+    # Perform the requested action on each of the containers.
+    interactive = (action == 'start' and len(arguments) == 1
+                   and all(os.isatty(n) for n in range(3)))
+    # Update ~/.ssh/config once, after all containers have been processed.
+    with ssh_config.batch(), WorkerPool(concurrency=concurrency or 1) as pool:
+        jobs = [(image_name, pool.submit(perform_action, action, image_name,
+                                         hostname=hostname, message=message,
+                                         pool_size=pool_size, snapshot=snapshot))
+                for image_name in arguments]
+    # Report the results per container.
+    failed = []
+    for image_name, job in jobs:
+        if job.succeeded:
+            if len(jobs) > 1:
+                logger.info("Finished %s action for %s in %s.", action, image_name, job.timer)
+        else:
+            logger.error("Failed to %s %s!", action, image_name, exc_info=job.exc_info)
+            failed.append(image_name)
+    if failed:
+        if len(jobs) > 1:
+            logger.error("%s action failed for %i of %i containers: %s",
+                         action.capitalize(), len(failed), len(jobs), ', '.join(failed))
         sys.exit(1)
+    # Connect to the container over SSH.
+    if interactive:
+        ssh_alias = jobs[0][1].result
+        ssh_timer = Timer()
+        logger.info("Detected interactive terminal, connecting to container ..")
+        ssh_client = subprocess.Popen(['ssh', ssh_alias])
+        ssh_client.wait()
+        if ssh_client.returncode == 0:
+            logger.info("SSH client exited after %s.", ssh_timer)
+        else:
+            logger.warn("SSH client exited with status %i after %s.",
+                        ssh_client.returncode, ssh_timer)
+
+def perform_action(action, image_name, hostname=None, message=None, pool_size=0, snapshot=None):
+    """
+    Perform one of the actions supported by the ``redock`` program on a single
+    container. This is called by the worker threads started by :py:func:`main()`.
+
+    :param action: One of the strings ``start``, ``commit``, ``kill``,
+                   ``delete``, ``fill``, ``snapshot`` or ``restore``.
+    :param image_name: The name of the container's image (a string).
+    :param hostname: The host name to use inside the container (optional).
+    :param message: The commit message (optional).
+    :param pool_size: The size of the warm pool (optional).
+    :param snapshot: The name of the snapshot to create or restore (optional).
+    :returns: The SSH alias of the container (a string).
+
+    If the ``redockd`` program is running the action is performed by the
+    daemon (see :py:mod:`redock.daemon`), otherwise it's performed in the
+    current process.
+    """
+    daemon = DaemonClient()
+    if daemon.is_running():
+        return daemon.perform(action, image_name, hostname=hostname,
+                              message=message, pool_size=pool_size,
+                              snapshot=snapshot)
+    from redock.api import Container, Image
+    container = Container(image=Image.coerce(image_name),
+                          hostname=hostname)
+    container.perform(action, message=message, pool_size=pool_size, snapshot=snapshot)
+    return container.ssh_alias
+
+def manage_base_image(action, pathname=None):
+    """
+    Export or import the base image (see :py:func:`redock.base.export_base_image()`
+    and :py:func:`redock.base.import_base_image()`).
+
+    :param action: One of the strings ``export-base`` or ``import-base``.
+    :param pathname: The directory where the tarball is created (for
+                     ``export-base``) or the pathname of the tarball to
+                     import (for ``import-base``). Optional.
+    """
+    from redock.base import export_base_image, import_base_image
+    from redock.client import get_client
+    if action == 'export-base':
+        export_base_image(get_client(), directory=pathname)
+    else:
+        import_base_image(get_client(), pathname=pathname)
 
 def usage():
     """
@@ -99,16 +209,40 @@ def usage():
     """
     print textwrap.dedent("""
         Usage: redock [OPTIONS] ACTION CONTAINER..
+               redock [OPTIONS] export-base [DIRECTORY]
+               redock [OPTIONS] import-base [TARBALL]
+               redock [OPTIONS] gc
 
         Create and manage Docker containers and images. Supported actions are
-        `start', `commit', `kill' and `delete'.
+        `start', `commit', `kill', `delete', `fill' (start the containers
+        of a warm pool ahead of time), `snapshot' (save a named checkpoint of
+        a running container) and `restore' (replace a container with a fresh
+        container created from a checkpoint).
+
+        The `export-base' action saves Redock's base image to a tarball (in
+        ~/.redock/base-images by default) and the `import-base' action loads
+        the base image from such a tarball, so that other hosts don't have to
+        build the base image. When the base image doesn't exist, tarballs in
+        ~/.redock/base-images are imported automatically.
+
+        The `gc' action removes stopped containers, unused images and stale
+        runtime configuration entries left behind by Redock.
 
         Supported options:
 
           -n, --hostname=NAME  set container host name (defaults to image tag)
           -m, --message=TEXT   message for image created with `commit' action
+          -j, --jobs=N         process up to N containers in parallel
+                               (or remove N containers/images with `gc')
+          -p, --pool=N         keep N pre-started containers in reserve
+          -s, --snapshot=NAME  name of the snapshot to create or restore
+                               (defaults to a timestamp / the latest snapshot)
+              --dry-run        report what `gc' would remove without removing it
           -v, --verbose        make more noise (can be repeated)
           -h, --help           show this message and exit
     """).strip()
 
+if __name__ == '__main__':
+    main()
+
 # vim: ts=4 sw=4 et
@@ -0,0 +1,298 @@
+# Shared connection to the Docker daemon for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.client` module provides the :py:class:`docker.Client`
+object shared by everything in the current process that talks to Docker (see
+:py:func:`get_client()`). The UNIX socket adapter included in docker-py
+creates a new connection to the Docker daemon for every API call; the client
+returned by :py:func:`get_client()` instead keeps a pool of connections to
+the UNIX socket open (HTTP keep-alive) and reuses them between API calls and
+threads.
+
+Dropped connections (e.g. because the Docker daemon was restarted) are
+replaced automatically: Before a pooled connection is reused it's checked for
+a pending EOF and idempotent requests that fail due to a connection error are
+retried once on a fresh connection. The following environment variables can
+be used to tune the pool:
+
+``$REDOCK_DOCKER_POOL_SIZE``
+  The maximum number of idle connections kept open (defaults to 10). When
+  more threads talk to Docker at the same time, additional connections are
+  created and closed after use.
+
+``$REDOCK_DOCKER_TIMEOUT``
+  The number of seconds to wait for a response from the Docker daemon
+  (defaults to no timeout, because some API calls like
+  :py:func:`docker.Client.wait()` block until a container exits).
+"""
+
+# Standard library modules.
+import httplib
+import os
+import socket
+import threading
+import urlparse
+
+# External dependencies.
+import docker
+import requests.adapters
+import requests.exceptions
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+from verboselogs import VerboseLogger
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The URL of the UNIX socket of the Docker daemon.
+DOCKER_SOCKET_URL = 'unix://var/run/docker.sock'
+
+# The default maximum number of idle connections to the Docker daemon.
+DEFAULT_POOL_SIZE = 10
+
+# The number of seconds to wait for the UNIX socket to accept a connection.
+CONNECT_TIMEOUT = 10
+
+# HTTP methods that can safely be retried on a fresh connection.
+IDEMPOTENT_METHODS = ('DELETE', 'GET', 'HEAD', 'OPTIONS', 'PUT')
+
+class ClientFactory(object):
+
+    """
+    Create and share a single :py:class:`docker.Client` object that uses a
+    pool of keep-alive connections (see :py:class:`UnixSocketAdapter`). All
+    callers in the current process share :py:data:`client_factory` through
+    :py:func:`get_client()`.
+    """
+
+    def __init__(self, base_url=DOCKER_SOCKET_URL, pool_size=None, timeout=None):
+        """
+        Initialize a :py:class:`ClientFactory` object.
+
+        :param base_url: The URL of the Docker daemon's UNIX socket.
+        :param pool_size: The maximum number of idle connections (an integer,
+                          defaults to ``$REDOCK_DOCKER_POOL_SIZE`` or 10).
+        :param timeout: The number of seconds to wait for responses (a number,
+                        defaults to ``$REDOCK_DOCKER_TIMEOUT`` or ``None``
+                        which means wait forever).
+        """
+        if pool_size is None:
+            pool_size = int(os.environ.get('REDOCK_DOCKER_POOL_SIZE', DEFAULT_POOL_SIZE))
+        if timeout is None and os.environ.get('REDOCK_DOCKER_TIMEOUT'):
+            timeout = float(os.environ['REDOCK_DOCKER_TIMEOUT'])
+        self.logger = logger
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.client = None
+        self.adapter = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the shared client (creating it on first use).
+
+        :returns: A :py:class:`docker.Client` object.
+        """
+        with self.lock:
+            if self.client is None:
+                self.logger.debug("Connecting to Docker daemon at %s (pool size %i) ..",
+                                  self.base_url, self.pool_size)
+                client = docker.Client(base_url=self.base_url)
+                self.adapter = UnixSocketAdapter(self.base_url, self.pool_size, self.timeout)
+                client.mount('unix://', self.adapter)
+                self.client = client
+            return self.client
+
+    @property
+    def statistics(self):
+        """
+        A dictionary with the counters of the connection pool: ``requests``
+        (the number of requests issued), ``connections`` (the number of
+        connections opened), ``reused`` (the number of requests sent over an
+        existing connection) and ``reconnects`` (the number of requests that
+        were retried on a fresh connection).
+        """
+        if self.adapter:
+            return self.adapter.statistics.copy()
+        return dict.fromkeys(('requests', 'connections', 'reused', 'reconnects'), 0)
+
+    def close(self):
+        """
+        Close all idle connections to the Docker daemon (the client can still
+        be used afterwards, new connections are opened on demand).
+        """
+        if self.adapter:
+            self.adapter.close()
+
+class UnixSocketAdapter(requests.adapters.HTTPAdapter):
+
+    """
+    Transport adapter for Requests_ that sends all requests for a Docker
+    daemon through a single :py:class:`UnixConnectionPool`.
+
+    .. _Requests: http://python-requests.org/
+    """
+
+    def __init__(self, base_url, pool_size, timeout=None):
+        """
+        Initialize a :py:class:`UnixSocketAdapter` object.
+
+        :param base_url: The URL of the Docker daemon's UNIX socket.
+        :param pool_size: The maximum number of idle connections.
+        :param timeout: The number of seconds to wait for responses.
+        """
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.statistics = dict.fromkeys(('requests', 'connections', 'reused', 'reconnects'), 0)
+        self.connection_pool = None
+        super(UnixSocketAdapter, self).__init__()
+
+    def get_connection(self, url, proxies=None):
+        """
+        Get the connection pool (creating it if needed). All URLs share the
+        same pool because they all refer to the same UNIX socket, except for
+        attach requests: :py:func:`docker.Client.attach_socket()` takes over
+        the socket of the connection, so it's never returned to the pool.
+        Those requests get a connection pool of their own.
+
+        :param url: The URL of the request (a string).
+        :param proxies: Ignored (proxies don't apply to UNIX sockets).
+        :returns: A :py:class:`UnixConnectionPool` object.
+        """
+        if urlparse.urlparse(url).path.endswith('/attach'):
+            return UnixConnectionPool(self)
+        with self.lock:
+            if self.connection_pool is None:
+                self.connection_pool = UnixConnectionPool(self)
+            return self.connection_pool
+
+    def send(self, request, stream=False, timeout=None, **kw):
+        """
+        Send a request to the Docker daemon. When an idempotent request fails
+        because of a connection error, the idle connections are discarded and
+        the request is retried once on a fresh connection.
+
+        See :py:func:`requests.adapters.HTTPAdapter.send()` for the
+        parameters and return value.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return super(UnixSocketAdapter, self).send(request, stream=stream, timeout=timeout, **kw)
+        except requests.exceptions.ConnectionError, e:
+            if request.method not in IDEMPOTENT_METHODS:
+                raise
+            logger.debug("Connection to Docker daemon failed, reconnecting! (%s)", e)
+            self.count('reconnects')
+            self.close()
+            return super(UnixSocketAdapter, self).send(request, stream=stream, timeout=timeout, **kw)
+
+    def count(self, name):
+        """
+        Increment one of the counters in :py:attr:`statistics`.
+
+        :param name: The name of the counter (a string).
+        """
+        with self.lock:
+            self.statistics[name] += 1
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.lock:
+            connection_pool = self.connection_pool
+            self.connection_pool = None
+        if connection_pool:
+            connection_pool.close()
+
+class UnixConnectionPool(HTTPConnectionPool):
+
+    """
+    Pool of :py:class:`UnixConnection` objects (a customized urllib3_
+    connection pool). Connections that are checked out while the pool is
+    empty aren't blocked; a new connection is created instead.
+
+    .. _urllib3: https://github.com/shazow/urllib3
+    """
+
+    def __init__(self, adapter):
+        """
+        Initialize a :py:class:`UnixConnectionPool` object.
+
+        :param adapter: The :py:class:`UnixSocketAdapter` that owns the pool.
+        """
+        HTTPConnectionPool.__init__(self, 'localhost', maxsize=adapter.pool_size,
+                                    block=False, timeout=adapter.timeout)
+        self.adapter = adapter
+
+    def _new_conn(self):
+        """
+        Create a new :py:class:`UnixConnection` object (called by urllib3_).
+        """
+        return UnixConnection(self.adapter)
+
+class UnixConnection(httplib.HTTPConnection):
+
+    """
+    HTTP connection to the UNIX socket of the Docker daemon.
+    """
+
+    def __init__(self, adapter):
+        """
+        Initialize a :py:class:`UnixConnection` object.
+
+        :param adapter: The :py:class:`UnixSocketAdapter` that owns the
+                        connection (used to find the pathname of the UNIX
+                        socket and to update the counters).
+        """
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.adapter = adapter
+        self.socket_path = adapter.base_url.replace('unix:/', '')
+        # Requests parses unix://var/run/docker.sock/v1.4/info as a URL with
+        # the host "var" so the path of the socket ends up in the request path.
+        self.path_prefix = urlparse.urlparse(adapter.base_url).path.rstrip('/')
+
+    def connect(self):
+        """
+        Connect to the UNIX socket.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(self.socket_path)
+        sock.settimeout(None)
+        self.sock = sock
+        self.adapter.count('connections')
+
+    def putrequest(self, method, url, *args, **kw):
+        """
+        Start a request to the Docker daemon (see
+        :py:func:`httplib.HTTPConnection.putrequest()`). This is used both for
+        regular requests and for requests with a chunked body (e.g. streaming
+        uploads to :py:func:`docker.Client.import_image()`).
+        """
+        if self.path_prefix and url.startswith(self.path_prefix):
+            url = url[len(self.path_prefix):]
+        self.adapter.count('requests')
+        if self.sock:
+            self.adapter.count('reused')
+        httplib.HTTPConnection.putrequest(self, method, url, *args, **kw)
+
+# The client factory shared by all callers in the current process.
+client_factory = ClientFactory()
+
+def get_client():
+    """
+    Get the :py:class:`docker.Client` shared by the current process.
+
+    :returns: A :py:class:`docker.Client` object.
+    """
+    return client_factory.get()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,310 @@
+# Long running Redock daemon.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.daemon` module implements ``redockd``, an optional long
+running process that performs ``redock`` actions on behalf of the ``redock``
+program. Every run of ``redock`` has to import its dependencies, connect to
+Docker, load the runtime configuration and discover the network interfaces of
+the host. When you run ``redock`` hundreds of times per hour from scripts this
+startup cost adds up. The daemon pays it once and keeps its
+:py:class:`redock.api.Container` objects (with their Docker connections,
+inventories and SSH_ endpoints) around between requests.
+
+The daemon listens on the UNIX socket ``~/.redock/redockd.sock``. When this
+socket exists and accepts connections the ``redock`` program sends its
+requests to the daemon, otherwise it performs the requested action itself.
+The protocol is trivial: The client sends one JSON encoded request per line
+and the daemon responds with one JSON encoded response per line.
+
+.. _SSH: http://en.wikipedia.org/wiki/Secure_Shell
+"""
+
+# Standard library modules.
+import getopt
+import json
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import textwrap
+import threading
+
+# External dependencies.
+import coloredlogs
+from humanfriendly import Timer, format_path
+from verboselogs import VerboseLogger
+
+# Modules included in our package (redock.api is imported on demand so that
+# the redock program can use DaemonClient without importing docker-py).
+from redock.utils import REDOCK_CONFIG_DIR, create_configuration_directory
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The absolute pathname of the UNIX socket used to communicate with the daemon.
+DAEMON_SOCKET = os.path.join(REDOCK_CONFIG_DIR, 'redockd.sock')
+
+def main():
+    """
+    Command line interface for the ``redockd`` program.
+    """
+    # Initialize coloredlogs.
+    coloredlogs.install()
+    # Parse and validate the command line arguments.
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'vh', ['verbose', 'help'])
+        for option, value in options:
+            if option in ('-v', '--verbose'):
+                coloredlogs.increase_verbosity()
+            elif option in ('-h', '--help'):
+                usage()
+                return
+            else:
+                # Programming error...
+                assert False, "Unhandled option!"
+        if arguments:
+            raise Exception, "The redockd program doesn't take any positional arguments!"
+    except Exception, e:
+        logger.error("Failed to parse command line arguments!")
+        logger.exception(e)
+        usage()
+        sys.exit(1)
+    # Translate SIGTERM into a normal exit so that the socket is cleaned up.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    daemon = Daemon()
+    try:
+        logger.info("Listening on %s ..", format_path(daemon.server_address))
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown_daemon()
+
+def usage():
+    """
+    Print a usage message to the console.
+    """
+    print textwrap.dedent("""
+        Usage: redockd [OPTIONS]
+
+        Long running process that performs the actions of the `redock' program
+        on its behalf to avoid the startup cost of `redock'. The `redock'
+        program automatically uses redockd when it's running.
+
+        Supported options:
+
+          -v, --verbose        make more noise (can be repeated)
+          -h, --help           show this message and exit
+    """).strip()
+
+class Daemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    """
+    The ``redockd`` server. Each connection is handled in a separate thread;
+    requests for the same container are serialized.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, pathname=DAEMON_SOCKET):
+        """
+        Initialize the daemon and start listening on the UNIX socket.
+
+        :param pathname: The pathname of the UNIX socket.
+        """
+        self.logger = logger
+        self.containers = {}
+        self.lock = threading.Lock()
+        create_configuration_directory()
+        if os.path.exists(pathname):
+            if DaemonClient(pathname).is_running():
+                msg = "Another daemon is already listening on %s!"
+                raise Exception, msg % format_path(pathname)
+            self.logger.verbose("Removing stale socket %s ..", format_path(pathname))
+            os.unlink(pathname)
+        SocketServer.UnixStreamServer.__init__(self, pathname, RequestHandler)
+        # Only the owner of the daemon should be able to control it.
+        os.chmod(pathname, 0600)
+
+    def get_container(self, image_name, hostname=None):
+        """
+        Get the cached :py:class:`redock.api.Container` object for the given
+        image and host name (creating it if needed).
+
+        :param image_name: The name of the container's image (a string).
+        :param hostname: The host name to use inside the container (optional).
+        :returns: A tuple with a :py:class:`redock.api.Container` object and a
+                  :py:class:`threading.Lock` that serializes its use.
+        """
+        from redock.api import Container, Image
+        image = Image.coerce(image_name)
+        key = (image.name, hostname or image.tag)
+        with self.lock:
+            if key not in self.containers:
+                self.logger.verbose("Creating container object for %s ..", image.name)
+                self.containers[key] = (Container(image=image, hostname=hostname), threading.Lock())
+            return self.containers[key]
+
+    def perform(self, request):
+        """
+        Perform a ``redock`` action on behalf of a client.
+
+        :param request: A dictionary with the keys ``action`` and ``image``
+                        and optionally ``hostname``, ``message``,
+                        ``pool_size`` and ``snapshot``.
+        :returns: A dictionary with the response to the client.
+        """
+        timer = Timer()
+        try:
+            action = request['action']
+            self.logger.info("Performing %s action for %s ..", action, request['image'])
+            container, lock = self.get_container(request['image'], request.get('hostname'))
+            with lock:
+                self.forget_stale_session(container)
+                container.perform(action,
+                                  message=request.get('message'),
+                                  pool_size=request.get('pool_size', 0),
+                                  snapshot=request.get('snapshot'))
+            self.logger.info("Finished %s action for %s in %s.", action, request['image'], timer)
+            return dict(status='ok', ssh_alias=container.ssh_alias)
+        except Exception, e:
+            self.logger.exception(e)
+            return dict(status='error', message=str(e))
+
+    def forget_stale_session(self, container):
+        """
+        Cached :py:class:`redock.api.Container` objects remember the id of
+        their running container. When the container was killed by someone
+        else (e.g. by the ``redock`` program when the daemon wasn't running)
+        the cached session has to be reset.
+
+        :param container: A :py:class:`redock.api.Container` object.
+        """
+        container_id = container.session.container_id
+        if container_id:
+            container.inventory.invalidate()
+            if not container.inventory.is_running(container_id):
+                self.logger.verbose("Container of %s is no longer running, resetting session ..",
+                                    container.image.name)
+                if container.session.remote_terminal:
+                    container.session.remote_terminal.detach()
+                container.session.reset()
+
+    def shutdown_daemon(self):
+        """
+        Stop listening and remove the UNIX socket.
+        """
+        self.logger.info("Shutting down ..")
+        self.server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        for container, lock in self.containers.values():
+            if container.session.remote_terminal:
+                container.session.remote_terminal.detach()
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+    """
+    Handles a single connection to the daemon.
+    """
+
+    def handle(self):
+        """
+        Read JSON encoded requests (one per line) and respond to them.
+        """
+        for line in iter(self.rfile.readline, ''):
+            response = self.server.perform(json.loads(line))
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+class DaemonClient(object):
+
+    """
+    Client for the ``redockd`` program (used by the ``redock`` program).
+    """
+
+    def __init__(self, pathname=DAEMON_SOCKET):
+        """
+        Initialize a :py:class:`DaemonClient`.
+
+        :param pathname: The pathname of the daemon's UNIX socket.
+        """
+        self.pathname = pathname
+
+    def connect(self):
+        """
+        Connect to the daemon.
+
+        :returns: A connected :py:class:`socket.socket` object.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.pathname)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def is_running(self):
+        """
+        Check whether the daemon is running.
+
+        :returns: ``True`` if the daemon accepts connections, ``False``
+                  otherwise.
+        """
+        if not os.path.exists(self.pathname):
+            return False
+        try:
+            self.connect().close()
+            return True
+        except socket.error:
+            return False
+
+    def perform(self, action, image_name, hostname=None, message=None, pool_size=0, snapshot=None):
+        """
+        Ask the daemon to perform an action on a container.
+
+        Raises :py:exc:`DaemonError` when the daemon reports an error.
+
+        :param action: One of the strings ``start``, ``commit``, ``kill``,
+                       ``delete``, ``fill``, ``snapshot`` or ``restore``.
+        :param image_name: The name of the container's image (a string).
+        :param hostname: The host name to use inside the container (optional).
+        :param message: The commit message (optional).
+        :param pool_size: The size of the warm pool (optional).
+        :param snapshot: The name of a snapshot (optional).
+        :returns: The SSH alias of the container (a string).
+        """
+        logger.verbose("Asking redockd to perform %s action for %s ..", action, image_name)
+        request = dict(action=action, image=image_name, hostname=hostname,
+                       message=message, pool_size=pool_size, snapshot=snapshot)
+        sock = self.connect()
+        try:
+            handle = sock.makefile('r+')
+            handle.write(json.dumps(request) + '\n')
+            handle.flush()
+            line = handle.readline()
+        finally:
+            sock.close()
+        if not line:
+            raise DaemonError, "The daemon closed the connection without responding!"
+        response = json.loads(line)
+        if response['status'] != 'ok':
+            raise DaemonError, response['message']
+        return response['ssh_alias']
+
+class DaemonError(Exception):
+    """
+    Raised by :py:func:`DaemonClient.perform()` when the daemon failed to
+    perform the requested action.
+    """
+
+if __name__ == '__main__':
+    main()
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,420 @@
+# Garbage collection of Docker images and containers for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.garbage` module removes the containers and images that
+Redock created but no longer needs. Nothing else in Redock removes them
+automatically, so on hosts where Redock runs for a long time they pile up,
+wasting disk space and making every listing of images and containers (see
+:py:class:`redock.inventory.Inventory`) slower:
+
+.. code-block:: sh
+
+   $ redock --dry-run gc
+   $ redock gc
+
+The garbage collector (see :py:class:`GarbageCollector`) starts from the
+runtime configuration (see :py:class:`redock.utils.Config`) and the running
+containers and removes what can't be reached from them:
+
+- Stopped containers created by Redock (containers running Supervisor, the
+  containers of the build stages of the base image and containers created
+  from Redock's intermediate images). Running containers are never removed.
+
+- Images in the ``redock-snapshots`` repository that aren't referenced by a
+  snapshot (see :py:mod:`redock.snapshots`).
+
+- Images in the ``redock-stage`` repository that the current base image
+  wasn't built from (left behind by earlier builds of the base image, see
+  :py:func:`redock.base.create_base_image()`). When the base image doesn't
+  exist these images are kept, because they're needed to build it.
+
+- Untagged images without children that were committed from containers
+  created by Redock (e.g. when :py:func:`redock.api.Container.commit()` was
+  called more than once for the same container). Untagged images that are
+  layers of other images can't be removed.
+
+- Entries in the runtime configuration that refer to containers that are no
+  longer running or to snapshots whose image no longer exists.
+
+Containers and images are removed in bulk by a pool of worker threads (see
+:py:mod:`redock.parallel`). Containers and images created in the last ten
+minutes are never removed, so that it's safe to collect garbage while other
+``redock`` processes are starting containers or creating snapshots.
+"""
+
+# Standard library modules.
+import time
+
+# External dependencies.
+from humanfriendly import Timer, format_size
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from redock.base import (BASE_IMAGE_REPO, BASE_IMAGE_TAG, BASE_STAGE_REPO,
+                         BUILD_HOSTNAME, SUPERVISOR_COMMAND)
+from redock.client import get_client
+from redock.inventory import Inventory, PrefixIndex
+from redock.parallel import DEFAULT_CONCURRENCY, run_concurrently
+from redock.snapshots import SNAPSHOT_REPO
+from redock.utils import Config, summarize_id
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# Containers and images younger than this number of seconds are never removed.
+MINIMUM_AGE = 60 * 10
+
+# The repository reported by Docker for untagged images.
+UNTAGGED_REPO = '<none>'
+
+class GarbageCollector(object):
+
+    """
+    Finds and removes the containers and images created by Redock that are no
+    longer needed, together with stale entries in the runtime configuration.
+    """
+
+    def __init__(self, client=None, config=None, concurrency=DEFAULT_CONCURRENCY,
+                 minimum_age=MINIMUM_AGE, dry_run=False):
+        """
+        Initialize a :py:class:`GarbageCollector`.
+
+        :param client: Connection to Docker (instance of
+                       :py:class:`docker.Client`, defaults to the result of
+                       :py:func:`redock.client.get_client()`).
+        :param config: The runtime configuration (a
+                       :py:class:`redock.utils.Config` object, optional).
+        :param concurrency: The maximum number of containers or images to
+                            remove at the same time (a positive integer).
+        :param minimum_age: Containers and images younger than this number of
+                            seconds are never removed.
+        :param dry_run: ``True`` to only report what would be removed.
+        """
+        self.client = client or get_client()
+        self.config = config or Config()
+        self.concurrency = concurrency
+        self.minimum_age = minimum_age
+        self.dry_run = dry_run
+        self.logger = logger
+        self.inventory = Inventory(self.client)
+        self.parents = {}
+
+    def collect(self):
+        """
+        Collect garbage: Prune stale entries from the runtime configuration and
+        remove unreachable containers and images.
+
+        :returns: A :py:class:`GarbageReport` object.
+        """
+        gc_timer = Timer()
+        self.logger.info("%s garbage ..", "Looking for" if self.dry_run else "Collecting")
+        report = GarbageReport(dry_run=self.dry_run)
+        self.inventory.invalidate()
+        all_containers = self.client.containers(all=True, trunc=False)
+        all_images = self.client.images(all=True)
+        running_ids = set(c['Id'] for c in self.inventory.containers())
+        image_ids = PrefixIndex(i['Id'] for i in all_images)
+        report.state_entries = self.prune_state(running_ids, image_ids)
+        containers = self.find_containers(all_containers, running_ids, image_ids)
+        if self.dry_run:
+            report.containers = [c['Id'] for c in containers]
+        else:
+            report.containers, report.failures = self.remove_containers(containers)
+            self.inventory.invalidate(images=False)
+        remaining = [c for c in all_containers if c['Id'] not in report.containers]
+        images = self.find_images(remaining, image_ids)
+        if self.dry_run:
+            report.images = [i['Id'] for i in images]
+            report.bytes_reclaimed = sum(i.get('Size') or 0 for i in images)
+        else:
+            removed, failed = self.remove_images(images)
+            report.images = [i['Id'] for i in removed]
+            report.failures += failed
+            self.inventory.invalidate()
+            if removed:
+                # Removing an image also removes the untagged layers below it
+                # that aren't shared with other images, so compare listings.
+                remaining_ids = set(i['Id'] for i in self.client.images(all=True))
+                report.bytes_reclaimed = sum(i.get('Size') or 0 for i in all_images
+                                             if i['Id'] not in remaining_ids)
+        self.logger.info("%s (took %s).", report, gc_timer)
+        return report
+
+    def prune_state(self, running_ids, image_ids):
+        """
+        Remove entries from the runtime configuration that refer to containers
+        that are no longer running (in the namespaces ``containers`` and
+        ``pool``) or to images that no longer exist (in the namespace
+        ``snapshots``).
+
+        :param running_ids: A set with the ids of the running containers.
+        :param image_ids: A :py:class:`redock.inventory.PrefixIndex` of the ids
+                          of all images (including intermediate images).
+        :returns: The number of entries that were (or would be) removed.
+        """
+        pruned = 0
+        with self.config.transaction():
+            for key, container_id in self.config.items('containers'):
+                if container_id not in running_ids:
+                    self.logger.verbose("Forgetting container %s of %s (no longer running).",
+                                        summarize_id(container_id), ':'.join(key))
+                    if not self.dry_run:
+                        self.config.delete('containers', key)
+                    pruned += 1
+            for key, entries in self.config.items('pool'):
+                alive = [e for e in entries if e['container_id'] in running_ids]
+                if len(alive) < len(entries):
+                    self.logger.verbose("Forgetting %i reserved container(s) of %s (no longer running).",
+                                        len(entries) - len(alive), ':'.join(key))
+                    if not self.dry_run:
+                        self.config.set('pool', key, alive)
+                    pruned += len(entries) - len(alive)
+            for key, snapshots in self.config.items('snapshots'):
+                existing = [s for s in snapshots if image_ids.matches(s['image_id'])]
+                if len(existing) < len(snapshots):
+                    self.logger.verbose("Forgetting %i snapshot(s) of %s (image no longer exists).",
+                                        len(snapshots) - len(existing), ':'.join(key))
+                    if not self.dry_run:
+                        self.config.set('snapshots', key, existing)
+                    pruned += len(snapshots) - len(existing)
+        return pruned
+
+    def find_containers(self, containers, running_ids, image_ids):
+        """
+        Find the stopped containers that were created by Redock.
+
+        :param containers: A list of dictionaries as returned by
+                           :py:func:`docker.Client.containers()` (including
+                           containers that are not running).
+        :param running_ids: A set with the ids of the running containers.
+        :param image_ids: A :py:class:`redock.inventory.PrefixIndex` of the ids
+                          of all images (including intermediate images).
+        :returns: A list of dictionaries like the ones in `containers`.
+        """
+        owned_image_ids = set()
+        for image in self.inventory.images():
+            if image.get('Repository') in (BASE_STAGE_REPO, SNAPSHOT_REPO):
+                owned_image_ids.add(image['Id'])
+        garbage = []
+        for container in containers:
+            if container['Id'] in running_ids or not self.is_old_enough(container):
+                continue
+            image = container.get('Image') or ''
+            owned = (container.get('Command', '').startswith(SUPERVISOR_COMMAND)
+                     or image.split(':')[0] in (BASE_STAGE_REPO, SNAPSHOT_REPO)
+                     or (image and any(i in owned_image_ids for i in image_ids.matches(image))))
+            if owned:
+                self.logger.verbose("Found stopped container %s (%s).",
+                                    summarize_id(container['Id']), container.get('Status'))
+                garbage.append(container)
+        return garbage
+
+    def find_images(self, containers, image_ids):
+        """
+        Find the images created by Redock that can't be reached from the
+        runtime configuration.
+
+        :param containers: A list of dictionaries as returned by
+                           :py:func:`docker.Client.containers()` (the
+                           containers that will remain after garbage
+                           collection).
+        :param image_ids: A :py:class:`redock.inventory.PrefixIndex` of the ids
+                          of all images (including intermediate images).
+        :returns: A list of dictionaries as returned by
+                  :py:func:`docker.Client.images()`.
+        """
+        # Images used by containers can't be removed.
+        protected = set()
+        for container in containers:
+            name = container.get('Image') or ''
+            if ':' in name:
+                image = self.inventory.find_image(*name.split(':', 1))
+                if image:
+                    protected.add(image['Id'])
+            elif name:
+                protected.update(image_ids.matches(name))
+        # Images referenced by snapshots are reachable.
+        snapshot_ids = set()
+        for key, snapshots in self.config.items('snapshots'):
+            for snapshot in snapshots:
+                snapshot_ids.update(image_ids.matches(snapshot['image_id']))
+        # Intermediate images that the base image was built from are reachable.
+        base_image = self.inventory.find_image(BASE_IMAGE_REPO, BASE_IMAGE_TAG)
+        base_ancestry = self.find_ancestors(base_image['Id']) if base_image else None
+        garbage = []
+        for image in self.inventory.images():
+            if image['Id'] in protected or not self.is_old_enough(image):
+                continue
+            repository = image.get('Repository')
+            if repository == SNAPSHOT_REPO:
+                unreachable = image['Id'] not in snapshot_ids
+            elif repository == BASE_STAGE_REPO:
+                unreachable = base_ancestry is not None and image['Id'] not in base_ancestry
+            elif repository in (UNTAGGED_REPO, None, ''):
+                unreachable = self.is_owned_image(image['Id'])
+            else:
+                unreachable = False
+            if unreachable:
+                self.logger.verbose("Found unreachable image %s (%s).", self.get_image_name(image),
+                                    format_size(image.get('Size') or 0))
+                garbage.append(image)
+        return garbage
+
+    def find_ancestors(self, image_id):
+        """
+        Find the ancestors of an image.
+
+        :param image_id: The id of an image (a string).
+        :returns: A set with the ids of the image and its ancestors.
+        """
+        ancestors = set()
+        while image_id and image_id not in ancestors:
+            ancestors.add(image_id)
+            if image_id not in self.parents:
+                self.parents[image_id] = self.client.inspect_image(image_id).get('parent')
+            image_id = self.parents[image_id]
+        return ancestors
+
+    def is_owned_image(self, image_id):
+        """
+        Check whether an image was committed from a container created by
+        Redock (based on the command and host name of the container).
+
+        :param image_id: The id of an image (a string).
+        :returns: ``True`` if the image was created by Redock, ``False``
+                  otherwise.
+        """
+        details = self.client.inspect_image(image_id)
+        self.parents[image_id] = details.get('parent')
+        config = details.get('container_config') or {}
+        command = config.get('Cmd') or []
+        return (' '.join(command).startswith(SUPERVISOR_COMMAND)
+                or config.get('Hostname') == BUILD_HOSTNAME)
+
+    def is_old_enough(self, thing):
+        """
+        Check whether a container or image is old enough to be removed.
+
+        :param thing: A dictionary with a ``Created`` key (a UNIX timestamp).
+        :returns: ``True`` if the container or image can be removed, ``False``
+                  otherwise.
+        """
+        return thing.get('Created', 0) <= time.time() - self.minimum_age
+
+    def remove_containers(self, containers):
+        """
+        Remove containers using a pool of worker threads.
+
+        :param containers: A list of dictionaries as returned by
+                           :py:func:`docker.Client.containers()`.
+        :returns: A tuple with two lists: The ids of the removed containers
+                  and error messages about the containers that couldn't be
+                  removed.
+        """
+        removed = []
+        failures = []
+        jobs = run_concurrently(lambda c: self.client.remove_container(c['Id']),
+                                containers, self.concurrency)
+        for container, job in zip(containers, jobs):
+            if job.succeeded:
+                removed.append(container['Id'])
+            else:
+                self.logger.warn("Failed to remove container %s! (%s)",
+                                 summarize_id(container['Id']), job.exception)
+                failures.append("container %s: %s" % (summarize_id(container['Id']), job.exception))
+        return removed, failures
+
+    def remove_images(self, images):
+        """
+        Remove images using a pool of worker threads. Images that can't be
+        removed yet because another image that's being removed depends on
+        them are retried until no more progress is made.
+
+        :param images: A list of dictionaries as returned by
+                       :py:func:`docker.Client.images()`.
+        :returns: A tuple with two lists: The dictionaries of the removed
+                  images and error messages about the images that couldn't be
+                  removed.
+        """
+        removed = []
+        failed = []
+        pending = images
+        while pending:
+            jobs = run_concurrently(lambda i: self.client.remove_image(self.get_image_name(i)),
+                                    pending, self.concurrency)
+            removed.extend(i for i, j in zip(pending, jobs) if j.succeeded)
+            failed = [(i, j) for i, j in zip(pending, jobs) if not j.succeeded]
+            if len(failed) == len(pending):
+                break
+            pending = [i for i, j in failed]
+            failed = []
+        failures = []
+        for image, job in failed:
+            self.logger.warn("Failed to remove image %s! (%s)", self.get_image_name(image), job.exception)
+            failures.append("image %s: %s" % (self.get_image_name(image), job.exception))
+        return removed, failures
+
+    def get_image_name(self, image):
+        """
+        Get the name used to remove an image. Tagged images are removed by
+        name, so that tags in other repositories are left alone.
+
+        :param image: A dictionary as returned by :py:func:`docker.Client.images()`.
+        :returns: The name or id of the image (a string).
+        """
+        if image.get('Repository') in (UNTAGGED_REPO, None, ''):
+            return image['Id']
+        return '%s:%s' % (image['Repository'], image['Tag'])
+
+class GarbageReport(object):
+
+    """
+    The results of :py:func:`GarbageCollector.collect()`.
+    """
+
+    def __init__(self, dry_run=False):
+        """
+        Initialize a :py:class:`GarbageReport`.
+
+        :param dry_run: ``True`` if nothing was actually removed.
+        """
+        self.dry_run = dry_run
+        self.containers = []
+        self.images = []
+        self.state_entries = 0
+        self.bytes_reclaimed = 0
+        self.failures = []
+
+    def __str__(self):
+        """
+        Summarize the results of garbage collection (a string).
+        """
+        if self.dry_run:
+            template = "Would remove %i containers, %i images and %i runtime configuration entries, reclaiming at least %s"
+        else:
+            template = "Removed %i containers, %i images and %i runtime configuration entries, reclaimed %s"
+        summary = template % (len(self.containers), len(self.images),
+                              self.state_entries, format_size(self.bytes_reclaimed))
+        if self.failures:
+            summary += " (%i failed)" % len(self.failures)
+        return summary
+
+def collect_garbage(client=None, concurrency=DEFAULT_CONCURRENCY, dry_run=False):
+    """
+    Remove the containers and images that Redock no longer needs (see
+    :py:class:`GarbageCollector`).
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`,
+                   optional).
+    :param concurrency: The maximum number of containers or images to remove
+                        at the same time (a positive integer).
+    :param dry_run: ``True`` to only report what would be removed.
+    :returns: A :py:class:`GarbageReport` object.
+    """
+    return GarbageCollector(client=client, concurrency=concurrency, dry_run=dry_run).collect()
+
+# vim: ts=4 sw=4 et
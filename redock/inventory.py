@@ -0,0 +1,221 @@
+# Cached listings of Docker images and containers.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.inventory` module defines the :py:class:`Inventory` class
+which caches the lists of images and containers reported by Docker. On hosts
+with lots of images these lists are big JSON documents that take a while to
+generate, transfer and parse, so Redock tries hard to fetch them at most once
+per operation.
+
+It also defines the :py:class:`PrefixIndex` class which is used to translate
+the short ids reported by some of Docker's API calls into long ids.
+"""
+
+# Standard library modules.
+import bisect
+
+# External dependencies.
+from verboselogs import VerboseLogger
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+class Inventory(object):
+
+    """
+    Snapshot of the images and containers known to Docker. The listings are
+    fetched on demand and cached until :py:func:`invalidate()` is called. Code
+    that changes the set of images or containers (for example by calling
+    :py:func:`docker.Client.commit()`, :py:func:`docker.Client.create_container()`
+    or :py:func:`docker.Client.remove_image()`) is responsible for calling
+    :py:func:`invalidate()` afterwards.
+    """
+
+    def __init__(self, client):
+        """
+        Initialize an :py:class:`Inventory`.
+
+        :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+        """
+        self.client = client
+        self.logger = logger
+        self.invalidate()
+
+    def invalidate(self, images=True, containers=True):
+        """
+        Forget (some of) the cached listings so that they're fetched again on
+        the next access.
+
+        :param images: ``True`` to forget the list of images.
+        :param containers: ``True`` to forget the lists of containers.
+        """
+        if images:
+            self.cached_images = None
+            self.cached_image_index = None
+            self.cached_image_ids = None
+        if containers:
+            self.cached_containers = {}
+            self.cached_container_ids = None
+
+    def images(self):
+        """
+        Get the list of images known to Docker.
+
+        :returns: A list of dictionaries as returned by
+                  :py:func:`docker.Client.images()`.
+        """
+        if self.cached_images is None:
+            self.logger.debug("Fetching list of images from Docker ..")
+            self.cached_images = self.client.images()
+            self.logger.debug("Docker reported %i images.", len(self.cached_images))
+        return self.cached_images
+
+    def containers(self, all=False):
+        """
+        Get the list of containers known to Docker.
+
+        :param all: ``True`` to include containers that are not running.
+        :returns: A list of dictionaries as returned by
+                  :py:func:`docker.Client.containers()`.
+        """
+        if all not in self.cached_containers:
+            self.logger.debug("Fetching list of %s containers from Docker ..", 'all' if all else 'running')
+            self.cached_containers[all] = self.client.containers(all=all)
+            self.logger.debug("Docker reported %i containers.", len(self.cached_containers[all]))
+        return self.cached_containers[all]
+
+    @property
+    def image_index(self):
+        """
+        A dictionary that maps tuples with a repository and tag to the
+        dictionary of the most recent image with that repository and tag.
+        """
+        if self.cached_image_index is None:
+            index = {}
+            for image in self.images():
+                key = (image.get('Repository'), image.get('Tag'))
+                if key not in index or image['Created'] > index[key]['Created']:
+                    index[key] = image
+            self.cached_image_index = index
+        return self.cached_image_index
+
+    @property
+    def image_ids(self):
+        """
+        A :py:class:`PrefixIndex` of the ids of all images known to Docker.
+        """
+        if self.cached_image_ids is None:
+            self.cached_image_ids = PrefixIndex(i['Id'] for i in self.images())
+        return self.cached_image_ids
+
+    @property
+    def container_ids(self):
+        """
+        A :py:class:`PrefixIndex` of the ids of all containers known to Docker
+        (including containers that are not running).
+        """
+        if self.cached_container_ids is None:
+            self.cached_container_ids = PrefixIndex(c['Id'] for c in self.containers(all=True))
+        return self.cached_container_ids
+
+    def find_image(self, repository, tag):
+        """
+        Find the most recent Docker image with the given repository and tag.
+
+        :param repository: The name of the image's repository.
+        :param tag: The name of the image's tag.
+        :returns: A dictionary as returned by :py:func:`docker.Client.images()`
+                  or ``None`` if no images were matched.
+        """
+        return self.image_index.get((repository, tag))
+
+    def is_running(self, container_id):
+        """
+        Check whether a container is running.
+
+        :param container_id: The id of a container (a string).
+        :returns: ``True`` if the container is running, ``False`` otherwise.
+        """
+        return any(c['Id'] == container_id for c in self.containers())
+
+class PrefixIndex(object):
+
+    """
+    Sorted index of unique ids that supports looking up ids by prefix in
+    logarithmic time (using binary search).
+
+    >>> index = PrefixIndex(['abc123', 'abd456', 'bcd789'])
+    >>> index.resolve('abd')
+    'abd456'
+    """
+
+    def __init__(self, ids):
+        """
+        Initialize a :py:class:`PrefixIndex`.
+
+        :param ids: An iterable of ids (strings).
+        """
+        self.ids = sorted(set(ids))
+
+    def matches(self, prefix):
+        """
+        Find the ids that start with the given prefix.
+
+        :param prefix: The prefix to search for (a string).
+        :returns: A list of matching ids (strings).
+        """
+        position = bisect.bisect_left(self.ids, prefix)
+        matches = []
+        while position < len(self.ids) and self.ids[position].startswith(prefix):
+            matches.append(self.ids[position])
+            position += 1
+        return matches
+
+    def resolve(self, prefix):
+        """
+        Translate a prefix (e.g. a short id) into the full id.
+
+        Raises :py:exc:`UnknownId` when no id matches the prefix and
+        :py:exc:`AmbiguousId` when more than one id matches the prefix.
+
+        :param prefix: The prefix to search for (a string).
+        :returns: The full id (a string).
+        """
+        position = bisect.bisect_left(self.ids, prefix)
+        if position == len(self.ids) or not self.ids[position].startswith(prefix):
+            msg = "Failed to translate short id (%s) into long id!"
+            raise UnknownId, msg % prefix
+        if position + 1 < len(self.ids) and self.ids[position + 1].startswith(prefix):
+            msg = "Short id %s is ambiguous! (it matches %s)"
+            raise AmbiguousId, msg % (prefix, ', '.join(self.matches(prefix)))
+        return self.ids[position]
+
+    def __contains__(self, id):
+        """
+        Check whether the exact given id is in the index.
+        """
+        position = bisect.bisect_left(self.ids, id)
+        return position < len(self.ids) and self.ids[position] == id
+
+    def __len__(self):
+        """
+        Get the number of ids in the index.
+        """
+        return len(self.ids)
+
+class UnknownId(Exception):
+    """
+    Raised by :py:func:`PrefixIndex.resolve()` when no id matches a prefix.
+    """
+
+class AmbiguousId(Exception):
+    """
+    Raised by :py:func:`PrefixIndex.resolve()` when more than one id matches
+    a prefix.
+    """
+
+# vim: ts=4 sw=4 et
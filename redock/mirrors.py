@@ -0,0 +1,251 @@
+# Ranking of Ubuntu package mirrors for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.mirrors` module selects the Ubuntu package mirror that's
+configured inside containers. The candidates are the mirrors reported by
+``http://mirrors.ubuntu.com/mirrors.txt`` (a list of mirrors in the country of
+the caller). Because being in the same country doesn't make a mirror fast,
+the candidates are probed concurrently: For each mirror the time to open a
+TCP connection and to download the first few kilobytes of a ``Release`` file
+is measured. The resulting ranking is stored in ``~/.redock/ubuntu-mirrors.json``
+(including timestamps) and the candidates are ranked again when the ranking is
+more than a week old.
+
+Changing the mirror means ``apt-get`` has to download all package metadata
+again (and the base image has to be rebuilt, see
+:py:func:`redock.base.create_base_image()`) so once a mirror has been
+selected it's only replaced when it fails or when another mirror is a lot
+faster.
+"""
+
+# Standard library modules.
+import httplib
+import json
+import os
+import time
+import urllib
+import urlparse
+
+# External dependencies.
+from humanfriendly import Timer, format_path, format_timespan
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from redock.parallel import run_concurrently
+from redock.utils import (DEFAULT_UBUNTU_MIRROR, REDOCK_CONFIG_DIR,
+                          UBUNTU_MIRROR_FILE, coerce_boolean,
+                          create_configuration_directory)
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The absolute pathname of the JSON file with the ranked mirrors.
+MIRROR_RANKING_FILE = os.path.join(REDOCK_CONFIG_DIR, 'ubuntu-mirrors.json')
+
+# The URL of the list of Ubuntu mirrors in the country of the caller.
+MIRROR_LIST_URL = 'http://mirrors.ubuntu.com/mirrors.txt'
+
+# The file that's downloaded (partially) from each mirror.
+PROBE_FILE = 'dists/precise/Release'
+
+# The number of bytes downloaded from each mirror.
+PROBE_SIZE = 4096
+
+# The number of seconds before a probe is aborted.
+PROBE_TIMEOUT = 5
+
+# The number of mirrors probed at the same time.
+PROBE_CONCURRENCY = 10
+
+# The number of seconds after which the ranking is considered stale (a week).
+RANKING_MAX_AGE = 60 * 60 * 24 * 7
+
+# The previously selected mirror is kept unless the best mirror is this many
+# times faster.
+STICKINESS = 2.0
+
+def select_mirror(force=False, pathname=MIRROR_RANKING_FILE, candidates=None, max_age=RANKING_MAX_AGE):
+    """
+    Select the fastest Ubuntu mirror that's currently available.
+
+    :param force: ``True`` to rank the mirrors even if the ranking isn't stale.
+    :param pathname: The pathname of the JSON file with the ranking.
+    :param candidates: A list of mirror URLs to rank (defaults to the mirrors
+                       reported by ``mirrors.ubuntu.com``).
+    :param max_age: The age (in seconds) after which the ranking is stale.
+    :returns: The URL of the selected mirror (a string).
+    """
+    ranking = MirrorRanking(pathname)
+    if coerce_boolean(os.environ.get('REDOCK_OFFLINE', '')):
+        # Don't touch the network in offline mode (see redock.aptcache).
+        return ranking.selected or DEFAULT_UBUNTU_MIRROR
+    if force or ranking.is_stale(max_age):
+        try:
+            if candidates is None:
+                candidates = find_candidate_mirrors()
+            ranking.update(rank_mirrors(candidates))
+        except Exception, e:
+            logger.warn("Failed to rank Ubuntu mirrors! (%s)", e)
+    # Quickly check that the selected mirror still responds, otherwise fall
+    # back to the next mirror in the ranking.
+    while ranking.selected:
+        result = probe_mirror(ranking.selected, size=0)
+        if not result['error']:
+            return ranking.selected
+        logger.warn("Ubuntu mirror %s failed, falling back to next mirror! (%s)",
+                    ranking.selected, result['error'])
+        ranking.demote(result)
+    logger.warn("No working Ubuntu mirrors found, using %s.", DEFAULT_UBUNTU_MIRROR)
+    return DEFAULT_UBUNTU_MIRROR
+
+def find_candidate_mirrors(url=MIRROR_LIST_URL):
+    """
+    Get the list of Ubuntu mirrors in the country of the caller.
+
+    :param url: The URL of the list of mirrors (one URL per line).
+    :returns: A list of mirror URLs (strings).
+    """
+    logger.debug("Finding nearby Ubuntu package mirrors using %s ..", url)
+    candidates = [l.strip() for l in urllib.urlopen(url) if l.strip()]
+    logger.debug("Found %i candidate mirrors.", len(candidates))
+    return candidates
+
+def rank_mirrors(candidates, concurrency=PROBE_CONCURRENCY):
+    """
+    Probe the given mirrors concurrently and sort them by their response
+    time (see :py:func:`probe_mirror()`).
+
+    :param candidates: A list of mirror URLs (strings).
+    :param concurrency: The number of mirrors to probe at the same time.
+    :returns: A list of dictionaries like the ones returned by
+              :py:func:`probe_mirror()`: First the working mirrors (fastest
+              first), then the failed mirrors.
+    """
+    timer = Timer()
+    logger.info("Ranking %i Ubuntu mirrors ..", len(candidates))
+    results = [job.result for job in run_concurrently(probe_mirror, candidates, concurrency)]
+    results.sort(key=lambda r: (bool(r['error']), r['elapsed']))
+    working = [r for r in results if not r['error']]
+    if working:
+        logger.info("Ranked Ubuntu mirrors in %s, fastest is %s (%s).",
+                    timer, working[0]['url'], format_timespan(working[0]['elapsed']))
+    else:
+        logger.warn("None of the %i Ubuntu mirrors responded!", len(candidates))
+    return results
+
+def probe_mirror(url, size=PROBE_SIZE, timeout=PROBE_TIMEOUT):
+    """
+    Measure the response time of an Ubuntu mirror.
+
+    :param url: The URL of the mirror (a string).
+    :param size: The number of bytes of the ``Release`` file to download (if
+                 this is zero only a TCP connection is made).
+    :param timeout: The number of seconds before the probe is aborted.
+    :returns: A dictionary with the keys ``url``, ``connect_time``,
+              ``elapsed`` (the total time in seconds), ``timestamp`` and
+              ``error`` (``None`` if the probe succeeded, a string otherwise).
+    """
+    result = dict(url=url, connect_time=None, elapsed=None, timestamp=time.time(), error=None)
+    components = urlparse.urlparse(url)
+    connection = httplib.HTTPConnection(components.hostname, components.port, timeout=timeout)
+    try:
+        timer = Timer()
+        connection.connect()
+        result['connect_time'] = timer.elapsed_time
+        if size > 0:
+            connection.request('GET', '%s/%s' % (components.path.rstrip('/'), PROBE_FILE),
+                               headers={'Range': 'bytes=0-%i' % (size - 1)})
+            response = connection.getresponse()
+            if response.status not in (httplib.OK, httplib.PARTIAL_CONTENT):
+                raise Exception, "Unexpected HTTP status %i (%s)" % (response.status, response.reason)
+            response.read(size)
+        result['elapsed'] = timer.elapsed_time
+        logger.debug("Mirror %s responded in %s.", url, format_timespan(result['elapsed']))
+    except Exception, e:
+        result['error'] = str(e) or e.__class__.__name__
+        logger.debug("Mirror %s failed! (%s)", url, result['error'])
+    finally:
+        connection.close()
+    return result
+
+class MirrorRanking(object):
+
+    """
+    The ranked mirrors stored in ``~/.redock/ubuntu-mirrors.json``.
+    """
+
+    def __init__(self, pathname=MIRROR_RANKING_FILE):
+        """
+        Initialize a :py:class:`MirrorRanking` object.
+
+        :param pathname: The pathname of the JSON file.
+        """
+        self.pathname = pathname
+        self.timestamp = 0
+        self.selected = None
+        self.mirrors = []
+        if os.path.isfile(pathname):
+            with open(pathname) as handle:
+                state = json.load(handle)
+            self.timestamp = state['timestamp']
+            self.selected = state['selected']
+            self.mirrors = state['mirrors']
+        elif pathname == MIRROR_RANKING_FILE and os.path.isfile(UBUNTU_MIRROR_FILE):
+            # Prefer the mirror selected by older versions of Redock.
+            with open(UBUNTU_MIRROR_FILE) as handle:
+                self.selected = handle.read().strip() or None
+
+    def is_stale(self, max_age=RANKING_MAX_AGE):
+        """
+        Check whether the mirrors should be ranked again.
+
+        :param max_age: The maximum age of the ranking (in seconds).
+        :returns: ``True`` if the ranking is stale, ``False`` otherwise.
+        """
+        return not self.mirrors or time.time() - self.timestamp > max_age
+
+    def update(self, results):
+        """
+        Replace the ranking with new results and select a mirror.
+
+        :param results: The list returned by :py:func:`rank_mirrors()`.
+        """
+        working = [r for r in results if not r['error']]
+        previous = [r for r in working if r['url'] == self.selected]
+        if previous and previous[0]['elapsed'] <= working[0]['elapsed'] * STICKINESS:
+            logger.verbose("Keeping previously selected Ubuntu mirror %s.", self.selected)
+        else:
+            self.selected = working[0]['url'] if working else None
+        self.timestamp = time.time()
+        self.mirrors = results
+        self.save()
+
+    def demote(self, result):
+        """
+        Move a failed mirror to the end of the ranking and select the next
+        working mirror.
+
+        :param result: The dictionary returned by :py:func:`probe_mirror()`.
+        """
+        self.mirrors = [r for r in self.mirrors if r['url'] != result['url']] + [result]
+        working = [r for r in self.mirrors if not r['error']]
+        self.selected = working[0]['url'] if working else None
+        self.save()
+
+    def save(self):
+        """
+        Save the ranking to disk.
+        """
+        if self.pathname == MIRROR_RANKING_FILE:
+            create_configuration_directory()
+        logger.debug("Saving ranking of Ubuntu mirrors to %s ..", format_path(self.pathname))
+        temporary_file = '%s.tmp' % self.pathname
+        with open(temporary_file, 'w') as handle:
+            json.dump(dict(timestamp=self.timestamp, selected=self.selected, mirrors=self.mirrors), handle, indent=2)
+        os.rename(temporary_file, self.pathname)
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,295 @@
+# Bounded concurrency for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.parallel` module implements a simple bounded pool of
+worker threads. Most of what Redock does consists of waiting for Docker, SSH_
+and apt-get_ so threads are a good fit, even in Python. The pool is used by
+the ``redock`` program to start/commit/kill multiple containers at once.
+
+.. _apt-get: http://manpages.ubuntu.com/manpages/precise/man8/apt-get.8.html
+.. _SSH: http://en.wikipedia.org/wiki/Secure_Shell
+"""
+
+# Standard library modules.
+import Queue
+import sys
+import threading
+
+# External dependencies.
+from humanfriendly import Timer
+from verboselogs import VerboseLogger
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The default number of worker threads.
+DEFAULT_CONCURRENCY = 4
+
+class WorkerPool(object):
+
+    """
+    A bounded pool of worker threads that execute :py:class:`Job` objects.
+    Can be used as a context manager, in which case :py:func:`shutdown()` is
+    called automatically at the end of the ``with`` block:
+
+    >>> with WorkerPool(concurrency=10) as pool:
+    ...   jobs = [pool.submit(pow, 2, n) for n in range(5)]
+    >>> [job.result for job in jobs]
+    [1, 2, 4, 8, 16]
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Initialize a :py:class:`WorkerPool`.
+
+        :param concurrency: The maximum number of jobs to run at the same time
+                            (a positive integer).
+        """
+        if concurrency < 1:
+            msg = "Concurrency should be a positive integer! (got %r)"
+            raise ValueError, msg % concurrency
+        self.concurrency = concurrency
+        self.queue = Queue.Queue()
+        self.threads = []
+
+    def submit(self, function, *args, **kw):
+        """
+        Schedule a function to be called by one of the worker threads. Worker
+        threads are started on demand.
+
+        :param function: The callable to execute.
+        :param args: The positional arguments for the callable.
+        :param kw: The keyword arguments for the callable.
+        :returns: A :py:class:`Job` object.
+        """
+        return self.schedule(Job(function, *args, **kw))
+
+    def schedule(self, job):
+        """
+        Schedule a :py:class:`Job` that was created in advance (this makes it
+        possible to hand out a job before it's scheduled, for example to
+        schedule it from the callback of another job).
+
+        :param job: A :py:class:`Job` object.
+        :returns: The same :py:class:`Job` object.
+        """
+        self.queue.put(job)
+        if len(self.threads) < self.concurrency:
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return job
+
+    def map(self, function, arguments):
+        """
+        Call a function once for each of the given arguments.
+
+        :param function: The callable to execute.
+        :param arguments: An iterable of (single) arguments for the callable.
+        :returns: A list of :py:class:`Job` objects (in the same order as the
+                  arguments).
+        """
+        return [self.submit(function, a) for a in arguments]
+
+    def cancel(self):
+        """
+        Cancel all jobs that haven't been started yet (jobs that are already
+        running are not interrupted).
+
+        :returns: The number of jobs that were cancelled.
+        """
+        count = 0
+        sentinels = 0
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if job is None:
+                # Preserve the markers queued by shutdown().
+                sentinels += 1
+            else:
+                job.cancel()
+                count += 1
+        for i in range(sentinels):
+            self.queue.put(None)
+        return count
+
+    def shutdown(self):
+        """
+        Wait for all submitted jobs to finish and stop the worker threads.
+        """
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def work(self):
+        """
+        The main loop of the worker threads.
+        """
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            job.run()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+
+class Job(object):
+
+    """
+    A function call scheduled on a :py:class:`WorkerPool`. After the job has
+    finished either :py:attr:`result` or :py:attr:`exception` is set.
+    """
+
+    def __init__(self, function, *args, **kw):
+        """
+        Initialize a :py:class:`Job` from the given arguments.
+
+        :param function: The callable to execute.
+        :param args: The positional arguments for the callable.
+        :param kw: The keyword arguments for the callable.
+        """
+        self.function = function
+        self.args = args
+        self.kw = kw
+        self.result = None
+        self.exception = None
+        self.exc_info = None
+        self.cancelled = False
+        self.timer = None
+        self.elapsed_time = None
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def run(self):
+        """
+        Execute the job (called by the worker thread).
+        """
+        self.timer = Timer()
+        try:
+            self.result = self.function(*self.args, **self.kw)
+        except Exception, e:
+            self.exception = e
+            self.exc_info = sys.exc_info()
+        self.elapsed_time = self.timer.elapsed_time
+        self.finish()
+
+    def cancel(self):
+        """
+        Mark the job as cancelled (only used for jobs that never started).
+        """
+        self.cancelled = True
+        self.exception = JobCancelled("Job was cancelled before it started!")
+        self.finish()
+
+    def finish(self):
+        """
+        Mark the job as finished and run any registered callbacks.
+        """
+        with self.lock:
+            self.finished.set()
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception, e:
+                logger.exception(e)
+
+    def add_callback(self, callback):
+        """
+        Register a function to be called when the job finishes. If the job
+        has already finished the callback is called immediately.
+
+        :param callback: A callable that takes a single argument (the
+                         :py:class:`Job` object).
+        """
+        with self.lock:
+            if not self.done:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to finish and return its result. If the job raised an
+        exception the exception is re-raised in the calling thread.
+
+        :param timeout: The maximum number of seconds to wait (``None`` means
+                        wait forever).
+        :returns: The return value of the function.
+        """
+        # Event.wait() without a timeout can't be interrupted by Control-C in
+        # Python 2.x so we wake up regularly.
+        remaining = timeout
+        while not self.finished.is_set():
+            interval = 1 if remaining is None else min(1, remaining)
+            self.finished.wait(interval)
+            if remaining is not None:
+                remaining -= interval
+                if remaining <= 0:
+                    break
+        if not self.done:
+            raise JobTimeout, "Job didn't finish within %s seconds!" % timeout
+        if self.exc_info and not self.cancelled:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        elif self.exception:
+            raise self.exception
+        return self.result
+
+    @property
+    def done(self):
+        """
+        ``True`` if the job has finished (successfully or not), ``False``
+        otherwise.
+        """
+        return self.finished.is_set()
+
+    @property
+    def succeeded(self):
+        """
+        ``True`` if the job finished without raising an exception, ``False``
+        otherwise.
+        """
+        return self.done and self.exception is None
+
+def run_concurrently(function, arguments, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Call a function once for each of the given arguments using a temporary
+    :py:class:`WorkerPool` and wait for all calls to finish.
+
+    :param function: The callable to execute.
+    :param arguments: An iterable of (single) arguments for the callable.
+    :param concurrency: The maximum number of concurrent calls.
+    :returns: A list of finished :py:class:`Job` objects (in the same order as
+              the arguments).
+    """
+    with WorkerPool(concurrency=concurrency) as pool:
+        jobs = pool.map(function, arguments)
+    return jobs
+
+class JobCancelled(Exception):
+    """
+    Set as the :py:attr:`Job.exception` of jobs that were cancelled using
+    :py:func:`WorkerPool.cancel()`.
+    """
+
+class JobTimeout(Exception):
+    """
+    Raised by :py:func:`Job.wait()` when the job doesn't finish within the
+    given timeout.
+    """
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,321 @@
+# Streaming download and upload of Docker images for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.pull` module downloads Docker images from the registry
+while showing what's going on. :py:func:`docker.Client.pull()` blocks until
+the Docker daemon has downloaded all layers of an image and returns the whole
+response (a long list of progress messages) as a single string, which means
+minutes without any feedback for large images. :py:func:`pull_image()`
+instead consumes the progress messages one at a time as they arrive (using a
+constant amount of memory) and reports the progress and throughput of each
+layer (see :py:class:`PullProgress`).
+
+When a download is interrupted (for example because the connection to the
+registry was reset) the pull is started again. The Docker daemon keeps the
+layers it finished downloading so only the interrupted layers are downloaded
+again.
+
+The same API call is used to upload tarballs as new images (see
+:py:func:`import_tarball()`). :py:func:`docker.Client.import_image()` can't be
+used for this because for file-like sources it doesn't pass ``fromSrc=-``,
+so the Docker daemon tries to download the image from an empty URL instead
+of reading the request body.
+"""
+
+# Standard library modules.
+import json
+import socket
+import time
+
+# External dependencies.
+import requests.exceptions
+from humanfriendly import Timer, format_size, format_timespan
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from redock.utils import summarize_id
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The number of times an interrupted download is restarted.
+PULL_RETRIES = 3
+
+# The number of seconds to wait before the first restart (doubled after every
+# failed attempt).
+RETRY_DELAY = 2
+
+# The number of bytes read from the progress stream at once.
+CHUNK_SIZE = 512
+
+# The maximum size of a single progress message (in bytes).
+MAX_MESSAGE_SIZE = 1024 * 64
+
+# The number of seconds between progress reports of a layer.
+PROGRESS_INTERVAL = 5
+
+def pull_image(client, repository, tag, retries=PULL_RETRIES):
+    """
+    Download an image from the Docker registry and report the progress.
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param repository: The name of the image's repository.
+    :param tag: The name of the image's tag.
+    :param retries: The number of times an interrupted download is restarted.
+    :returns: A :py:class:`PullProgress` object.
+    """
+    progress = PullProgress('%s:%s' % (repository, tag))
+    attempt = 0
+    while True:
+        try:
+            for message in stream_pull(client, repository, tag):
+                progress.update(message)
+            break
+        except (PullInterrupted, requests.exceptions.ConnectionError, socket.error), e:
+            if attempt >= retries:
+                msg = "Failed to download %s after %i attempts! (%s)"
+                raise PullFailed, msg % (progress.name, attempt + 1, e)
+            delay = RETRY_DELAY * 2 ** attempt
+            attempt += 1
+            logger.warn("Download of %s was interrupted, retrying in %s! (%s)",
+                        progress.name, format_timespan(delay), e)
+            time.sleep(delay)
+    progress.finish()
+    return progress
+
+def stream_pull(client, repository, tag):
+    """
+    Start downloading an image and get the progress messages of the Docker
+    daemon as they arrive.
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param repository: The name of the image's repository.
+    :param tag: The name of the image's tag.
+    :returns: A generator of dictionaries.
+    """
+    return stream_messages(client, dict(fromImage=repository, tag=tag))
+
+def import_tarball(client, source, repository, tag):
+    """
+    Upload a tarball to the Docker daemon and create an image from it (like
+    ``docker import - repository:tag``).
+
+    Raises :py:exc:`ImportFailed` when the Docker daemon reports an error.
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param source: A file-like object or an iterable of strings with the
+                   (optionally compressed) contents of the tarball. It's
+                   streamed to the Docker daemon, not buffered in memory.
+    :param repository: The name of the image's repository.
+    :param tag: The name of the image's tag.
+    """
+    name = '%s:%s' % (repository, tag)
+    try:
+        for message in stream_messages(client, dict(fromSrc='-', repo=repository, tag=tag), data=source):
+            if message.get('error'):
+                raise ImportFailed, "Failed to import %s! (%s)" % (name, message['error'])
+            logger.debug("%s: %s", name, message.get('status'))
+    except PullInterrupted, e:
+        raise ImportFailed, "Failed to import %s! (%s)" % (name, e)
+
+def stream_messages(client, params, data=None):
+    """
+    Make a request to the ``/images/create`` API call and get the progress
+    messages of the Docker daemon as they arrive.
+
+    :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+    :param params: A dictionary with query string parameters.
+    :param data: The body of the request (optional).
+    :returns: A generator of dictionaries.
+    """
+    url = client._url('/images/create')
+    response = client.post(url, data=data, params=params, stream=True)
+    try:
+        client._raise_for_status(response)
+        for message in iter_json_objects(response.iter_content(CHUNK_SIZE)):
+            yield message
+    finally:
+        if not response._content_consumed:
+            # Don't return a connection with unread data to the pool.
+            connection = getattr(response.raw, '_connection', None)
+            if connection:
+                connection.close()
+        response.close()
+
+def iter_json_objects(chunks):
+    """
+    Decode a stream of concatenated JSON objects (the Docker daemon doesn't
+    always separate progress messages with newlines).
+
+    :param chunks: An iterable of strings.
+    :returns: A generator of decoded objects.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            try:
+                value, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # The object is incomplete (or invalid, see below).
+                break
+            yield value
+            buffer = buffer[end:]
+        if len(buffer) > MAX_MESSAGE_SIZE:
+            raise PullInterrupted, "Invalid progress message from Docker daemon! (%r)" % buffer[:100]
+    if buffer.strip():
+        raise PullInterrupted, "Progress stream ended in the middle of a message!"
+
+class PullProgress(object):
+
+    """
+    Keeps track of the layers of an image that's being downloaded by
+    :py:func:`pull_image()` and reports their progress.
+    """
+
+    def __init__(self, name):
+        """
+        Initialize a :py:class:`PullProgress` object.
+
+        :param name: The name of the image (a string).
+        """
+        self.name = name
+        self.timer = Timer()
+        self.layers = {}
+        self.bytes_downloaded = 0
+        self.elapsed_time = None
+        logger.info("Downloading image %s ..", name)
+
+    def update(self, message):
+        """
+        Process a progress message of the Docker daemon.
+
+        :param message: A dictionary with the keys ``status``, ``id``,
+                        ``progressDetail`` and/or ``error``.
+        """
+        if message.get('error'):
+            error = message['error']
+            if 'not found' in error.lower():
+                raise PullFailed, "Failed to download %s! (%s)" % (self.name, error)
+            raise PullInterrupted, error
+        status = message.get('status', '')
+        if not message.get('id'):
+            logger.verbose("%s: %s", self.name, status)
+            return
+        layer = self.layers.get(message['id'])
+        if layer is None:
+            layer = Layer(message['id'])
+            self.layers[layer.id] = layer
+        detail = message.get('progressDetail') or {}
+        if status == 'Downloading' and 'current' in detail:
+            self.bytes_downloaded += layer.progress(detail['current'], detail.get('total'))
+            if time.time() - layer.reported >= PROGRESS_INTERVAL:
+                layer.reported = time.time()
+                logger.info("%s: %s", self.name, layer)
+        elif status != layer.status:
+            if layer.finished is None and status in ('Download complete', 'Already exists', 'Pull complete'):
+                layer.finished = time.time()
+            logger.verbose("%s: Layer %s: %s", self.name, summarize_id(layer.id), status)
+        layer.status = status
+
+    @property
+    def throughput(self):
+        """
+        The average download speed in bytes per second (a number).
+        """
+        elapsed_time = self.elapsed_time or self.timer.elapsed_time
+        return self.bytes_downloaded / elapsed_time if elapsed_time > 0 else 0
+
+    def finish(self):
+        """
+        Report the time spent on the download (overall and per layer).
+        """
+        self.elapsed_time = self.timer.elapsed_time
+        for layer in sorted(self.layers.values(), key=lambda l: l.started):
+            if layer.size:
+                logger.verbose("%s: Layer %s: %s in %s.", self.name, summarize_id(layer.id),
+                               format_size(layer.size), format_timespan(layer.elapsed_time))
+        logger.info("Finished downloading %s in %s (%i layers, %s at %s/s).",
+                    self.name, format_timespan(self.elapsed_time), len(self.layers),
+                    format_size(self.bytes_downloaded), format_size(self.throughput))
+
+class Layer(object):
+
+    """
+    The download progress of a single layer of an image.
+    """
+
+    def __init__(self, id):
+        """
+        Initialize a :py:class:`Layer` object.
+
+        :param id: The id of the layer (a string).
+        """
+        self.id = id
+        self.status = None
+        self.current = 0
+        self.size = None
+        self.started = time.time()
+        self.finished = None
+        self.reported = self.started
+
+    def progress(self, current, total=None):
+        """
+        Update the number of bytes downloaded.
+
+        :param current: The number of bytes downloaded so far (an integer).
+        :param total: The size of the layer in bytes (an integer or ``None``).
+        :returns: The number of bytes downloaded since the previous update.
+        """
+        # When a download is restarted the counter starts at zero again.
+        delta = current - self.current if current >= self.current else current
+        self.current = current
+        if total:
+            self.size = total
+        return delta
+
+    @property
+    def elapsed_time(self):
+        """
+        The number of seconds spent downloading the layer (a number).
+        """
+        return (self.finished or time.time()) - self.started
+
+    def __str__(self):
+        """
+        Summarize the progress of the layer (used for progress reports).
+        """
+        throughput = self.current / self.elapsed_time if self.elapsed_time > 0 else 0
+        if self.size:
+            return "Layer %s: %s of %s (%i%%, %s/s)" % (summarize_id(self.id), format_size(self.current),
+                                                       format_size(self.size), self.current * 100 / self.size,
+                                                       format_size(throughput))
+        return "Layer %s: %s (%s/s)" % (summarize_id(self.id), format_size(self.current), format_size(throughput))
+
+class PullInterrupted(Exception):
+    """
+    Raised by :py:func:`stream_messages()` and :py:func:`PullProgress.update()`
+    when a download was interrupted (it will be restarted by
+    :py:func:`pull_image()`).
+    """
+
+class PullFailed(Exception):
+    """
+    Raised by :py:func:`pull_image()` when an image can't be downloaded.
+    """
+
+class ImportFailed(Exception):
+    """
+    Raised by :py:func:`import_tarball()` when the Docker daemon fails to
+    create an image from a tarball.
+    """
+
+# vim: ts=4 sw=4 et
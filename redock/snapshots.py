@@ -0,0 +1,288 @@
+# Named checkpoints of containers for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.snapshots` module implements named checkpoints of running
+containers. :py:func:`redock.api.Container.commit()` replaces the image of a
+container, so the only way back to an earlier state is to commit to another
+image by hand. Snapshots instead record any number of checkpoints per
+container which can be restored later:
+
+.. code-block:: sh
+
+   $ redock --snapshot=before-upgrade snapshot test
+   $ redock --snapshot=before-upgrade restore test
+
+Restoring a snapshot replaces the running container with a fresh container
+created from the snapshot. The new container is bound to the same SSH port
+on the host system, so the SSH client configuration (and e.g. the host key
+cache of tools that ignore it) stays valid.
+
+Snapshots are committed as images in the ``redock-snapshots`` repository and
+tracked in the runtime configuration (see :py:class:`redock.utils.Config`) in
+the namespace ``snapshots``. Only the most recent snapshots of each container
+are kept (10 by default, see ``$REDOCK_SNAPSHOT_RETENTION``); older snapshot
+images are removed automatically. Because every container restored from a
+snapshot adds another layer on top of the snapshot's image, snapshots whose
+image has too many layers are squashed into a single layer (AUFS supports
+only 42 layers per image).
+"""
+
+# Standard library modules.
+import json
+import os
+import time
+
+# External dependencies.
+from humanfriendly import Timer
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from redock.pull import import_tarball
+from redock.utils import slug, summarize_id
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The repository of the images created for snapshots.
+SNAPSHOT_REPO = 'redock-snapshots'
+
+# The default number of snapshots kept per container.
+SNAPSHOT_RETENTION = 10
+
+# Snapshots with more layers than this are squashed into a single layer.
+SNAPSHOT_MAX_LAYERS = 30
+
+# The number of bytes copied at once while squashing images.
+SQUASH_CHUNK_SIZE = 1024 * 64
+
+class SnapshotManager(object):
+
+    """
+    The snapshots of a single :py:class:`redock.api.Container`.
+    """
+
+    def __init__(self, container, retention=None):
+        """
+        Initialize a :py:class:`SnapshotManager`.
+
+        :param container: The :py:class:`redock.api.Container` whose snapshots
+                          should be managed.
+        :param retention: The number of snapshots to keep (defaults to
+                          ``$REDOCK_SNAPSHOT_RETENTION`` or 10).
+        """
+        if retention is None:
+            retention = int(os.environ.get('REDOCK_SNAPSHOT_RETENTION', SNAPSHOT_RETENTION))
+        if retention < 1:
+            msg = "The number of snapshots to keep should be a positive integer! (got %r)"
+            raise ValueError, msg % retention
+        self.container = container
+        self.retention = retention
+        self.logger = logger
+
+    @property
+    def key(self):
+        """
+        Get a tuple with the repository and tag of the container's image (used
+        as the key in the runtime configuration).
+        """
+        return self.container.image.key
+
+    def list(self):
+        """
+        Get the snapshots of the container.
+
+        :returns: A list of dictionaries with the keys ``name``, ``tag``,
+                  ``image_id``, ``created`` and ``message`` (oldest first).
+        """
+        return self.container.config.get('snapshots', self.key, [])
+
+    def find(self, name=None):
+        """
+        Find a snapshot by name.
+
+        Raises :py:exc:`UnknownSnapshot` when no matching snapshot exists.
+
+        :param name: The name of the snapshot (defaults to the most recent
+                     snapshot).
+        :returns: A dictionary like the ones returned by :py:func:`list()`.
+        """
+        snapshots = self.list()
+        if name is None and snapshots:
+            return snapshots[-1]
+        for snapshot in snapshots:
+            if snapshot['name'] == name:
+                return snapshot
+        if name is None:
+            msg = "Container %s doesn't have any snapshots!"
+            raise UnknownSnapshot, msg % self.container.image.name
+        msg = "Container %s doesn't have a snapshot named %r! (available snapshots: %s)"
+        raise UnknownSnapshot, msg % (self.container.image.name, name,
+                                      ', '.join(s['name'] for s in snapshots) or 'none')
+
+    def create(self, name=None, message=None):
+        """
+        Commit the running container as a new snapshot. An existing snapshot
+        with the same name is replaced. Afterwards snapshots beyond the
+        retention limit are removed (see :py:func:`prune()`).
+
+        Raises :py:exc:`redock.api.NoContainerRunning` if the container isn't
+        running.
+
+        :param name: The name of the snapshot (defaults to a timestamp).
+        :param message: A short message describing the snapshot (a string).
+        :returns: A dictionary like the ones returned by :py:func:`list()`.
+        """
+        self.container.check_active()
+        name = name or time.strftime('%Y%m%d-%H%M%S')
+        tag = slug('%s-%s-%s' % (self.container.image.repository, self.container.image.tag, name))
+        snapshot_timer = Timer()
+        self.logger.info("Creating snapshot %r of %s ..", name, self.container.image.name)
+        result = self.container.client.commit(self.container.session.container_id,
+                                              repository=SNAPSHOT_REPO, tag=tag,
+                                              message=message or name)
+        # Docker accepts the short id so there's no need to list all images.
+        image_id = result['Id']
+        layers = len(json.loads(self.container.client.history(image_id)))
+        if layers > SNAPSHOT_MAX_LAYERS:
+            try:
+                image_id = self.squash(image_id, tag, layers)
+            except Exception:
+                # The snapshot isn't recorded, so don't leave its image behind.
+                self.remove_image(dict(name=name, image_id=image_id))
+                self.container.inventory.invalidate(containers=False)
+                raise
+        snapshot = dict(name=name, tag=tag, image_id=image_id, created=time.time(), message=message)
+        config = self.container.config
+        with config.transaction():
+            snapshots = config.get('snapshots', self.key, [])
+            replaced = [s for s in snapshots if s['name'] == name]
+            config.set('snapshots', self.key, [s for s in snapshots if s['name'] != name] + [snapshot])
+        for old_snapshot in replaced:
+            if old_snapshot['image_id'] != image_id:
+                self.remove_image(old_snapshot)
+        self.container.inventory.invalidate(containers=False)
+        self.logger.info("Created snapshot %r (%s) in %s.", name, summarize_id(image_id), snapshot_timer)
+        self.prune()
+        return snapshot
+
+    def restore(self, name=None):
+        """
+        Replace the running container (if any) with a fresh container created
+        from a snapshot. The new container reuses the SSH port of the old
+        container (so the SSH client configuration doesn't change).
+
+        Raises :py:exc:`UnknownSnapshot` when no matching snapshot exists.
+
+        :param name: The name of the snapshot (defaults to the most recent
+                     snapshot).
+        """
+        snapshot = self.find(name)
+        restore_timer = Timer()
+        self.logger.info("Restoring snapshot %r of %s ..", snapshot['name'], self.container.image.name)
+        # Imported here to avoid a circular import.
+        from redock.api import Image
+        host_port = None
+        self.container.inventory.invalidate()
+        if self.container.find_container():
+            host_port = int(self.container.client.port(self.container.session.container_id, '22'))
+            self.container.kill(revoke_ssh=False)
+        self.container.session.custom_image = Image(repository=SNAPSHOT_REPO,
+                                                    tag=snapshot['tag'],
+                                                    id=snapshot['image_id'])
+        self.container.start_supervisor(host_port=host_port)
+        self.container.setup_ssh_access()
+        self.logger.info("Restored snapshot %r in %s.", snapshot['name'], restore_timer)
+
+    def prune(self):
+        """
+        Remove the oldest snapshots until at most :py:attr:`retention`
+        snapshots remain. Snapshots whose image can't be removed (for example
+        because a running container was created from it) are kept until the
+        next time :py:func:`prune()` is called.
+
+        :returns: The number of snapshots that were removed.
+        """
+        config = self.container.config
+        with config.transaction():
+            snapshots = config.get('snapshots', self.key, [])
+            surplus = snapshots[:max(0, len(snapshots) - self.retention)]
+        removed = [s for s in surplus if self.remove_image(s)]
+        if removed:
+            with config.transaction():
+                names = set(s['name'] for s in removed)
+                config.set('snapshots', self.key, [s for s in config.get('snapshots', self.key, [])
+                                                   if s['name'] not in names])
+            self.container.inventory.invalidate(containers=False)
+            self.logger.info("Removed %i old snapshot(s) of %s.", len(removed), self.container.image.name)
+        return len(removed)
+
+    def remove_image(self, snapshot):
+        """
+        Remove the image of a snapshot.
+
+        :param snapshot: A dictionary like the ones returned by :py:func:`list()`.
+        :returns: ``True`` if the image was removed (or no longer exists),
+                  ``False`` otherwise.
+        """
+        self.logger.verbose("Removing image of snapshot %r (%s) ..", snapshot['name'],
+                            summarize_id(snapshot['image_id']))
+        try:
+            self.container.client.remove_image(snapshot['image_id'])
+            return True
+        except Exception, e:
+            if getattr(getattr(e, 'response', None), 'status_code', None) == 404:
+                return True
+            self.logger.verbose("Keeping image of snapshot %r for now! (%s)", snapshot['name'], e)
+            return False
+
+    def squash(self, image_id, tag, layers):
+        """
+        Replace an image by a copy that consists of a single layer. The file
+        system of the image is streamed from ``docker export`` to ``docker
+        import`` without being buffered in memory or on disk.
+
+        :param image_id: The id of the image to squash (a string).
+        :param tag: The tag of the image in the ``redock-snapshots``
+                    repository (a string).
+        :param layers: The number of layers of the image (an integer).
+        :returns: The id of the squashed image (a string).
+        """
+        client = self.container.client
+        squash_timer = Timer()
+        self.logger.info("Squashing %i layers of snapshot image %s ..", layers, summarize_id(image_id))
+        result = client.create_container(image=image_id, command='true')
+        try:
+            stream = client.export(result['Id'])
+            def chunks():
+                while True:
+                    chunk = stream.read(SQUASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            import_tarball(client, chunks(), SNAPSHOT_REPO, tag)
+        finally:
+            client.remove_container(result['Id'])
+        self.container.inventory.invalidate(containers=False)
+        squashed_image = self.container.inventory.find_image(SNAPSHOT_REPO, tag)
+        if not squashed_image:
+            msg = "Docker didn't create the image %s:%s while squashing %s!"
+            raise Exception, msg % (SNAPSHOT_REPO, tag, summarize_id(image_id))
+        try:
+            client.remove_image(image_id)
+        except Exception, e:
+            self.logger.verbose("Failed to remove unsquashed image %s! (%s)", summarize_id(image_id), e)
+        self.logger.verbose("Squashed snapshot image in %s.", squash_timer)
+        return squashed_image['Id']
+
+class UnknownSnapshot(Exception):
+    """
+    Raised by :py:func:`SnapshotManager.find()` and
+    :py:func:`SnapshotManager.restore()` when the requested snapshot doesn't
+    exist.
+    """
+
+# vim: ts=4 sw=4 et
@@ -0,0 +1,428 @@
+# Declarative configuration management on top of Bootstrap.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.tasks` module makes it possible to describe the
+configuration of a host as a graph of tasks instead of a sequence of
+:py:class:`redock.bootstrap.Bootstrap` method calls:
+
+>>> from redock.bootstrap import Bootstrap
+>>> from redock.tasks import Command, Directory, File, Package, Rsync
+>>> bootstrap = Bootstrap('redock:web')
+>>> bootstrap.apply([
+...   Package('nginx', packages=['nginx']),
+...   Directory('webroot', pathname='/srv/www'),
+...   Rsync('site', local_directory='site', remote_directory='/srv/www', requires=['webroot']),
+...   File('vhost', pathname='/etc/nginx/sites-enabled/site', contents=vhost, requires=['nginx']),
+...   Command('reload', command=['service', 'nginx', 'reload'], requires=['vhost', 'site']),
+... ])
+
+Tasks whose dependencies have finished are executed in parallel (using a
+:py:class:`redock.parallel.WorkerPool` on top of the connection shared by all
+:py:class:`redock.bootstrap.Bootstrap` objects for the host). Each task has a
+fingerprint of its inputs; the fingerprints of successful tasks are stored on
+the remote host in ``/var/lib/redock/tasks.json``. On the next run tasks whose
+fingerprint didn't change are skipped, unless one of their dependencies
+changed during the run.
+"""
+
+# Standard library modules.
+import hashlib
+import json
+import os
+import pipes
+import threading
+
+# External dependencies.
+from humanfriendly import Timer
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from redock.parallel import DEFAULT_CONCURRENCY, WorkerPool
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The absolute pathname of the file on the remote host with the fingerprints of
+# the tasks that were previously applied.
+TASK_STATE_FILE = '/var/lib/redock/tasks.json'
+
+class Task(object):
+
+    """
+    Base class for tasks. Subclasses implement :py:func:`inputs()` and
+    :py:func:`apply()`.
+    """
+
+    def __init__(self, name, requires=()):
+        """
+        Initialize a :py:class:`Task`.
+
+        :param name: The unique name of the task (a string).
+        :param requires: The names of the tasks (or the :py:class:`Task`
+                         objects) that have to be applied before this task.
+        """
+        self.name = name
+        self.requires = [getattr(t, 'name', t) for t in requires]
+
+    def inputs(self):
+        """
+        Get the inputs of the task that determine whether it has to be applied
+        again.
+
+        :returns: A value that can be serialized to JSON.
+        """
+        raise NotImplementedError
+
+    def fingerprint(self):
+        """
+        Get the fingerprint of the task (a SHA1 hash of its class and inputs).
+        """
+        value = json.dumps([self.__class__.__name__, self.inputs()], sort_keys=True)
+        return hashlib.sha1(value).hexdigest()
+
+    def apply(self, bootstrap):
+        """
+        Apply the task to a remote host.
+
+        :param bootstrap: A :py:class:`redock.bootstrap.Bootstrap` object.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        """
+        Get a human readable representation of the task.
+        """
+        return "%s(%r)" % (self.__class__.__name__, self.name)
+
+class Package(Task):
+
+    """
+    Install system packages (see :py:func:`redock.bootstrap.Bootstrap.install_packages()`).
+    """
+
+    def __init__(self, name, packages, requires=()):
+        """
+        :param packages: The names of the packages (a list of strings).
+        """
+        super(Package, self).__init__(name, requires)
+        self.packages = list(packages)
+
+    def inputs(self):
+        return sorted(self.packages)
+
+    def apply(self, bootstrap):
+        bootstrap.install_packages(*self.packages)
+
+class File(Task):
+
+    """
+    Create a file (see :py:func:`redock.bootstrap.Bootstrap.upload_file()`).
+    """
+
+    def __init__(self, name, pathname, contents, requires=()):
+        """
+        :param pathname: The absolute pathname on the remote host (a string).
+        :param contents: The contents of the file (a string).
+        """
+        super(File, self).__init__(name, requires)
+        self.pathname = pathname
+        self.contents = contents
+
+    def inputs(self):
+        return [self.pathname, hashlib.sha1(self.contents).hexdigest()]
+
+    def apply(self, bootstrap):
+        bootstrap.upload_file(self.pathname, self.contents)
+
+class Directory(Task):
+
+    """
+    Create a directory.
+    """
+
+    def __init__(self, name, pathname, mode=0755, requires=()):
+        """
+        :param pathname: The absolute pathname on the remote host (a string).
+        :param mode: The permissions of the directory (an integer).
+        """
+        super(Directory, self).__init__(name, requires)
+        self.pathname = pathname
+        self.mode = mode
+
+    def inputs(self):
+        return [self.pathname, self.mode]
+
+    def apply(self, bootstrap):
+        bootstrap.execute('mkdir', '-p', '-m', '%o' % self.mode, pipes.quote(self.pathname))
+        bootstrap.execute('chmod', '%o' % self.mode, pipes.quote(self.pathname))
+
+class Rsync(Task):
+
+    """
+    Copy a directory to the remote host (see :py:func:`redock.bootstrap.Bootstrap.rsync()`).
+    The task is applied again when the names, sizes or modification times of
+    the files in the local directory change.
+    """
+
+    def __init__(self, name, local_directory, remote_directory, cvs_exclude=True, delete=True, requires=()):
+        """
+        :param local_directory: The pathname of the directory on the host.
+        :param remote_directory: The pathname of the directory on the remote host.
+        :param cvs_exclude: Exclude version control files (enabled by default).
+        :param delete: Delete remote files that don't exist locally (enabled by default).
+        """
+        super(Rsync, self).__init__(name, requires)
+        self.local_directory = local_directory
+        self.remote_directory = remote_directory
+        self.cvs_exclude = cvs_exclude
+        self.delete = delete
+
+    def inputs(self):
+        context = hashlib.sha1()
+        for root, dirs, files in os.walk(self.local_directory):
+            dirs.sort()
+            for filename in sorted(files):
+                pathname = os.path.join(root, filename)
+                stat = os.lstat(pathname)
+                context.update('%s %i %i\n' % (os.path.relpath(pathname, self.local_directory),
+                                               stat.st_size, stat.st_mtime))
+        return [os.path.abspath(self.local_directory), self.remote_directory,
+                self.cvs_exclude, self.delete, context.hexdigest()]
+
+    def apply(self, bootstrap):
+        bootstrap.rsync(self.local_directory, self.remote_directory,
+                        cvs_exclude=self.cvs_exclude, delete=self.delete)
+
+class Command(Task):
+
+    """
+    Execute a remote command (see :py:func:`redock.bootstrap.Bootstrap.execute()`).
+    Because the effects of a command are unknown, the command is only executed
+    again when the command line or the given inputs change (or when one of its
+    dependencies changed) unless ``always`` is ``True``.
+    """
+
+    def __init__(self, name, command, inputs=None, always=False, requires=()):
+        """
+        :param command: The remote command and its arguments (a list of strings).
+        :param inputs: Extra inputs for the fingerprint (any value that can be
+                       serialized to JSON).
+        :param always: ``True`` to execute the command on every run.
+        """
+        super(Command, self).__init__(name, requires)
+        self.command = list(command)
+        self.extra_inputs = inputs
+        self.always = always
+
+    def inputs(self):
+        return [self.command, self.extra_inputs]
+
+    def fingerprint(self):
+        return None if self.always else super(Command, self).fingerprint()
+
+    def apply(self, bootstrap):
+        bootstrap.execute(*self.command)
+
+class TaskEngine(object):
+
+    """
+    Applies a graph of :py:class:`Task` objects to a remote host.
+    """
+
+    def __init__(self, bootstrap, tasks, concurrency=DEFAULT_CONCURRENCY, state_file=TASK_STATE_FILE):
+        """
+        Initialize a :py:class:`TaskEngine`.
+
+        Raises :py:exc:`InvalidTaskGraph` when task names aren't unique, when
+        tasks depend on unknown tasks or when the dependencies contain a cycle.
+
+        :param bootstrap: A :py:class:`redock.bootstrap.Bootstrap` object.
+        :param tasks: An iterable of :py:class:`Task` objects.
+        :param concurrency: The maximum number of tasks to apply at the same time.
+        :param state_file: The pathname of the file on the remote host with
+                           the fingerprints of previously applied tasks.
+        """
+        self.logger = logger
+        self.bootstrap = bootstrap
+        self.tasks = list(tasks)
+        self.concurrency = concurrency
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.check_graph()
+
+    def check_graph(self):
+        """
+        Validate the task graph (see :py:class:`TaskEngine`).
+        """
+        names = set()
+        for task in self.tasks:
+            if task.name in names:
+                raise InvalidTaskGraph, "Duplicate task name %r!" % task.name
+            names.add(task.name)
+        for task in self.tasks:
+            for name in task.requires:
+                if name not in names:
+                    raise InvalidTaskGraph, "Task %r depends on unknown task %r!" % (task.name, name)
+        # Kahn's algorithm: If we can't order all tasks there's a cycle.
+        remaining = dict((t.name, set(t.requires)) for t in self.tasks)
+        while remaining:
+            ready = [n for n, r in remaining.items() if not r]
+            if not ready:
+                raise InvalidTaskGraph, "Dependency cycle between tasks: %s" % ', '.join(sorted(remaining))
+            for name in ready:
+                del remaining[name]
+            for requires in remaining.values():
+                requires.difference_update(ready)
+
+    def run(self):
+        """
+        Apply the tasks. Independent tasks are applied in parallel. When a task
+        fails the tasks that depend on it are skipped, other tasks are still
+        applied.
+
+        Raises :py:exc:`TasksFailed` when any of the tasks failed (after
+        saving the state of the tasks that succeeded).
+
+        :returns: A dictionary that maps task names to one of the strings
+                  ``changed``, ``unchanged``, ``failed`` or ``skipped``.
+        """
+        interactive = self.bootstrap.interactive
+        try:
+            # Concurrent commands can't share the terminal.
+            self.bootstrap.interactive = False
+            return self.run_tasks()
+        finally:
+            self.bootstrap.interactive = interactive
+
+    def run_tasks(self):
+        """
+        Apply the tasks (called by :py:func:`run()`).
+        """
+        timer = Timer()
+        self.logger.info("%s: Applying %i tasks ..", self.bootstrap.ssh_alias, len(self.tasks))
+        state = self.load_state()
+        results = {}
+        remaining = dict((t.name, set(t.requires)) for t in self.tasks)
+        dependents = dict((t.name, []) for t in self.tasks)
+        for task in self.tasks:
+            for name in task.requires:
+                dependents[name].append(task)
+        all_done = threading.Event()
+        with WorkerPool(concurrency=self.concurrency) as pool:
+            def submit(task):
+                job = pool.submit(self.run_task, task, state, results)
+                job.add_callback(lambda job: finished(task, job))
+            def finished(task, job):
+                ready = []
+                with self.lock:
+                    if not job.succeeded:
+                        # Programming error in run_task()?
+                        results[task.name] = 'failed'
+                    for dependent in dependents[task.name]:
+                        remaining[dependent.name].discard(task.name)
+                        if not remaining[dependent.name]:
+                            ready.append(dependent)
+                    if len(results) == len(self.tasks):
+                        all_done.set()
+                for dependent in ready:
+                    submit(dependent)
+            roots = [t for t in self.tasks if not t.requires]
+            if not roots:
+                all_done.set()
+            for task in roots:
+                submit(task)
+            # Event.wait() without a timeout can't be interrupted by Control-C.
+            while not all_done.is_set():
+                all_done.wait(1)
+        changed = [n for n, r in results.items() if r == 'changed']
+        if changed:
+            self.save_state(state)
+        counts = dict((r, results.values().count(r)) for r in ('changed', 'unchanged', 'failed', 'skipped'))
+        self.logger.info("%s: Applied tasks in %s (%i changed, %i unchanged, %i failed, %i skipped).",
+                         self.bootstrap.ssh_alias, timer, counts['changed'], counts['unchanged'],
+                         counts['failed'], counts['skipped'])
+        failed = sorted(n for n, r in results.items() if r == 'failed')
+        if failed:
+            msg = "%s: The following tasks failed: %s"
+            raise TasksFailed, msg % (self.bootstrap.ssh_alias, ', '.join(failed))
+        return results
+
+    def run_task(self, task, state, results):
+        """
+        Apply a single task (called by the worker threads started by :py:func:`run()`).
+
+        :param task: A :py:class:`Task` object.
+        :param state: The dictionary with fingerprints from the remote host.
+        :param results: The dictionary with the results of the current run.
+        """
+        with self.lock:
+            statuses = [results[name] for name in task.requires]
+        if any(s in ('failed', 'skipped') for s in statuses):
+            self.logger.warn("%s: Skipping task %s because a dependency failed.",
+                             self.bootstrap.ssh_alias, task.name)
+            status = 'skipped'
+        else:
+            fingerprint = task.fingerprint()
+            if fingerprint and fingerprint == state.get(task.name) and 'changed' not in statuses:
+                self.logger.verbose("%s: Task %s is unchanged.", self.bootstrap.ssh_alias, task.name)
+                status = 'unchanged'
+            else:
+                self.logger.info("%s: Applying task %s ..", self.bootstrap.ssh_alias, task.name)
+                try:
+                    task.apply(self.bootstrap)
+                    status = 'changed'
+                except Exception, e:
+                    self.logger.error("%s: Task %s failed! (%s)", self.bootstrap.ssh_alias, task.name, e)
+                    fingerprint = None
+                    status = 'failed'
+                with self.lock:
+                    if fingerprint:
+                        state[task.name] = fingerprint
+                    else:
+                        state.pop(task.name, None)
+        with self.lock:
+            results[task.name] = status
+
+    def load_state(self):
+        """
+        Load the fingerprints of previously applied tasks from the remote host.
+
+        :returns: A dictionary that maps task names to fingerprints.
+        """
+        def remote_function(channel, pathname):
+            """
+            Pure function that's executed remotely to read the state file.
+            """
+            import os
+            if os.path.isfile(pathname):
+                handle = open(pathname)
+                channel.send(handle.read())
+                handle.close()
+            else:
+                channel.send('')
+        contents = self.bootstrap.gateway.remote_exec(remote_function, pathname=self.state_file).receive()
+        return json.loads(contents) if contents else {}
+
+    def save_state(self, state):
+        """
+        Save the fingerprints of the applied tasks on the remote host.
+
+        :param state: A dictionary that maps task names to fingerprints.
+        """
+        self.bootstrap.upload_file(self.state_file, json.dumps(state, indent=2, sort_keys=True))
+
+class InvalidTaskGraph(Exception):
+    """
+    Raised by :py:class:`TaskEngine` when the task graph is invalid.
+    """
+
+class TasksFailed(Exception):
+    """
+    Raised by :py:func:`TaskEngine.run()` when one or more tasks failed.
+    """
+
+# vim: ts=4 sw=4 et
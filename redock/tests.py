@@ -1,20 +1,73 @@
 # Tests for Redock.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: September 30, 2013
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-redock
 
 # Standard library modules.
+import BaseHTTPServer
+import gzip
+import hashlib
+import json
 import logging
+import os
+import pickle
 import pipes
+import shlex
+import shutil
+import socket
+import SocketServer
+import StringIO
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
 
 # External dependencies.
 import coloredlogs
+import docker
+import execnet
+import update_dotdee
 
 # Modules included in our package.
-from redock.api import Container, Image
+from redock.api import AsyncContainer, Container, Image, Session
+from redock.aptcache import (APT_CONFIG_LINK, APT_LINK_COMMAND, CONTAINER_CACHE_DIR,
+                             CONTAINER_CONFIG_DIR, CONTAINER_CONFIG_FILE, PackageCache,
+                             PackageCacheMissing)
+from redock.attach import OutputMultiplexer, multiplexer
+from redock.base import (BASE_EXPORT_PATTERN, BUILD_HOSTNAME, SUPERVISOR_COMMAND,
+                         SUPERVISOR_CONFIG, CorruptTarball, download_image, export_base_image,
+                         find_base_image, find_base_tarballs, get_build_stages,
+                         import_base_image, run_build_stages)
+from redock.bootstrap import (Bootstrap, ConnectionPool, ExternalCommandFailed,
+                              Fleet, FleetError, connection_pool)
+from redock.client import ClientFactory
+from redock.daemon import Daemon, DaemonClient, DaemonError
+from redock.garbage import GarbageCollector
+from redock.inventory import AmbiguousId, Inventory, PrefixIndex, UnknownId
+from redock.mirrors import rank_mirrors, select_mirror
+from redock.parallel import WorkerPool, run_concurrently
+from redock.pull import ImportFailed, PullFailed, iter_json_objects, pull_image
+from redock.snapshots import SNAPSHOT_REPO, SnapshotManager, UnknownSnapshot
+from redock.tasks import (Command, Directory, File, InvalidTaskGraph,
+                          TaskEngine, TasksFailed)
+from redock.utils import Config, SecureShellConfig, wait_for_ssh_banner
+from redock.warmpool import WarmPool
+
+# Modules that shouldn't be imported by the redock program until it actually
+# needs them (because they're slow to import).
+HEAVY_MODULES = ('docker', 'execnet', 'netifaces', 'redock.api', 'requests', 'update_dotdee')
+
+# The maximum number of seconds that `import redock.cli' is allowed to take
+# (generous because the tests may run on slow or busy machines; can be
+# overridden using the environment variable $REDOCK_IMPORT_TIME_BUDGET).
+IMPORT_TIME_BUDGET = float(os.environ.get('REDOCK_IMPORT_TIME_BUDGET', '1.0'))
+
+# Initialize a logger for this module.
+logger = logging.getLogger(__name__)
 
 class RedockTestCase(unittest.TestCase):
 
@@ -22,6 +75,22 @@ class RedockTestCase(unittest.TestCase):
         coloredlogs.install()
         coloredlogs.set_level(logging.DEBUG)
 
+    def tearDown(self):
+        # Don't leave the threads of the shared multiplexer running (they're
+        # started by tests that attach to containers).
+        multiplexer.stop()
+
+    def test_import_time(self):
+        seconds, modules = measure_import_time('redock.cli')
+        logger.info("Importing redock.cli took %.3f seconds (budget is %.3f seconds).",
+                    seconds, IMPORT_TIME_BUDGET)
+        self.assertTrue('redock.cli' in modules)
+        for name in HEAVY_MODULES:
+            self.assertFalse(name in modules, "redock.cli imports %s!" % name)
+        self.assertTrue(seconds < IMPORT_TIME_BUDGET,
+                        "Importing redock.cli took %.3f seconds! (budget is %.3f seconds)"
+                        % (seconds, IMPORT_TIME_BUDGET))
+
     def test_image_coercion(self):
         image = Image.coerce('redock:test')
         self.assertEqual(image.repository, 'redock')
@@ -30,6 +99,1047 @@ class RedockTestCase(unittest.TestCase):
         self.assertEqual(image.name, 'redock:test')
         self.assertEqual(image.unique_name, 'redock:test')
 
+    def test_config(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # Create a runtime configuration in the format of older versions.
+            pickle_file = os.path.join(directory, 'state.pickle')
+            with open(pickle_file, 'w') as handle:
+                pickle.dump(dict(version=1, containers={('redock', 'test'): 'abc'}), handle)
+            config = Config(os.path.join(directory, 'state.sqlite3'))
+            self.assertEqual(config.get('containers', ('redock', 'test')), 'abc')
+            self.assertFalse(os.path.exists(pickle_file))
+            # Test atomic updates.
+            try:
+                with config.transaction():
+                    config.set('containers', ('redock', 'test'), 'def')
+                    raise Exception
+            except Exception:
+                pass
+            self.assertEqual(config.get('containers', ('redock', 'test')), 'abc')
+            with config.transaction():
+                config.delete('containers', ('redock', 'test'))
+                config.set('containers', ('redock', 'other'), 'ghi')
+            self.assertEqual(config.items('containers'), [(('redock', 'other'), 'ghi')])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ssh_config(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pathname = os.path.join(directory, 'config')
+            with open(pathname, 'w') as handle:
+                handle.write('Host example\n')
+            ssh_config = SecureShellConfig(pathname)
+            with ssh_config.batch():
+                ssh_config.update_fragment('redock:a', 'Host a\n')
+                ssh_config.update_fragment('redock:b', 'Host b\n')
+                # Nothing is merged until the batch ends.
+                self.assertFalse(os.path.exists(pathname))
+            contents = open(pathname).read()
+            self.assertTrue('Host example' in contents)
+            self.assertTrue('Host a' in contents and 'Host b' in contents)
+            # Unchanged fragments don't cause ~/.ssh/config to be rewritten.
+            os.utime(pathname, (0, 0))
+            ssh_config.update_fragment('redock:a', 'Host a\n')
+            self.assertEqual(os.path.getmtime(pathname), 0)
+            ssh_config.remove_fragment('redock:b')
+            self.assertFalse('Host b' in open(pathname).read())
+            # Changes that cancel out within a batch don't rewrite the file.
+            os.utime(pathname, (0, 0))
+            with ssh_config.batch():
+                ssh_config.remove_fragment('redock:a')
+                ssh_config.update_fragment('redock:a', 'Host a\n')
+            self.assertEqual(os.path.getmtime(pathname), 0)
+            # Updates made by worker threads (like `redock --jobs=N start')
+            # are merged once, at the end of the batch.
+            merges = []
+            original_update = update_dotdee.UpdateDotDee.update_file
+            def counting_update(self, *args, **kw):
+                merges.append(self.filename)
+                return original_update(self, *args, **kw)
+            update_dotdee.UpdateDotDee.update_file = counting_update
+            try:
+                with ssh_config.batch(), WorkerPool(concurrency=5) as pool:
+                    for i in range(20):
+                        pool.submit(ssh_config.update_fragment, 'redock:worker-%i' % i, 'Host worker-%i\n' % i)
+                    pool.submit(ssh_config.remove_fragment, 'redock:a')
+            finally:
+                update_dotdee.UpdateDotDee.update_file = original_update
+            self.assertEqual(merges, [pathname])
+            contents = open(pathname).read()
+            self.assertTrue(all('Host worker-%i\n' % i in contents for i in range(20)))
+            self.assertFalse('Host a' in contents)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_package_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pathname = os.path.join(directory, 'apt-cache')
+            config_directory = os.path.join(directory, 'apt-config')
+            # Without a cache packages are downloaded as usual.
+            cache = PackageCache(pathname, offline=False, config_directory=config_directory)
+            self.assertFalse(cache.enabled)
+            self.assertEqual(cache.volumes.keys(), [CONTAINER_CONFIG_DIR])
+            empty_config = cache.write_apt_config()
+            self.assertEqual(cache.binds, {empty_config: CONTAINER_CONFIG_DIR})
+            self.assertEqual(open(os.path.join(empty_config, 'redock.conf')).read(), '')
+            self.assertEqual(cache.update_commands(), ['apt-get update'])
+            self.assertEqual(cache.clean_commands(), ['apt-get clean'])
+            # Offline mode without a cache only fails when packages are needed.
+            cache = PackageCache(pathname, offline=True, config_directory=config_directory)
+            self.assertRaises(PackageCacheMissing, cache.update_commands)
+            self.assertRaises(PackageCacheMissing, getattr, cache, 'binds')
+            # In offline mode only the cache is used.
+            os.mkdir(pathname)
+            cache = PackageCache(pathname, proxy='http://localhost:3142', offline=True, config_directory=config_directory)
+            cache_config = cache.write_apt_config()
+            self.assertNotEqual(cache_config, empty_config)
+            self.assertEqual(cache.binds, {pathname: CONTAINER_CACHE_DIR, cache_config: CONTAINER_CONFIG_DIR})
+            self.assertTrue(os.path.isdir(os.path.join(pathname, 'archives', 'partial')))
+            contents = open(os.path.join(cache_config, 'redock.conf')).read()
+            self.assertTrue('Acquire::http::Proxy "http://localhost:3142";' in contents)
+            self.assertTrue('APT::Get::Download "false";' in contents)
+            # The host specific configuration is never baked into images.
+            commands = ' '.join(command for stage, command in get_build_stages(cache))
+            self.assertFalse('Acquire::http::Proxy' in commands)
+            self.assertFalse('Dir::Cache' in commands)
+            self.assertTrue(APT_CONFIG_LINK in commands)
+            self.assertFalse('apt-get update' in cache.update_commands())
+            self.assertEqual(cache.clean_commands(), [])
+            # A container started without the configuration (e.g. from a base
+            # image imported on another host) doesn't keep a dangling link.
+            root = os.path.join(directory, 'root')
+            os.makedirs(root + os.path.dirname(APT_CONFIG_LINK))
+            os.symlink(CONTAINER_CONFIG_FILE, root + APT_CONFIG_LINK)
+            link_command = APT_LINK_COMMAND.replace('/etc/', root + '/etc/')
+            subprocess.check_call(['bash', '-c', link_command])
+            self.assertFalse(os.path.lexists(root + APT_CONFIG_LINK))
+            # When the configuration is mounted the link is created.
+            os.makedirs(root + CONTAINER_CONFIG_DIR)
+            open(root + CONTAINER_CONFIG_FILE, 'w').close()
+            subprocess.check_call(['bash', '-c', link_command])
+            self.assertEqual(os.readlink(root + APT_CONFIG_LINK), root + CONTAINER_CONFIG_FILE)
+            # The link is checked whenever a container starts its supervisor.
+            program = SUPERVISOR_CONFIG.split('[program:apt-config]')[1]
+            command = [l for l in program.splitlines() if l.startswith('command = ')][0]
+            self.assertEqual(shlex.split(command[len('command = '):]), ['bash', '-c', APT_LINK_COMMAND])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_connection_pool(self):
+        import redock.bootstrap
+        pool = ConnectionPool()
+        connection = pool.get('redock:test')
+        self.assertTrue(pool.get('redock:test') is connection)
+        self.assertFalse(pool.get('redock:other') is connection)
+        self.assertTrue('ControlPath=%s' % connection.control_path in connection.ssh_options)
+        # The gateway uses the master connection through a generated SSH
+        # client configuration, so the SSH alias is passed to ssh as a
+        # single argument (which is all that execnet 1.1 supports).
+        directory = tempfile.mkdtemp()
+        saved_paths = (redock.bootstrap.REDOCK_CONFIG_DIR, redock.bootstrap.SSH_CONFIG_FILE)
+        try:
+            redock.bootstrap.REDOCK_CONFIG_DIR = directory
+            redock.bootstrap.SSH_CONFIG_FILE = os.path.join(directory, 'config')
+            with open(redock.bootstrap.SSH_CONFIG_FILE, 'w') as handle:
+                handle.write('Host redock:test\n  Port 2222\n')
+            arguments = execnet.gateway_io.ssh_args(execnet.XSpec(connection.gateway_spec))
+            self.assertEqual(arguments[:5], ['ssh', '-C', '-F', connection.ssh_config_file, 'redock:test'])
+            self.assertEqual(len(arguments), 6)
+            with open(connection.ssh_config_file) as handle:
+                contents = handle.read()
+            self.assertTrue('ControlPath %s' % connection.control_path in contents)
+            self.assertTrue(contents.index('ControlMaster auto') < contents.index('Port 2222'))
+        finally:
+            redock.bootstrap.REDOCK_CONFIG_DIR, redock.bootstrap.SSH_CONFIG_FILE = saved_paths
+            shutil.rmtree(directory)
+        # Run commands through a local gateway instead of one over SSH.
+        connection.cached_gateway = execnet.makegateway('popen')
+        try:
+            self.assertEqual(connection.execute('true'), 0)
+            self.assertEqual(connection.execute('sh', '-c', 'read line && exit $line', input='3\n'), 3)
+            self.assertTrue('dpkg' in connection.get_installed_packages())
+        finally:
+            pool.close_all()
+        self.assertFalse(connection.has_gateway)
+
+    def test_shell_semantics(self):
+        import redock.bootstrap
+        connection = connection_pool.get('redock:shell')
+        connection.cached_gateway = execnet.makegateway('popen')
+        connection.cached_packages = set(['python2.7'])
+        directory = tempfile.mkdtemp()
+        # Instead of starting ssh, let the local shell play the role of the
+        # remote login shell that interprets the command given to ssh.
+        original_popen = redock.bootstrap.subprocess.Popen
+        class FakePopen(original_popen):
+            def __init__(self, command, **kw):
+                assert command[0] == 'ssh'
+                original_popen.__init__(self, ['sh', '-c', command[-1]], **kw)
+        try:
+            bootstrap = Bootstrap('redock:shell')
+            redock.bootstrap.subprocess.Popen = FakePopen
+            # The gateway and ssh interpret commands in the same way.
+            for interactive, name in ((False, 'gateway'), (True, 'ssh')):
+                bootstrap.execute('cd', pipes.quote(directory), '&&', 'touch %s' % name, interactive=interactive)
+                self.assertTrue(os.path.isfile(os.path.join(directory, name)))
+                bootstrap.execute('read line && test "$line" = %s' % name, input='%s\n' % name, interactive=interactive)
+                self.assertRaises(ExternalCommandFailed, bootstrap.execute, 'exit 3', interactive=interactive)
+        finally:
+            redock.bootstrap.subprocess.Popen = original_popen
+            connection.close()
+            shutil.rmtree(directory)
+
+    def test_package_batching(self):
+        connection = connection_pool.get('redock:batch')
+        connection.cached_gateway = execnet.makegateway('popen')
+        connection.cached_packages = set(['python2.7', 'rsync'])
+        try:
+            bootstrap = Bootstrap('redock:batch')
+            commands = []
+            bootstrap.execute = lambda *command, **kw: commands.append(command)
+            with bootstrap.batch():
+                bootstrap.install_packages('rsync', 'git')
+                bootstrap.install_packages('git', 'mercurial')
+                self.assertEqual(commands, [])
+            self.assertEqual(commands, [('apt-get', 'install', '-q', '-y', 'git', 'mercurial')])
+            # Installed packages are remembered.
+            bootstrap.install_packages('mercurial')
+            self.assertEqual(len(commands), 1)
+        finally:
+            connection.close()
+
+    def test_fleet(self):
+        class FakeBootstrap(object):
+            def __init__(self, ssh_alias):
+                self.ssh_alias = ssh_alias
+            def install_packages(self, *packages):
+                if self.ssh_alias == 'broken':
+                    time.sleep(0.1)
+                    raise Exception, "Failed to install packages!"
+                return packages
+        class FakeFleet(Fleet):
+            def get_bootstrap(self, ssh_alias):
+                return FakeBootstrap(ssh_alias)
+        # By default all hosts are processed.
+        result = FakeFleet(['host1', 'broken', 'host2'], concurrency=2).install_packages('git')
+        self.assertEqual([h.ssh_alias for h in result.succeeded], ['host1', 'host2'])
+        self.assertEqual([h.ssh_alias for h in result.failed], ['broken'])
+        self.assertEqual(result['host1'].result, ('git',))
+        self.assertTrue(result['host1'].elapsed_time >= 0)
+        # In fail-fast mode the remaining hosts are cancelled.
+        fleet = FakeFleet(['broken', 'host1', 'host2'], concurrency=1, fail_fast=True)
+        try:
+            fleet.install_packages('git')
+            self.fail("Expected FleetError!")
+        except FleetError, e:
+            self.assertEqual([h.ssh_alias for h in e.result.cancelled], ['host1', 'host2'])
+
+    def test_task_engine(self):
+        connection = connection_pool.get('redock:tasks')
+        connection.cached_gateway = execnet.makegateway('popen')
+        connection.cached_packages = set(['python2.7'])
+        directory = tempfile.mkdtemp()
+        try:
+            bootstrap = Bootstrap('redock:tasks')
+            state_file = os.path.join(directory, 'tasks.json')
+            config_directory = os.path.join(directory, 'etc')
+            config_file = os.path.join(config_directory, 'example.conf')
+            marker_file = os.path.join(directory, 'reloaded')
+            def apply(contents, *extra_tasks):
+                tasks = [Directory('directory', pathname=config_directory),
+                         File('config', pathname=config_file, contents=contents, requires=['directory']),
+                         Command('reload', command=['touch', marker_file], requires=['config'])]
+                return TaskEngine(bootstrap, tasks + list(extra_tasks), state_file=state_file).run()
+            # Failing tasks are reported, tasks that depend on them are skipped.
+            self.assertRaises(TasksFailed, apply, 'a = 1\n',
+                              Command('broken', command=['false']),
+                              Command('dependent', command=['true'], requires=['broken']))
+            self.assertEqual(open(config_file).read(), 'a = 1\n')
+            self.assertTrue(os.path.isfile(marker_file))
+            # Unchanged tasks are skipped.
+            os.unlink(marker_file)
+            self.assertEqual(apply('a = 1\n'), dict(directory='unchanged', config='unchanged', reload='unchanged'))
+            self.assertFalse(os.path.isfile(marker_file))
+            # Tasks that depend on changed tasks are applied again.
+            self.assertEqual(apply('a = 2\n'), dict(directory='unchanged', config='changed', reload='changed'))
+            self.assertTrue(os.path.isfile(marker_file))
+            # Invalid task graphs are rejected.
+            self.assertRaises(InvalidTaskGraph, TaskEngine, bootstrap,
+                              [Command('a', command=['true'], requires=['b']),
+                               Command('b', command=['true'], requires=['a'])])
+        finally:
+            connection.close()
+            shutil.rmtree(directory)
+
+    def test_rsync_manifest(self):
+        connection = connection_pool.get('redock:rsync')
+        connection.cached_gateway = execnet.makegateway('popen')
+        connection.cached_packages = set(['python2.7', 'rsync'])
+        directory = tempfile.mkdtemp()
+        commands = []
+        def fake_spawnvp(mode, program, command):
+            files_from = [a for a in command if a.startswith('--files-from=')]
+            if files_from:
+                with open(files_from[0].split('=', 1)[1]) as handle:
+                    commands.append(handle.read().split())
+            else:
+                commands.append(None)
+            return 0
+        original_spawnvp = os.spawnvp
+        os.spawnvp = fake_spawnvp
+        try:
+            bootstrap = Bootstrap('redock:rsync')
+            bootstrap.config = Config(os.path.join(directory, 'state.sqlite3'))
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            for name in ('a', 'b'):
+                with open(os.path.join(source, name), 'w') as handle:
+                    handle.write(name)
+            # The first upload synchronizes the whole tree.
+            bootstrap.rsync(source, '/srv/source')
+            self.assertEqual(commands, [None])
+            # Nothing changed so rsync isn't run.
+            bootstrap.rsync(source, '/srv/source')
+            self.assertEqual(len(commands), 1)
+            # Only changed files are passed to rsync.
+            with open(os.path.join(source, 'b'), 'w') as handle:
+                handle.write('changed')
+            bootstrap.rsync(source, '/srv/source')
+            self.assertEqual(commands[-1], ['b'])
+            # Deleted files require synchronizing the whole tree.
+            os.unlink(os.path.join(source, 'a'))
+            bootstrap.rsync(source, '/srv/source')
+            self.assertEqual(commands[-1], None)
+            # The identity of the remote system doesn't change by itself.
+            self.assertEqual(bootstrap.get_remote_identity(), bootstrap.get_remote_identity())
+            bootstrap.rsync(source, '/srv/source')
+            self.assertEqual(len(commands), 3)
+            # A replacement of the remote system (e.g. a new container with
+            # the same SSH alias) gets a full upload even though nothing
+            # changed locally.
+            bootstrap.get_remote_identity = lambda: 'replaced'
+            bootstrap.rsync(source, '/srv/source')
+            self.assertEqual(len(commands), 4)
+            self.assertEqual(commands[-1], None)
+        finally:
+            os.spawnvp = original_spawnvp
+            connection.close()
+            shutil.rmtree(directory)
+
+    def test_upload_files(self):
+        connection = connection_pool.get('redock:upload')
+        connection.cached_gateway = execnet.makegateway('popen')
+        connection.cached_packages = set(['python2.7'])
+        directory = tempfile.mkdtemp()
+        try:
+            bootstrap = Bootstrap('redock:upload')
+            small_file = os.path.join(directory, 'small.txt')
+            large_file = os.path.join(directory, 'subdirectory', 'large.bin')
+            large_contents = os.urandom(1024 * 200)
+            files = lambda: [(small_file, StringIO.StringIO('Hello world!\n')),
+                             (large_file, StringIO.StringIO(large_contents))]
+            self.assertEqual(bootstrap.upload_files(files()), [small_file, large_file])
+            self.assertEqual(open(large_file, 'rb').read(), large_contents)
+            # Unchanged files are skipped.
+            self.assertEqual(bootstrap.upload_files(files()), [])
+            bootstrap.upload_file(small_file, 'Something else\n')
+            self.assertEqual(open(small_file).read(), 'Something else\n')
+            # No temporary files are left behind.
+            self.assertEqual(sorted(os.listdir(directory)), ['small.txt', 'subdirectory'])
+        finally:
+            connection.close()
+            shutil.rmtree(directory)
+
+    def test_output_multiplexer(self):
+        output = StringIO.StringIO()
+        output_multiplexer = OutputMultiplexer(stream=output)
+        # Raw output (containers with a pseudo-tty).
+        raw, remote_raw = socket.socketpair()
+        output_multiplexer.add('raw', 'first', raw)
+        remote_raw.sendall('foo\r\nba')
+        remote_raw.sendall('r\nunterminated')
+        remote_raw.close()
+        # Multiplexed output split over several writes.
+        multiplexed, remote_multiplexed = socket.socketpair()
+        output_multiplexer.add('multiplexed', 'second', multiplexed)
+        frame = '\x01\x00\x00\x00\x00\x00\x00\x08baz\nqux\n'
+        remote_multiplexed.sendall(frame[:5])
+        remote_multiplexed.sendall(frame[5:] + '\x02\x00\x00\x00\x00\x00\x00\x06error\n')
+        output_multiplexer.remove('multiplexed', timeout=0.5)
+        output_multiplexer.remove('raw', timeout=5)
+        self.assertTrue(output_multiplexer.flush(timeout=5))
+        threads = (output_multiplexer.reader, output_multiplexer.writer)
+        output_multiplexer.stop()
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        lines = output.getvalue().splitlines()
+        self.assertEqual([l for l in lines if l.startswith('first: ')],
+                         ['first: foo', 'first: bar', 'first: unterminated'])
+        self.assertEqual([l for l in lines if l.startswith('second: ')],
+                         ['second: baz', 'second: qux', 'second: error'])
+        remote_multiplexed.close()
+        # A slow terminal causes old lines to be dropped instead of blocking.
+        class SlowTerminal(object):
+            def __init__(self):
+                self.unblocked = threading.Event()
+                self.chunks = []
+            def write(self, text):
+                self.unblocked.wait()
+                self.chunks.append(text)
+            def flush(self):
+                pass
+        terminal = SlowTerminal()
+        output_multiplexer = OutputMultiplexer(stream=terminal, buffer_size=5)
+        sock, remote = socket.socketpair()
+        output_multiplexer.add('slow', 'slow', sock)
+        remote.sendall(''.join('line %i\n' % i for i in range(50)))
+        remote.close()
+        output_multiplexer.remove('slow', timeout=5)
+        self.assertEqual(output_multiplexer.lines_received, 50)
+        self.assertTrue(output_multiplexer.lines_dropped >= 40)
+        terminal.unblocked.set()
+        # Stopping the multiplexer writes the buffered lines first.
+        output_multiplexer.stop()
+        self.assertEqual(output_multiplexer.reader, None)
+        text = ''.join(terminal.chunks)
+        self.assertTrue('lines of container output dropped' in text)
+        self.assertTrue(text.endswith('slow: line 49\n'))
+        # Sockets that are still registered are closed by stop().
+        sock, remote = socket.socketpair()
+        output_multiplexer.add('idle', 'idle', sock)
+        threads = (output_multiplexer.reader, output_multiplexer.writer)
+        output_multiplexer.stop()
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(remote.recv(1), '')
+        remote.close()
+
+    def test_client_factory(self):
+        directory = tempfile.mkdtemp()
+        socket_path = os.path.join(directory, 'docker.sock')
+        requests_seen = []
+        class DockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):
+                requests_seen.append(self.path)
+                if self.path == '/v1.4/version' and len(requests_seen) == 4:
+                    # Simulate a Docker daemon that drops the connection.
+                    self.close_connection = 1
+                    return
+                body = '{"Version": "0.7.0"}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        class DockerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            daemon_threads = True
+        server = DockerServer(socket_path, DockerHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            factory = ClientFactory(base_url='unix:/' + socket_path, pool_size=2)
+            client = factory.get()
+            self.assertTrue(factory.get() is client)
+            for i in range(3):
+                self.assertEqual(client.version()['Version'], '0.7.0')
+            self.assertEqual(requests_seen, ['/v1.4/version'] * 3)
+            statistics = factory.statistics
+            self.assertEqual(statistics['requests'], 3)
+            self.assertEqual(statistics['connections'], 1)
+            self.assertEqual(statistics['reused'], 2)
+            # The dropped connection is replaced transparently.
+            self.assertEqual(client.version()['Version'], '0.7.0')
+            statistics = factory.statistics
+            self.assertEqual(statistics['reconnects'], 1)
+            self.assertEqual(statistics['connections'], 2)
+            # Idle connections can be closed explicitly.
+            factory.close()
+            self.assertEqual(client.version()['Version'], '0.7.0')
+            self.assertEqual(factory.statistics['connections'], 3)
+        finally:
+            factory.close()
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            shutil.rmtree(directory)
+
+    def test_daemon(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pathname = os.path.join(directory, 'redockd.sock')
+            client = DaemonClient(pathname)
+            self.assertFalse(client.is_running())
+            daemon = Daemon(pathname)
+            thread = threading.Thread(target=daemon.serve_forever)
+            thread.start()
+            try:
+                self.assertTrue(client.is_running())
+                self.assertRaises(DaemonError, client.perform, 'bogus', 'redock:test')
+            finally:
+                daemon.shutdown()
+                thread.join()
+                daemon.shutdown_daemon()
+            self.assertFalse(os.path.exists(pathname))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_inventory(self):
+        client = FakeDockerClient()
+        client.add_image('a' * 64, parent='b' * 64, created=2)
+        client.add_image('b' * 64, 'redock', 'test', created=1)
+        calls = []
+        images = client.images
+        client.images = lambda **kw: calls.append(kw) or images(**kw)
+        inventory = Inventory(client)
+        self.assertEqual(inventory.find_image('redock', 'test')['Id'], 'b' * 64)
+        self.assertEqual(inventory.find_image('redock', 'other'), None)
+        self.assertEqual(len(calls), 1)
+        inventory.invalidate()
+        inventory.images()
+        self.assertEqual(len(calls), 2)
+
+    def test_prefix_index(self):
+        index = PrefixIndex(['abc123', 'abd456', 'abd789', 'bcd012'])
+        self.assertEqual(index.resolve('abc'), 'abc123')
+        self.assertEqual(index.resolve('b'), 'bcd012')
+        self.assertEqual(index.matches('abd'), ['abd456', 'abd789'])
+        self.assertRaises(AmbiguousId, index.resolve, 'abd')
+        self.assertRaises(UnknownId, index.resolve, 'xyz')
+        self.assertTrue('abd789' in index)
+        self.assertFalse('abd' in index)
+
+    def test_worker_pool(self):
+        jobs = run_concurrently(lambda n: 2 ** n, range(10), concurrency=3)
+        self.assertEqual([j.result for j in jobs], [2 ** n for n in range(10)])
+        with WorkerPool(concurrency=2) as pool:
+            job = pool.submit(int, 'not a number')
+        self.assertFalse(job.succeeded)
+        self.assertRaises(ValueError, job.wait)
+
+    def test_async_container(self):
+        with WorkerPool(concurrency=2) as pool:
+            first = AsyncContainer('redock:first', pool=pool)
+            second = AsyncContainer('redock:second', pool=pool)
+            blocker = threading.Event()
+            calls = []
+            def call(name, fail=False):
+                calls.append(name)
+                if fail:
+                    raise Exception, "Simulated failure"
+                return name
+            # Calls for the same container run in the order they were scheduled.
+            blocking_job = first.submit(lambda: blocker.wait(10) and call('first 1'))
+            jobs = [first.submit(call, 'first 2', fail=True), first.submit(call, 'first 3')]
+            finished = []
+            jobs[-1].add_callback(lambda job: finished.append(job.result))
+            # Waiting calls don't occupy a worker thread, so calls for other
+            # containers aren't held up by them.
+            self.assertEqual(second.submit(call, 'second').wait(timeout=5), 'second')
+            self.assertEqual(calls, ['second'])
+            self.assertFalse(any(job.done for job in jobs))
+            blocker.set()
+            self.assertEqual(jobs[-1].wait(timeout=5), 'first 3')
+            self.assertEqual(calls, ['second', 'first 1', 'first 2', 'first 3'])
+            self.assertTrue(blocking_job.succeeded)
+            # A failed call doesn't prevent later calls from running.
+            self.assertFalse(jobs[0].succeeded)
+            self.assertEqual(finished, ['first 3'])
+            # Calls scheduled after the previous call finished run right away.
+            self.assertEqual(first.submit(call, 'first 4').wait(timeout=5), 'first 4')
+
+    def test_ssh_banner(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        port_number = server.getsockname()[1]
+        def serve():
+            # Mimic Docker's port forwarding: The first connection is closed
+            # before the SSH server is running.
+            for banner in ('', 'SSH-2.0-OpenSSH_5.9p1\r\n'):
+                client, address = server.accept()
+                client.sendall(banner)
+                client.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        try:
+            result = wait_for_ssh_banner(['127.0.0.1'], port_number, timeout=5)
+            self.assertEqual(result, ('127.0.0.1', 'SSH-2.0-OpenSSH_5.9p1'))
+        finally:
+            thread.join()
+            server.close()
+        # Nothing is listening on the port anymore.
+        self.assertEqual(wait_for_ssh_banner(['127.0.0.1'], port_number, timeout=0.5), None)
+
+    def test_streaming_pull(self):
+        import redock.pull
+        # Progress messages are decoded as they arrive, even when they're
+        # split over several chunks or not separated by newlines.
+        stream = '{"status": "Pulling"}{"id": "abc",\n "status": "Downloading"}\r\n{"id": "abc"}'
+        chunks = [stream[i:i + 7] for i in range(0, len(stream), 7)]
+        self.assertEqual([m.get('status') for m in iter_json_objects(chunks)],
+                         ['Pulling', 'Downloading', None])
+        def download(layer_id, size, interrupt=False):
+            messages = [dict(status='Pulling repository ubuntu')]
+            for current in range(0, size + 1, size / 4):
+                messages.append(dict(id=layer_id, status='Downloading',
+                                     progressDetail=dict(current=current, total=size)))
+                if interrupt and current >= size / 2:
+                    messages.append(dict(error='Connection reset by peer'))
+                    return messages
+            messages.append(dict(id=layer_id, status='Download complete'))
+            return messages
+        def fake_client(responses):
+            client = FakeDockerClient()
+            client.pull_responses = responses
+            client.delay = 0.1
+            return client
+        saved_delay = redock.pull.RETRY_DELAY
+        redock.pull.RETRY_DELAY = 0
+        try:
+            # An interrupted download is restarted.
+            client = fake_client([download('a1b2c3', 4096, interrupt=True), download('a1b2c3', 4096)])
+            progress = pull_image(client, 'ubuntu', 'precise')
+            self.assertEqual(len(client.pulls), 2)
+            self.assertEqual(progress.layers['a1b2c3'].size, 4096)
+            self.assertEqual(progress.layers['a1b2c3'].status, 'Download complete')
+            self.assertEqual(progress.bytes_downloaded, 2048 + 4096)
+            # Downloads are restarted a limited number of times.
+            client = fake_client([download('a1b2c3', 4096, interrupt=True) for i in range(3)])
+            self.assertRaises(PullFailed, pull_image, client, 'ubuntu', 'precise', retries=2)
+            # Errors that won't go away aren't retried.
+            client = fake_client([[dict(error='Tag precise not found in repository ubuntu')]])
+            self.assertRaises(PullFailed, pull_image, client, 'ubuntu', 'precise')
+            self.assertEqual(len(client.pulls), 1)
+        finally:
+            redock.pull.RETRY_DELAY = saved_delay
+        # When several threads request the same image it's downloaded once.
+        client = fake_client([download('a1b2c3', 4096)])
+        inventory = Inventory(client)
+        jobs = run_concurrently(lambda i: download_image(client, 'ubuntu', 'precise', inventory),
+                                range(3), concurrency=3)
+        self.assertTrue(all(job.succeeded for job in jobs))
+        self.assertEqual(client.pulls, [('ubuntu', 'precise')])
+
+    def test_build_stages(self):
+        import redock.base
+        client = FakeDockerClient()
+        client.add_image('ubuntu', 'ubuntu', 'precise')
+        inventory = Inventory(client)
+        directory = tempfile.mkdtemp()
+        cache = PackageCache(os.path.join(directory, 'apt-cache'), offline=False,
+                             config_directory=os.path.join(directory, 'apt-config'))
+        settings = dict(mirror='http://archive.ubuntu.com/ubuntu/', ssh_key='key1')
+        executed = []
+        def run_build_stage(client, inventory, image_id, name, command, tag, cache):
+            executed.append((name, image_id))
+            image_id = client.add_image(repository='redock-stage', tag=tag, parent=image_id)
+            inventory.invalidate(containers=False)
+            return image_id
+        def build(image_id='ubuntu'):
+            del executed[:]
+            return run_build_stages(client, inventory, image_id, get_build_stages(cache), cache)
+        saved_functions = (redock.base.get_config_stage, redock.base.run_build_stage,
+                           redock.base.select_ubuntu_mirror, redock.base.APT_CONFIG)
+        try:
+            redock.base.get_config_stage = lambda: ('config', 'echo %s' % settings['ssh_key'])
+            redock.base.run_build_stage = run_build_stage
+            redock.base.select_ubuntu_mirror = lambda: settings['mirror']
+            # The first build runs all stages, each on top of the previous one.
+            first_build = build()
+            self.assertEqual([name for name, parent in executed], ['apt', 'packages', 'config'])
+            self.assertEqual(executed[0][1], 'ubuntu')
+            self.assertEqual(client.images_by_id[executed[2][1]]['parent'], executed[1][1])
+            parents = dict(executed)
+            # Rebuilding without changes reuses all stages.
+            self.assertEqual(build(), first_build)
+            self.assertEqual(executed, [])
+            # Changing only the last stage rebuilds only that stage (on top
+            # of the reused image of the packages stage).
+            settings['ssh_key'] = 'key2'
+            second_build = build()
+            self.assertNotEqual(second_build, first_build)
+            self.assertEqual(executed, [('config', parents['config'])])
+            # The selected mirror isn't part of the stage keys, so a change in
+            # the ranking of the mirrors doesn't rebuild anything.
+            settings['mirror'] = 'http://mirror.example.com/ubuntu/'
+            self.assertEqual(build(), second_build)
+            self.assertEqual(executed, [])
+            apt_command = dict(get_build_stages(cache))['apt']
+            self.assertTrue('"$UBUNTU_MIRROR"' in apt_command)
+            self.assertFalse('mirror.example.com' in apt_command)
+            # Changing an early stage rebuilds it and all stages after it,
+            # even though the commands of the later stages didn't change.
+            redock.base.APT_CONFIG = saved_functions[3] + 'APT::Get::Show-Versions "true";\n'
+            build()
+            self.assertEqual([name for name, parent in executed], ['apt', 'packages', 'config'])
+            # Going back to earlier settings reuses the earlier stages.
+            redock.base.APT_CONFIG = saved_functions[3]
+            self.assertEqual(build(), second_build)
+            self.assertEqual(executed, [])
+            # The mirror is passed to the container that runs the apt stage.
+            created = []
+            create_container = client.create_container
+            def record_container(*args, **kw):
+                created.append(kw)
+                return create_container(*args, **kw)
+            client.create_container = record_container
+            saved_functions[1](client, inventory, 'ubuntu', 'apt', apt_command, 'apt-test', cache)
+            saved_functions[1](client, inventory, 'ubuntu', 'config', 'true', 'config-test', cache)
+            self.assertEqual(created[0]['environment'], ['UBUNTU_MIRROR=http://mirror.example.com/ubuntu/'])
+            self.assertEqual(created[1]['environment'], [])
+            # A different starting image rebuilds everything.
+            client.add_image('other', 'ubuntu', 'other')
+            inventory.invalidate()
+            build('other')
+            self.assertEqual([name for name, parent in executed], ['apt', 'packages', 'config'])
+            self.assertEqual(executed[0][1], 'other')
+        finally:
+            (redock.base.get_config_stage, redock.base.run_build_stage,
+             redock.base.select_ubuntu_mirror, redock.base.APT_CONFIG) = saved_functions
+            shutil.rmtree(directory)
+
+    def test_base_image_tarballs(self):
+        import redock.base
+        # Create a small tar archive to play the role of the exported image.
+        archive = StringIO.StringIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo('etc/hostname')
+            info.size = len('redock\n')
+            tar.addfile(info, StringIO.StringIO('redock\n'))
+        def run_build_stage(client, inventory, image_id, name, command, tag, cache):
+            return client.add_image(repository='redock-stage', tag=tag, parent=image_id)
+        directory = tempfile.mkdtemp()
+        saved_functions = (redock.base.get_config_stage, redock.base.run_build_stage)
+        saved_environment = os.environ.get('REDOCK_BASE_IMAGES')
+        try:
+            redock.base.get_config_stage = lambda: ('config', 'true')
+            redock.base.run_build_stage = run_build_stage
+            # Export the base image to a content hashed tarball.
+            client = FakeDockerClient()
+            client.add_image('base', 'redock', 'base', contents=archive.getvalue())
+            pathname = export_base_image(client, directory=directory, inventory=Inventory(client))
+            self.assertFalse(client.containers(all=True))
+            match = BASE_EXPORT_PATTERN.match(os.path.basename(pathname))
+            self.assertTrue(match)
+            with open(pathname, 'rb') as handle:
+                self.assertEqual(hashlib.sha1(handle.read()).hexdigest(), match.group(1))
+            self.assertEqual(gzip.open(pathname).read(), archive.getvalue())
+            # Exporting the same image again gives the same tarball.
+            self.assertEqual(export_base_image(client, directory=directory, inventory=Inventory(client)), pathname)
+            self.assertEqual(find_base_tarballs(directory), [pathname])
+            # docker-py's import_image() doesn't upload file-like objects.
+            client = FakeDockerClient()
+            with open(pathname, 'rb') as handle:
+                client.import_image(handle, repository='redock-stage', tag='import')
+            self.assertEqual(client.images(), [])
+            # The base image is imported from the tarball instead of being built.
+            os.environ['REDOCK_BASE_IMAGES'] = directory
+            inventory = Inventory(client)
+            image_id = find_base_image(client, inventory, PackageCache(directory=directory))
+            self.assertEqual(inventory.find_image('redock', 'base')['Id'], image_id)
+            imported_image = client.images_by_id[client.images_by_id[image_id]['parent']]
+            with open(pathname, 'rb') as handle:
+                self.assertEqual(imported_image['contents'], handle.read())
+            self.assertEqual(client.uploads, [dict(fromSrc='-', repo='redock-stage',
+                                                   tag='import-%s' % match.group(1)[:12])])
+            # Truncated tarballs are rejected.
+            corrupt_directory = os.path.join(directory, 'corrupt')
+            os.mkdir(corrupt_directory)
+            corrupt_pathname = os.path.join(corrupt_directory, os.path.basename(pathname))
+            with open(pathname, 'rb') as source:
+                with open(corrupt_pathname, 'wb') as target:
+                    target.write(source.read()[:-10])
+            client = FakeDockerClient()
+            self.assertRaises(CorruptTarball, import_base_image, client, corrupt_pathname,
+                              Inventory(client), PackageCache(directory=directory))
+            self.assertFalse(client.uploads)
+        finally:
+            redock.base.get_config_stage, redock.base.run_build_stage = saved_functions
+            if saved_environment is None:
+                os.environ.pop('REDOCK_BASE_IMAGES', None)
+            else:
+                os.environ['REDOCK_BASE_IMAGES'] = saved_environment
+            shutil.rmtree(directory)
+
+    def test_warm_pool(self):
+        import redock.warmpool
+        client = FakeDockerClient()
+        client.add_image('base', 'redock', 'base')
+        directory = tempfile.mkdtemp()
+        config = Config(os.path.join(directory, 'state.sqlite3'))
+        class FakeContainer(object):
+            def __init__(self, image, hostname, timeout=10):
+                self.image = image
+                self.base = Image('redock', 'base')
+                self.hostname = hostname
+                self.timeout = timeout
+                self.config = config
+                self.client = client
+                self.inventory = Inventory(client)
+                self.session = Session()
+            def find_image(self, image_to_find):
+                image = self.inventory.find_image(image_to_find.repository, image_to_find.tag)
+                if image:
+                    return Image(repository=image['Repository'], tag=image['Tag'], id=image['Id'])
+            def ensure_image(self):
+                return self.find_image(self.image) or self.find_image(self.base)
+            def start_supervisor(self, register=True, attach=True):
+                assert not (register or attach)
+                self.session.container_id = client.add_container(self.ensure_image().id, SUPERVISOR_COMMAND,
+                                                                 hostname=self.hostname, running=True)
+                self.inventory.invalidate(images=False)
+            @property
+            def ssh_endpoint(self):
+                return ('127.0.0.1', int(client.port(self.session.container_id, 22)))
+        def reserved(container):
+            return [e['container_id'] for e in config.get('pool', WarmPool(container).key, [])]
+        original_directory = redock.warmpool.REDOCK_CONFIG_DIR
+        try:
+            redock.warmpool.REDOCK_CONFIG_DIR = directory
+            web = FakeContainer(Image('redock', 'test'), 'web')
+            pool = WarmPool(web, size=2)
+            self.assertFalse(pool.claim())
+            # Until the image exists containers are created from the base image.
+            pool.fill()
+            self.assertEqual(len(reserved(web)), 2)
+            self.assertTrue(all(client.containers_by_id[i]['image_id'] == 'base' for i in reserved(web)))
+            # Pools are keyed by repository, tag and host name.
+            self.assertEqual(pool.key, ('redock', 'test', 'web'))
+            self.assertFalse(WarmPool(FakeContainer(Image('redock', 'test'), 'db')).claim())
+            self.assertFalse(WarmPool(FakeContainer(Image('redock', 'other'), 'web')).claim())
+            self.assertEqual(len(reserved(web)), 2)
+            # Claiming hands out the oldest container (like Container.start()
+            # we make sure the inventory is up to date).
+            first, second = reserved(web)
+            web.inventory.invalidate()
+            self.assertTrue(pool.claim())
+            self.assertEqual(web.session.container_id, first)
+            self.assertEqual(web.session.ssh_endpoint, web.ssh_endpoint)
+            self.assertEqual(config.get('containers', web.image.key), first)
+            self.assertEqual(reserved(web), [second])
+            # Containers that are no longer running are pruned.
+            client.kill(second)
+            self.assertEqual(pool.prune(), 0)
+            self.assertEqual(reserved(web), [])
+            # The pool is refilled and a surplus is discarded.
+            pool.fill()
+            self.assertEqual(len(reserved(web)), 2)
+            surplus = reserved(web)[1]
+            WarmPool(web, size=1).fill()
+            self.assertEqual(len(reserved(web)), 1)
+            self.assertTrue(surplus in client.removed_containers)
+            # Containers created from an image that has since been committed
+            # to are discarded instead of being claimed.
+            outdated = reserved(web)[0]
+            client.commit(first, repository='redock', tag='test')
+            web = FakeContainer(Image('redock', 'test'), 'web')
+            self.assertFalse(WarmPool(web, size=1).claim())
+            self.assertTrue(outdated in client.removed_containers)
+            self.assertEqual(reserved(web), [])
+            # New containers are created from the committed image.
+            WarmPool(web, size=1).fill()
+            web.inventory.invalidate()
+            self.assertTrue(WarmPool(web, size=1).claim())
+            self.assertEqual(client.containers_by_id[web.session.container_id]['image_id'],
+                             client.tags[('redock', 'test')])
+        finally:
+            redock.warmpool.REDOCK_CONFIG_DIR = original_directory
+            shutil.rmtree(directory)
+
+    def test_snapshots(self):
+        class FakeContainer(object):
+            def __init__(self, config, client):
+                self.image = Image('redock', 'test')
+                self.config = config
+                self.client = client
+                self.inventory = Inventory(client)
+                self.session = Session()
+                self.calls = []
+            def check_active(self):
+                pass
+            def find_container(self):
+                return bool(self.session.container_id)
+            def kill(self, revoke_ssh=True):
+                self.calls.append(('kill', revoke_ssh))
+                self.session.reset()
+            def start_supervisor(self, host_port=None):
+                self.calls.append(('start_supervisor', host_port, self.session.custom_image.id))
+                self.session.container_id = 'd00d'
+            def setup_ssh_access(self):
+                self.calls.append(('setup_ssh_access',))
+        client = FakeDockerClient()
+        client.add_image('ubuntu', 'ubuntu', 'precise')
+        client.add_image('test', 'redock', 'test', parent='ubuntu')
+        directory = tempfile.mkdtemp()
+        try:
+            container = FakeContainer(Config(os.path.join(directory, 'state.sqlite3')), client)
+            original_id = client.add_container('redock:test', SUPERVISOR_COMMAND, host_port='49153', running=True)
+            container.session.container_id = original_id
+            snapshots = SnapshotManager(container, retention=2)
+            self.assertRaises(UnknownSnapshot, snapshots.find)
+            # Old snapshots are pruned.
+            ids = {}
+            for name in ('one', 'two', 'three'):
+                snapshot = snapshots.create(name=name)
+                ids[name] = snapshot['image_id']
+            self.assertEqual(snapshot['tag'], 'redock-test-three')
+            self.assertEqual([s['name'] for s in snapshots.list()], ['two', 'three'])
+            self.assertEqual(client.resolve_image(ids['one']), None)
+            # Snapshots with the same name are replaced.
+            snapshots.create(name='two')
+            self.assertEqual([s['name'] for s in snapshots.list()], ['three', 'two'])
+            self.assertEqual(client.resolve_image(ids['two']), None)
+            # Images that are still in use are kept until the next prune.
+            user = client.add_container(ids['three'], '/bin/sh')
+            ids['four'] = snapshots.create(name='four')['image_id']
+            self.assertEqual([s['name'] for s in snapshots.list()], ['three', 'two', 'four'])
+            client.remove_container(user)
+            self.assertEqual(snapshots.prune(), 1)
+            self.assertEqual([s['name'] for s in snapshots.list()], ['two', 'four'])
+            self.assertRaises(UnknownSnapshot, snapshots.find, 'one')
+            # Images with lots of layers are squashed.
+            parent = 'test'
+            for i in range(40):
+                parent = client.add_image(parent=parent, contents='tar archive')
+            container.session.container_id = client.add_container(parent, SUPERVISOR_COMMAND, running=True)
+            snapshot = snapshots.create(name='deep')
+            self.assertEqual(len(json.loads(client.history(snapshot['image_id']))), 1)
+            self.assertEqual(client.images_by_id[snapshot['image_id']]['contents'], 'tar archive')
+            self.assertEqual(client.uploads[-1]['fromSrc'], '-')
+            self.assertEqual(len(client.children(parent)), 0)
+            # When squashing fails the committed image is removed.
+            images = set(client.images_by_id)
+            def failing_post(url, data=None, **kw):
+                list(data)
+                return FakeResponse([dict(error='No space left on device')])
+            client.post = failing_post
+            self.assertRaises(ImportFailed, snapshots.create, name='broken')
+            del client.post
+            self.assertEqual(set(client.images_by_id), images)
+            self.assertRaises(UnknownSnapshot, snapshots.find, 'broken')
+            # Restoring a snapshot replaces the container and reuses its SSH port.
+            container.session.container_id = original_id
+            snapshots.restore('four')
+            self.assertEqual(container.calls, [('kill', False),
+                                               ('start_supervisor', 49153, ids['four']),
+                                               ('setup_ssh_access',)])
+            self.assertEqual(container.session.custom_image.name, '%s:redock-test-four' % SNAPSHOT_REPO)
+            # Snapshots are stored per container.
+            other = FakeContainer(container.config, client)
+            other.image = Image('redock', 'other')
+            self.assertEqual(SnapshotManager(other).list(), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_garbage_collection(self):
+        old = time.time() - 3600
+        client = FakeDockerClient()
+        client.add_image('ubuntu', 'ubuntu', 'precise', created=old)
+        client.add_image('stage1', 'redock-stage', 'apt-aaa', parent='ubuntu', command='bash -c true',
+                         hostname=BUILD_HOSTNAME, created=old)
+        client.add_image('stage2', parent='stage1', command='bash -c true', hostname=BUILD_HOSTNAME, created=old)
+        client.add_image('base', 'redock', 'base', parent='stage2', command='bash -c true',
+                         hostname=BUILD_HOSTNAME, created=old)
+        client.add_image('stale-stage', 'redock-stage', 'apt-old', parent='ubuntu', command='bash -c true',
+                         hostname=BUILD_HOSTNAME, created=old)
+        client.add_image('user', 'peter', 'test', parent='base', command=SUPERVISOR_COMMAND, created=old)
+        client.add_image('snap-kept', SNAPSHOT_REPO, 'peter-test-one', parent='base',
+                         command=SUPERVISOR_COMMAND, created=old)
+        client.add_image('snap-orphan', SNAPSHOT_REPO, 'peter-test-two', parent='base',
+                         command=SUPERVISOR_COMMAND, created=old)
+        client.add_image('dangling', parent='snap-orphan', command=SUPERVISOR_COMMAND, created=old)
+        client.add_image('foreign', parent='ubuntu', command='/bin/sh', created=old)
+        client.add_image('snap-new', SNAPSHOT_REPO, 'peter-test-new', parent='base', command=SUPERVISOR_COMMAND)
+        client.add_container('peter:test', SUPERVISOR_COMMAND, id='running', running=True, created=old)
+        client.add_container('peter:test', SUPERVISOR_COMMAND, id='stopped', created=old)
+        client.add_container('peter:test', SUPERVISOR_COMMAND, id='young')
+        client.add_container('redock-stage:apt-old', 'bash -c true', id='stage', created=old)
+        client.add_container('foreign', '/bin/sh', id='other', created=old)
+        directory = tempfile.mkdtemp()
+        try:
+            config = Config(os.path.join(directory, 'state.sqlite3'))
+            config.set('containers', ('peter', 'test'), 'running')
+            config.set('containers', ('peter', 'dead'), 'stopped')
+            config.set('pool', ('peter', 'test', 'test'), [dict(container_id='running'), dict(container_id='gone')])
+            config.set('snapshots', ('peter', 'test'), [dict(name='one', image_id='snap-k'),
+                                                         dict(name='lost', image_id='snap-lost')])
+            # A dry run doesn't change anything.
+            report = GarbageCollector(client=client, config=config, dry_run=True).collect()
+            self.assertEqual(sorted(report.containers), ['stage', 'stopped'])
+            self.assertEqual(sorted(report.images), ['dangling', 'snap-orphan', 'stale-stage'])
+            self.assertEqual(report.state_entries, 3)
+            self.assertEqual(client.removed_images + client.removed_containers, [])
+            self.assertEqual(config.get('containers', ('peter', 'dead')), 'stopped')
+            # Unreachable containers, images and configuration entries are removed.
+            report = GarbageCollector(client=client, config=config, concurrency=2).collect()
+            self.assertEqual(sorted(client.removed_containers), ['stage', 'stopped'])
+            self.assertEqual(sorted(report.images), ['dangling', 'snap-orphan', 'stale-stage'])
+            for image_id in report.images:
+                self.assertFalse(image_id in client.images_by_id)
+            self.assertEqual(sorted(client.images_by_id), ['base', 'foreign', 'snap-kept', 'snap-new',
+                                                           'stage1', 'stage2', 'ubuntu', 'user'])
+            self.assertEqual(report.bytes_reclaimed, 3 * 1024)
+            self.assertEqual(report.failures, [])
+            self.assertEqual(config.items('containers'), [(('peter', 'test'), 'running')])
+            self.assertEqual(config.get('pool', ('peter', 'test', 'test')), [dict(container_id='running')])
+            self.assertEqual([s['name'] for s in config.get('snapshots', ('peter', 'test'))], ['one'])
+            # Collecting garbage again finds nothing.
+            report = GarbageCollector(client=client, config=config).collect()
+            self.assertEqual((report.containers, report.images, report.state_entries), ([], [], 0))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_mirror_ranking(self):
+        class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/ubuntu/dists/precise/Release':
+                    self.send_response(206)
+                    self.end_headers()
+                    self.wfile.write('Origin: Ubuntu\n')
+                else:
+                    self.send_error(404)
+            def log_message(self, *args):
+                pass
+        servers = []
+        threads = []
+        for i in range(2):
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), MirrorHandler)
+            threads.append(threading.Thread(target=server.serve_forever))
+            threads[-1].start()
+            servers.append(server)
+        # A port on which nothing is listening.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        dead_mirror = 'http://127.0.0.1:%i/ubuntu/' % sock.getsockname()[1]
+        sock.close()
+        mirrors = ['http://127.0.0.1:%i/ubuntu/' % s.server_address[1] for s in servers]
+        directory = tempfile.mkdtemp()
+        try:
+            results = rank_mirrors([dead_mirror, mirrors[0] + 'missing/', mirrors[0]])
+            self.assertEqual(results[0]['url'], mirrors[0])
+            self.assertEqual(results[0]['error'], None)
+            self.assertTrue(all(r['error'] for r in results[1:]))
+            # Rank the mirrors and remember the ranking.
+            pathname = os.path.join(directory, 'ubuntu-mirrors.json')
+            selected = select_mirror(pathname=pathname, candidates=[dead_mirror] + mirrors)
+            self.assertTrue(selected in mirrors)
+            self.assertTrue(os.path.isfile(pathname))
+            # Fall back to the next mirror when the selected mirror fails.
+            servers[mirrors.index(selected)].shutdown()
+            servers[mirrors.index(selected)].server_close()
+            fallback = select_mirror(pathname=pathname, candidates=[])
+            self.assertEqual(set([selected, fallback]), set(mirrors))
+        finally:
+            for server, thread in zip(servers, threads):
+                server.shutdown()
+                thread.join()
+                server.server_close()
+            shutil.rmtree(directory)
+
     def test_start_container(self):
         hostname = 'whatever'
         # Start a test container.
@@ -77,6 +1187,337 @@ class RedockTestCase(unittest.TestCase):
             # Delete the image.
             container.delete()
 
+def measure_import_time(module, repeat=5):
+    """
+    Measure how long it takes to import a module in a fresh Python interpreter.
+
+    :param module: The name of the module to import (a string).
+    :param repeat: The number of measurements (the fastest one is reported,
+                   because slower runs are caused by other activity on the
+                   machine).
+    :returns: A tuple with the number of seconds it took to import the module
+              and a set with the names of all modules imported as a side
+              effect.
+    """
+    script = ';'.join(['import sys, time',
+                       'start = time.time()',
+                       'import %s' % module,
+                       'print time.time() - start',
+                       'print " ".join(sys.modules)'])
+    timings = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', script])
+        lines = output.splitlines()
+        timings.append(float(lines[0]))
+    return min(timings), set(lines[1].split())
+
+class FakeDockerClient(object):
+
+    """
+    In-memory stand-in for :py:class:`docker.Client` used by the tests. The
+    methods have the same signatures as in docker-py 0.2.0 and, like the real
+    client, the convenience methods go through the HTTP level methods (e.g.
+    :py:func:`import_image()` calls :py:func:`post()`) so that requests with
+    missing parameters fail here the same way they fail against Docker.
+
+    Images and tags are kept apart (an image can have any number of tags) and
+    removing images follows Docker: removing a tag only deletes the image
+    when it was the last tag and the image has no children, deleting an image
+    also deletes its untagged parents that become unused.
+    """
+
+    def __init__(self):
+        self.images_by_id = {}
+        self.tags = {}
+        self.containers_by_id = {}
+        self.pulls = []
+        self.pull_responses = []
+        self.uploads = []
+        self.removed_images = []
+        self.removed_containers = []
+        self.exit_status = 0
+        self.delay = 0
+        self.counter = 0
+        self.lock = threading.RLock()
+
+    def add_image(self, id=None, repository=None, tag=None, parent=None, command=None,
+                  hostname=None, contents='', created=None, size=1024):
+        """
+        Create an image (used by the tests to prepare the fake Docker daemon).
+
+        :returns: The id of the image (a string).
+        """
+        with self.lock:
+            id = id or self.generate_id()
+            self.images_by_id[id] = dict(id=id, parent=parent, contents=contents,
+                                         created=time.time() if created is None else created,
+                                         size=size, command=command, hostname=hostname)
+            if repository:
+                self.tags[(repository, tag)] = id
+            return id
+
+    def add_container(self, image, command, id=None, hostname=None, host_port=None,
+                      running=False, created=None):
+        """
+        Create a container (used by the tests to prepare the fake Docker daemon).
+
+        :returns: The id of the container (a string).
+        """
+        with self.lock:
+            id = id or self.generate_id()
+            self.containers_by_id[id] = dict(id=id, image=image, image_id=self.resolve_image(image),
+                                             command=command, hostname=hostname,
+                                             created=time.time() if created is None else created,
+                                             running=running, host_port=host_port or str(49152 + self.counter))
+            return id
+
+    def generate_id(self):
+        with self.lock:
+            self.counter += 1
+            return hashlib.sha256(str(self.counter)).hexdigest()
+
+    def resolve_image(self, name):
+        with self.lock:
+            if ':' in name:
+                return self.tags.get(tuple(name.split(':', 1)))
+            matches = [i for i in self.images_by_id if i.startswith(name)]
+            return matches[0] if len(matches) == 1 else None
+
+    def resolve_container(self, container):
+        if isinstance(container, dict):
+            container = container.get('Id')
+        matches = [c for c in self.containers_by_id if c.startswith(container)]
+        if len(matches) != 1:
+            raise FakeResponse(status_code=404).error("No such container: %s" % container)
+        return self.containers_by_id[matches[0]]
+
+    def children(self, image_id):
+        return [i for i in self.images_by_id.values() if i['parent'] == image_id]
+
+    def ancestors(self, image_id):
+        while image_id:
+            yield self.images_by_id[image_id]
+            image_id = self.images_by_id[image_id]['parent']
+
+    # HTTP level methods.
+
+    def _url(self, path):
+        return path
+
+    def _raise_for_status(self, response, explanation=None):
+        if response.status_code >= 400:
+            raise response.error(explanation or response.data)
+
+    def _result(self, response, json=False):
+        self._raise_for_status(response)
+        return response.json() if json else response.data
+
+    def post(self, url, data=None, **kw):
+        params = kw.get('params') or {}
+        with self.lock:
+            time.sleep(self.delay)
+            if url != '/images/create':
+                raise NotImplementedError("POST %s" % url)
+            if params.get('fromImage'):
+                self.pulls.append((params['fromImage'], params['tag']))
+                messages = self.pull_responses.pop(0)
+                if not any(m.get('error') for m in messages):
+                    self.add_image(repository=params['fromImage'], tag=params['tag'])
+                return FakeResponse(messages)
+            if params.get('fromSrc') == '-':
+                if hasattr(data, 'read'):
+                    contents = data.read()
+                else:
+                    contents = ''.join(data)
+                self.uploads.append(params)
+                image_id = self.add_image(repository=params.get('repo'), tag=params.get('tag'),
+                                          contents=contents)
+                return FakeResponse([dict(status=image_id)])
+            # Docker tries to download the tarball from the URL in fromSrc.
+            return FakeResponse([dict(error='Get %s: unsupported protocol scheme ""' % params.get('fromSrc', ''))])
+
+    # Image methods.
+
+    def images(self, name=None, quiet=False, all=False, viz=False):
+        with self.lock:
+            listing = []
+            for image in self.images_by_id.values():
+                tags = sorted(k for k, v in self.tags.items() if v == image['id'])
+                if not tags and (all or not self.children(image['id'])):
+                    tags = [('<none>', '<none>')]
+                for repository, tag in tags:
+                    listing.append(dict(Id=image['id'], Repository=repository, Tag=tag,
+                                        Created=image['created'], Size=image['size'],
+                                        VirtualSize=sum(i['size'] for i in self.ancestors(image['id']))))
+            return [i['Id'] for i in listing] if quiet else listing
+
+    def inspect_image(self, image_id):
+        with self.lock:
+            image = self.images_by_id.get(self.resolve_image(image_id))
+            if not image:
+                raise FakeResponse(status_code=404).error("No such image: %s" % image_id)
+            return dict(id=image['id'], parent=image['parent'], Size=image['size'],
+                        container_config=dict(Cmd=(image['command'] or '').split() or None,
+                                              Hostname=image['hostname']))
+
+    def history(self, image):
+        with self.lock:
+            return json.dumps([dict(Id=i['id'], Created=i['created']) for i in self.ancestors(self.resolve_image(image))])
+
+    def tag(self, image, repository, tag=None, force=False):
+        with self.lock:
+            self.tags[(repository, tag)] = self.resolve_image(image)
+
+    def import_image(self, src, repository=None, tag=None):
+        u = self._url("/images/create")
+        params = {'repo': repository, 'tag': tag}
+        if isinstance(src, basestring):
+            params['fromSrc'] = src
+            return self._result(self.post(u, None, params=params))
+        return self._result(self.post(u, src, params=params))
+
+    def remove_image(self, image):
+        with self.lock:
+            image_id = self.resolve_image(image)
+            if not image_id:
+                raise FakeResponse(status_code=404).error("No such image: %s" % image)
+            if ':' in image:
+                del self.tags[tuple(image.split(':', 1))]
+                if image_id in self.tags.values():
+                    self.removed_images.append(image)
+                    return
+            if self.children(image_id) or any(c['image_id'] == image_id for c in self.containers_by_id.values()):
+                if ':' in image:
+                    # Docker untags the image but keeps it around.
+                    self.removed_images.append(image)
+                    return
+                raise FakeResponse(status_code=409).error("Conflict, %s has children or is in use" % image)
+            self.removed_images.append(image)
+            while image_id:
+                parent = self.images_by_id.pop(image_id)['parent']
+                for key in [k for k, v in self.tags.items() if v == image_id]:
+                    del self.tags[key]
+                # Untagged parents that are no longer used are deleted as well.
+                if (not parent or parent in self.tags.values() or self.children(parent)
+                        or any(c['image_id'] == parent for c in self.containers_by_id.values())):
+                    break
+                image_id = parent
+
+    # Container methods.
+
+    def containers(self, quiet=False, all=False, trunc=True, latest=False,
+                   since=None, before=None, limit=-1):
+        with self.lock:
+            listing = []
+            for container in self.containers_by_id.values():
+                if all or container['running']:
+                    command = container['command'][:20] if trunc else container['command']
+                    listing.append(dict(Id=container['id'], Image=container['image'], Command=command,
+                                        Created=container['created'],
+                                        Status='Up 1 second' if container['running'] else 'Exit 0'))
+            return listing
+
+    def create_container(self, image, command, hostname=None, user=None,
+                         detach=False, stdin_open=False, tty=False, mem_limit=0, ports=None,
+                         environment=None, dns=None, volumes=None, volumes_from=None,
+                         privileged=False):
+        with self.lock:
+            image_id = self.resolve_image(image)
+            if not image_id:
+                raise FakeResponse(status_code=404).error("No such image: %s" % image)
+            host_port = None
+            for spec in ports or []:
+                if ':' in spec:
+                    host_port = spec.split(':')[0]
+            container_id = self.add_container(image, command, hostname=hostname, host_port=host_port)
+            self.containers_by_id[container_id]['environment'] = environment
+            self.containers_by_id[container_id]['volumes'] = volumes
+            # Docker 0.6 reports short ids.
+            return dict(Id=container_id[:12])
+
+    def start(self, container, binds=None, lxc_conf=None):
+        with self.lock:
+            container = self.resolve_container(container)
+            container['running'] = True
+            container['binds'] = binds
+
+    def attach_socket(self, container, params=None):
+        with self.lock:
+            self.resolve_container(container)
+            # The fake containers don't produce any output.
+            sock, remote = socket.socketpair()
+            remote.close()
+            return sock
+
+    def wait(self, container):
+        with self.lock:
+            self.resolve_container(container)['running'] = False
+            return self.exit_status
+
+    def kill(self, container):
+        with self.lock:
+            self.resolve_container(container)['running'] = False
+
+    def port(self, container, private_port):
+        with self.lock:
+            return self.resolve_container(container)['host_port']
+
+    def commit(self, container, repository=None, tag=None, message=None,
+               author=None, conf=None):
+        with self.lock:
+            container = self.resolve_container(container)
+            image_id = self.add_image(repository=repository, tag=tag, parent=container['image_id'],
+                                      command=container['command'], hostname=container['hostname'],
+                                      contents=self.images_by_id[container['image_id']]['contents'])
+            return dict(Id=image_id[:12])
+
+    def export(self, container):
+        with self.lock:
+            return StringIO.StringIO(self.images_by_id[self.resolve_container(container)['image_id']]['contents'])
+
+    def remove_container(self, container, v=False):
+        with self.lock:
+            container = self.resolve_container(container)
+            if container['running']:
+                raise FakeResponse(status_code=500).error("Impossible to remove a running container")
+            del self.containers_by_id[container['id']]
+            self.removed_containers.append(container['id'])
+
+class FakeResponse(object):
+
+    """
+    Stand-in for :py:class:`requests.Response` returned by :py:class:`FakeDockerClient`.
+    """
+
+    def __init__(self, messages=(), status_code=200):
+        self.data = ''.join(json.dumps(m) for m in messages)
+        self.status_code = status_code
+        self.reason = 'OK' if status_code < 400 else 'Error'
+        self.raw = None
+        self._content_consumed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), chunk_size):
+            yield self.data[i:i + chunk_size]
+        self._content_consumed = True
+
+    @property
+    def content(self):
+        return self.data
+
+    @property
+    def text(self):
+        return self.data
+
+    def json(self):
+        return json.loads(self.data)
+
+    def close(self):
+        pass
+
+    def error(self, message):
+        return docker.client.APIError(message, response=self, explanation=message)
+
 if __name__ == '__main__':
     unittest.main()
 
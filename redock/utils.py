@@ -1,22 +1,25 @@
 # Utility functions for Redock.
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: September 30, 2013
+# Last Change: October 16, 2026
 # URL: https://github.com/xolox/python-redock
 
 # Standard library modules.
-import fcntl
+import contextlib
+import errno
+import json
 import os.path
 import pickle
 import pipes
 import re
+import select
 import socket
+import sqlite3
 import subprocess
-import sys
-import urllib
+import threading
+import time
 
 # External dependencies.
-from netifaces import interfaces, ifaddresses
 from humanfriendly import format_path
 from verboselogs import VerboseLogger
 
@@ -26,93 +29,366 @@ logger = VerboseLogger(__name__)
 # Directory on the host system with files generated by Redock.
 REDOCK_CONFIG_DIR = os.path.expanduser('~/.redock')
 
-# The absolute pathname of the serialized runtime configuration.
+# The absolute pathname of the SQLite database with the runtime configuration.
+CONFIG_DATABASE = os.path.join(REDOCK_CONFIG_DIR, 'state.sqlite3')
+
+# The absolute pathname of the serialized runtime configuration used by older
+# versions of Redock (migrated to CONFIG_DATABASE automatically).
 CONFIG_FILE = os.path.join(REDOCK_CONFIG_DIR, 'state.pickle')
 
 # The version number of the runtime configuration format.
-CONFIG_VERSION = 1
+CONFIG_VERSION = 2
 
-# The absolute pathname of the text file containing the selected Ubuntu mirror.
+# The absolute pathname of the text file containing the Ubuntu mirror selected
+# by older versions of Redock (superseded by redock.mirrors.MIRROR_RANKING_FILE).
 UBUNTU_MIRROR_FILE = os.path.join(REDOCK_CONFIG_DIR, 'ubuntu-mirror.txt')
 
+# The Ubuntu mirror used when no nearby mirror can be found (e.g. offline).
+DEFAULT_UBUNTU_MIRROR = 'http://archive.ubuntu.com/ubuntu/'
+
 # The absolute pathname of SSH public key generated by Redock.
 PUBLIC_SSH_KEY = os.path.join(REDOCK_CONFIG_DIR, 'id_rsa.pub')
 
 # The absolute pathname of SSH private key generated by Redock.
 PRIVATE_SSH_KEY = os.path.join(REDOCK_CONFIG_DIR, 'id_rsa')
 
-class Config(object):
+# The absolute pathname of the SSH client configuration file.
+SSH_CONFIG_FILE = os.path.expanduser('~/.ssh/config')
 
-    # TODO The Config class as it is written now is a bit tricky. I feel
-    #      like it should be a lot simpler! I hope this is possible :-)
+class Config(object):
 
     """
     :py:class:`Config` encapsulates the bits of runtime configuration that
     Redock needs to persist to disk (to share state in between runs of Redock).
-    UNIX file locking is used to guarantee that the datafile is not written to
-    simultaneously by multiple processes (that could corrupt the state).
+    The configuration is stored in an SQLite_ database in `WAL mode`_ which
+    means any number of Redock processes can read the configuration while
+    another process is updating it.
 
-    To use this class to update the configuration, use it like a context
-    manager, like this:
+    The configuration consists of namespaces (e.g. ``containers``) that
+    contain keys and values. Keys and values are serialized using JSON (so
+    tuples come back as lists). Individual keys can be read and written
+    without any explicit locking:
 
     >>> config = Config()
-    >>> with config as state:
-    ...   state['containers'].clear()
+    >>> config.set('containers', ('redock', 'test'), '5f2a...')
+    >>> config.get('containers', ('redock', 'test'))
+    u'5f2a...'
+
+    To read and update several keys atomically use :py:func:`transaction()`:
 
-    When used like this, ``state`` is a dictionary which is saved to disk when
-    the ``with`` block ends without raising an exception.
+    >>> with config.transaction():
+    ...   entries = config.get('pool', key, [])
+    ...   config.set('pool', key, entries[1:])
+
+    .. _SQLite: http://www.sqlite.org/
+    .. _WAL mode: http://www.sqlite.org/wal.html
     """
 
-    def __init__(self):
+    def __init__(self, pathname=CONFIG_DATABASE):
+        """
+        Initialize a :py:class:`Config` object.
+
+        :param pathname: The pathname of the SQLite database (defaults to
+                         ``~/.redock/state.sqlite3``).
+        """
         self.logger = logger
-        self.handle = None
-        self.state = {}
-
-    def load(self, exists=True):
-        """
-        Load the runtime configuration from disk. If the file doesn't exist yet
-        an empty configuration is returned. The configuration contains a
-        version number which enables graceful upgrades to the format.
-
-        :returns: A dictionary with runtime configuration data.
-        """
-        if exists:
-            self.logger.verbose("Loading runtime configuration from %s ..", format_path(CONFIG_FILE))
-        state = {}
-        handle = self.handle
-        close = False
-        if (not handle) and os.path.isfile(CONFIG_FILE):
-            handle = open(CONFIG_FILE)
-            close = True
-        if exists and handle:
-            state = pickle.load(handle)
-            if close:
-                handle.close()
-        version = state.get('version', 0)
-        if version == 0:
-            state['containers'] = dict()
-            state['version'] = CONFIG_VERSION
-        self.logger.debug("Initialized configuration: %r", state)
-        return state
+        self.pathname = pathname
+        # SQLite connections can't be shared between threads.
+        self.local = threading.local()
 
-    def __enter__(self):
-        exists = os.path.isfile(CONFIG_FILE)
-        self.handle = open(CONFIG_FILE, 'r+' if exists else 'w')
-        fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
-        self.state = self.load(exists=exists)
-        return self.state
+    @property
+    def connection(self):
+        """
+        Get the SQLite database connection of the current thread. The database
+        is created (and older configuration files are migrated) on demand.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.pathname)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.logger.debug("Connecting to runtime configuration in %s ..", format_path(self.pathname))
+            # We manage transactions ourselves (isolation_level=None) and wait
+            # up to 30 seconds for other processes to finish writing.
+            connection = sqlite3.connect(self.pathname, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            self.local.connection = connection
+            self.local.depth = 0
+            self.initialize()
+        return connection
+
+    def initialize(self):
+        """
+        Create the database schema if it doesn't exist yet and migrate the
+        runtime configuration of older versions of Redock.
+        """
+        with self.transaction():
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS metadata (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )
+            ''')
+            self.connection.execute('''
+                CREATE TABLE IF NOT EXISTS state (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+            ''')
+            row = self.connection.execute("SELECT value FROM metadata WHERE name = 'version'").fetchone()
+            if not row:
+                self.migrate()
+                self.connection.execute("INSERT INTO metadata (name, value) VALUES ('version', ?)",
+                                        (str(CONFIG_VERSION),))
+
+    def migrate(self, pathname=None):
+        """
+        Import the pickled runtime configuration used by older versions of
+        Redock (``~/.redock/state.pickle``). After a successful import the
+        file is renamed to ``state.pickle.migrated``.
 
-    def __exit__(self, type, value, traceback):
-        if type is None:
-            self.logger.verbose("Saving configuration to %s ..", format_path(CONFIG_FILE))
-            self.handle.seek(0)
-            pickle.dump(self.state, self.handle)
-            self.handle.truncate()
+        :param pathname: The pathname of the pickled runtime configuration
+                         (defaults to ``state.pickle`` in the directory
+                         containing the database).
+        """
+        if not pathname:
+            pathname = os.path.join(os.path.dirname(self.pathname), os.path.basename(CONFIG_FILE))
+        if os.path.isfile(pathname):
+            self.logger.info("Migrating runtime configuration from %s ..", format_path(pathname))
+            with open(pathname) as handle:
+                state = pickle.load(handle)
+            if state.get('version', 0) >= 1:
+                for namespace in ('containers', 'pool'):
+                    for key, value in state.get(namespace, {}).items():
+                        self.set(namespace, key, value)
+            os.rename(pathname, pathname + '.migrated')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Create a context manager that groups the :py:func:`get()`,
+        :py:func:`set()` and :py:func:`delete()` calls in the ``with`` block
+        into a single atomic transaction. The transaction is committed when
+        the ``with`` block ends normally and rolled back when an exception is
+        raised. Transactions can be nested (only the outermost transaction
+        commits).
+        """
+        connection = self.connection
+        if self.local.depth == 0:
+            # Acquire the write lock up front to avoid deadlocks between
+            # processes that both try to upgrade a read lock.
+            connection.execute('BEGIN IMMEDIATE')
+        self.local.depth += 1
+        try:
+            yield
+        except:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                self.logger.warn("Not saving runtime configuration! (an exception was raised)")
+                connection.execute('ROLLBACK')
+            raise
         else:
-            self.logger.warn("Not saving configuration! (an exception was raised: %s)", value)
-        fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
-        self.handle.close()
-        self.handle = None
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                connection.execute('COMMIT')
+
+    def get(self, namespace, key, default=None):
+        """
+        Get a value from the runtime configuration.
+
+        :param namespace: The name of the namespace (a string).
+        :param key: The key to get (any value that can be serialized to JSON).
+        :param default: The value to return if the key doesn't exist.
+        :returns: The (deserialized) value.
+        """
+        row = self.connection.execute('SELECT value FROM state WHERE namespace = ? AND key = ?',
+                                      (namespace, json.dumps(key))).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace, key, value):
+        """
+        Store a value in the runtime configuration.
+
+        :param namespace: The name of the namespace (a string).
+        :param key: The key to set (any value that can be serialized to JSON).
+        :param value: The value to store (any value that can be serialized to
+                      JSON).
+        """
+        self.logger.debug("Setting %s[%r] = %r in runtime configuration ..", namespace, key, value)
+        self.connection.execute('INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)',
+                                (namespace, json.dumps(key), json.dumps(value)))
+
+    def delete(self, namespace, key):
+        """
+        Remove a value from the runtime configuration (if it exists).
+
+        :param namespace: The name of the namespace (a string).
+        :param key: The key to delete (any value that can be serialized to
+                    JSON).
+        """
+        self.logger.debug("Deleting %s[%r] from runtime configuration ..", namespace, key)
+        self.connection.execute('DELETE FROM state WHERE namespace = ? AND key = ?',
+                                (namespace, json.dumps(key)))
+
+    def items(self, namespace):
+        """
+        Get all keys and values in a namespace.
+
+        :param namespace: The name of the namespace (a string).
+        :returns: A list of tuples with two values each (a key and a value).
+                  Keys that were stored as tuples are returned as tuples.
+        """
+        rows = self.connection.execute('SELECT key, value FROM state WHERE namespace = ?', (namespace,))
+        items = []
+        for key, value in rows.fetchall():
+            key = json.loads(key)
+            if isinstance(key, list):
+                key = tuple(key)
+            items.append((key, json.loads(value)))
+        return items
+
+class SecureShellConfig(object):
+
+    """
+    :py:class:`SecureShellConfig` manages the host definitions that Redock
+    adds to the SSH_ client configuration file ``~/.ssh/config``. Each host
+    definition is stored as a separate file (a fragment) in the directory
+    ``~/.ssh/config.d`` and update-dotdee_ is used to merge the fragments
+    (including the user's original configuration) into ``~/.ssh/config``.
+
+    Merging rewrites ``~/.ssh/config`` based on all fragments, so when lots
+    of containers are started or killed at once it makes sense to merge only
+    once. That's what :py:func:`batch()` is for:
+
+    >>> with ssh_config.batch():
+    ...   for container in containers:
+    ...     container.start()
+
+    Fragments whose contents didn't change aren't rewritten and when merging
+    wouldn't change the contents of ``~/.ssh/config`` the file isn't touched
+    at all. Batches apply to all threads in the current process, so the
+    containers in the example above can just as well be started by a pool of
+    worker threads.
+
+    .. _SSH: http://en.wikipedia.org/wiki/Secure_Shell
+    .. _update-dotdee: https://pypi.python.org/pypi/update-dotdee
+    """
+
+    def __init__(self, pathname=SSH_CONFIG_FILE):
+        """
+        Initialize a :py:class:`SecureShellConfig` object.
+
+        :param pathname: The pathname of the SSH client configuration file
+                         (defaults to ``~/.ssh/config``).
+        """
+        self.pathname = pathname
+        self.lock = threading.RLock()
+        self.depth = 0
+
+    @property
+    def directory(self):
+        """
+        Get the pathname of the directory containing the fragments.
+        """
+        return '%s.d' % self.pathname
+
+    def fragment_file(self, name):
+        """
+        Get the pathname of a fragment.
+
+        :param name: The name of the fragment (a string).
+        :returns: The absolute pathname of the fragment (a string).
+        """
+        return os.path.join(self.directory, name)
+
+    def update_fragment(self, name, contents):
+        """
+        Create or update a fragment. If the fragment already has the given
+        contents nothing happens.
+
+        :param name: The name of the fragment (a string).
+        :param contents: The contents of the fragment (a string).
+        """
+        pathname = self.fragment_file(name)
+        with self.lock:
+            if os.path.isfile(pathname):
+                with open(pathname) as handle:
+                    if handle.read() == contents:
+                        logger.debug("SSH client configuration %s didn't change.", format_path(pathname))
+                        return
+            if not os.path.isdir(self.directory):
+                logger.info("Creating directory: %s", format_path(self.directory))
+                os.makedirs(self.directory)
+                # Preserve the original configuration (like update-dotdee does).
+                if os.path.isfile(self.pathname):
+                    os.rename(self.pathname, os.path.join(self.directory, 'local'))
+            with open(pathname, 'w') as handle:
+                handle.write(contents)
+            self.update_file()
+
+    def remove_fragment(self, name):
+        """
+        Remove a fragment (if it exists).
+
+        :param name: The name of the fragment (a string).
+        """
+        pathname = self.fragment_file(name)
+        with self.lock:
+            if os.path.isfile(pathname):
+                os.unlink(pathname)
+            self.update_file()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Create a context manager that postpones updating ``~/.ssh/config``
+        until the end of the ``with`` block. Batches can be nested. The updates
+        made by all threads are postponed (the ``redock`` program performs
+        actions on several containers using a pool of worker threads).
+        """
+        with self.lock:
+            self.depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.depth -= 1
+                self.update_file()
+
+    def update_file(self, force=False):
+        """
+        Merge the fragments into ``~/.ssh/config`` using update-dotdee_ (unless
+        a batch is active or merging wouldn't change the file).
+
+        :param force: ``True`` to update the file even if its contents wouldn't
+                      change.
+        """
+        with self.lock:
+            if self.depth == 0 and os.path.isdir(self.directory):
+                if not force and os.path.isfile(self.pathname):
+                    with open(self.pathname) as handle:
+                        if handle.read() == self.merged_contents():
+                            return
+                # update-dotdee is imported on demand (see test_import_time()).
+                from update_dotdee import UpdateDotDee
+                UpdateDotDee(self.pathname).update_file()
+
+    def merged_contents(self):
+        """
+        Merge the fragments in the same way as update-dotdee_ (without
+        writing the result to ``~/.ssh/config``).
+
+        :returns: The merged contents (a string).
+        """
+        from natsort import natsort
+        blocks = []
+        for name in natsort(os.listdir(self.directory)):
+            if not name.startswith('.'):
+                with open(os.path.join(self.directory, name)) as handle:
+                    blocks.append(handle.read().rstrip())
+        return '\n\n'.join(blocks).rstrip() + '\n'
 
 class RemoteTerminal(object):
 
@@ -120,30 +396,48 @@ class RemoteTerminal(object):
     Attach to a running Docker container and show the output of the command(s)
     inside the container on the host's terminal. Can be used as a context
     manager or by manually calling :py:func:`RemoteTerminal.attach()` and
-    :py:func:`RemoteTerminal.detach()`.
+    :py:func:`RemoteTerminal.detach()`. The output of all attached containers
+    is read by a single thread (see :py:mod:`redock.attach`).
     """
 
-    def __init__(self, container_id):
+    def __init__(self, container_id, client, name=None):
         """
-        Initialize the context manager for the ``docker attach`` process.
+        Initialize the context manager for the attach socket.
 
         :param container_id: The id of the container to attach to (a string).
+        :param client: Connection to Docker (instance of :py:class:`docker.Client`)
+        :param name: The prefix for lines of output (a string, defaults to the
+                     summarized container id).
         """
         self.container_id = container_id
+        self.client = client
+        self.name = name or summarize_id(container_id)
+        self.attached = False
 
     def attach(self):
         """
-        Start the ``docker attach`` subprocess.
+        Open an attach socket using the Docker remote API and start showing
+        the output of the container (including any output produced before
+        the socket was opened).
         """
+        # The multiplexer is only needed when we actually attach to containers.
+        from redock.attach import multiplexer
         logger.verbose("Attaching to terminal of container %s ..", summarize_id(self.container_id))
-        self.subprocess = subprocess.Popen(['docker', 'attach', self.container_id], stdin=open(os.devnull), stdout=sys.stderr)
+        sock = self.client.attach_socket(self.container_id, params=dict(stdout=1, stderr=1, stream=1, logs=1))
+        multiplexer.add(self.container_id, self.name, sock)
+        self.attached = True
 
     def detach(self):
         """
-        Kill the ``docker attach`` subprocess.
+        Stop showing the output of the container. Output that the container
+        produced before it exited is still written to the terminal.
         """
-        logger.verbose("Detaching from container %s ..", summarize_id(self.container_id))
-        self.subprocess.kill()
+        from redock.attach import DETACH_TIMEOUT, multiplexer
+        if self.attached:
+            logger.verbose("Detaching from container %s ..", summarize_id(self.container_id))
+            multiplexer.remove(self.container_id, timeout=DETACH_TIMEOUT)
+            multiplexer.flush()
+            self.attached = False
 
     def __enter__(self):
         self.attach()
@@ -151,24 +445,26 @@ class RemoteTerminal(object):
     def __exit__(self, type, value, traceback):
         self.detach()
 
+# The SSH client configuration shared by all threads in the current process.
+ssh_config = SecureShellConfig()
+
 def select_ubuntu_mirror(force=False):
     """
-    Find an Ubuntu mirror that is geographically close to the current
-    location for use inside Docker containers. We remember the choice in a
-    file on the host system so that we always configure the same mirror in
-    Docker containers (if you change the mirror, ``apt-get`` has to
-    download all package metadata again, wasting a lot of time).
+    Find a fast Ubuntu mirror that is geographically close to the current
+    location for use inside Docker containers. Candidate mirrors are ranked
+    by their response time and the choice is remembered on the host system
+    so that we always configure the same mirror in Docker containers (if you
+    change the mirror, ``apt-get`` has to download all package metadata again,
+    wasting a lot of time). See :py:mod:`redock.mirrors` for details.
+
+    :param force: ``True`` to rank the mirrors again even if the previous
+                  ranking isn't stale yet.
+    :returns: The URL of the selected mirror (a string).
     """
-    create_configuration_directory()
-    if not os.path.isfile(UBUNTU_MIRROR_FILE):
-        url = 'http://mirrors.ubuntu.com/mirrors.txt'
-        logger.debug("Finding nearby Ubuntu package mirror using %s ..", url)
-        mirror = urllib.urlopen(url).readline().strip()
-        with open(UBUNTU_MIRROR_FILE, 'w') as handle:
-            handle.write('%s\n' % mirror)
-    with open(UBUNTU_MIRROR_FILE) as handle:
-        mirror = handle.read().strip()
-        logger.debug("Selected Ubuntu package mirror: %s", mirror)
+    # The mirror ranking code is only needed when building the base image.
+    from redock.mirrors import select_mirror
+    mirror = select_mirror(force=force)
+    logger.debug("Selected Ubuntu package mirror: %s", mirror)
     return mirror
 
 def get_ssh_public_key():
@@ -210,6 +506,8 @@ def find_local_ip_addresses():
     :returns: A :py:class:`set` of IP addresses associated with local network
               interfaces.
     """
+    # The netifaces module is imported on demand because it's only needed here.
+    from netifaces import interfaces, ifaddresses
     ip_addresses = set()
     for name in sorted(interfaces(), key=str.lower):
         for addresses in ifaddresses(name).values():
@@ -225,6 +523,103 @@ def find_local_ip_addresses():
                     ip_addresses.add(address)
     return ip_addresses
 
+def wait_for_ssh_banner(ip_addresses, port_number, timeout=10):
+    """
+    Wait for an SSH_ server to become available on one of the given IP
+    addresses. Instead of running an SSH client for every attempt this opens
+    non-blocking TCP connections to all addresses at once and waits for the
+    SSH server to send its protocol banner (a line starting with ``SSH-``).
+
+    This matters because Docker's port forwarding accepts TCP connections
+    before the SSH server inside the container is running; such connections
+    are simply closed again. Failed attempts are retried with an increasing
+    delay (starting at 50 milliseconds and doubling up to one second) so that
+    the time until the banner is seen closely tracks the actual startup time
+    of the SSH server.
+
+    :param ip_addresses: An iterable of IP addresses (strings).
+    :param port_number: The port number to connect to (an integer).
+    :param timeout: The maximum number of seconds to wait.
+    :returns: A tuple with the IP address and the banner (a string) or
+              ``None`` if no banner was received before the timeout expired.
+
+    .. _SSH: http://en.wikipedia.org/wiki/Secure_Shell
+    """
+    deadline = time.time() + timeout
+    # Per address bookkeeping: the time of the next attempt and the delay
+    # before the attempt after that.
+    schedule = dict((a, [0, 0.05]) for a in ip_addresses)
+    connecting = {}
+    reading = {}
+    buffers = {}
+    def retry(address):
+        """ Close the socket of a failed attempt and schedule another one. """
+        sock = connecting.pop(address, None) or reading.pop(address, None)
+        if sock:
+            sock.close()
+        buffers.pop(address, None)
+        next_attempt, delay = schedule[address]
+        schedule[address] = [time.time() + delay, min(delay * 2, 1.0)]
+    try:
+        while schedule and time.time() < deadline:
+            now = time.time()
+            # Start new connection attempts where needed.
+            for address, (next_attempt, delay) in schedule.items():
+                if address not in connecting and address not in reading and next_attempt <= now:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(0)
+                    status = sock.connect_ex((address, port_number))
+                    if status in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                        connecting[address] = sock
+                    else:
+                        sock.close()
+                        schedule[address][0] = now + delay
+                        schedule[address][1] = min(delay * 2, 1.0)
+            # Wait for something to happen (or the next scheduled attempt).
+            pending = [t for a, (t, d) in schedule.items() if a not in connecting and a not in reading]
+            wait_until = min(pending + [deadline])
+            sockets_by_fd = {}
+            for address, sock in connecting.items() + reading.items():
+                sockets_by_fd[sock.fileno()] = address
+            readable, writable, exceptional = select.select(
+                [s for s in reading.values()],
+                [s for s in connecting.values()],
+                [], max(0, min(wait_until, deadline) - time.time()))
+            # Handle connections that were established (or refused).
+            for sock in writable:
+                address = sockets_by_fd[sock.fileno()]
+                status = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if status == 0:
+                    reading[address] = connecting.pop(address)
+                    buffers[address] = ''
+                else:
+                    logger.debug("Failed to connect to %s:%i: %s", address, port_number, os.strerror(status))
+                    retry(address)
+            # Read (part of) the banner from established connections.
+            for sock in readable:
+                address = sockets_by_fd[sock.fileno()]
+                try:
+                    data = sock.recv(256)
+                except socket.error, e:
+                    logger.debug("Failed to read from %s:%i: %s", address, port_number, e)
+                    retry(address)
+                    continue
+                if not data:
+                    logger.debug("Connection to %s:%i was closed before banner was received.", address, port_number)
+                    retry(address)
+                    continue
+                buffers[address] += data
+                if '\n' in buffers[address]:
+                    banner = buffers[address].splitlines()[0].strip()
+                    if banner.startswith('SSH-'):
+                        logger.debug("Got SSH banner from %s:%i: %s", address, port_number, banner)
+                        return address, banner
+                    logger.debug("Ignoring unexpected banner from %s:%i: %r", address, port_number, banner)
+                    retry(address)
+    finally:
+        for sock in connecting.values() + reading.values():
+            sock.close()
+
 def apt_get_install(*packages):
     """
     Generate a command to install the given packages with ``apt-get``.
@@ -270,6 +665,15 @@ def slug(text):
     slug = re.sub('[^a-z0-9]+', '-', text.lower())
     return slug.strip('-')
 
+def coerce_boolean(value):
+    """
+    Convert the value of an environment variable to a boolean.
+
+    :param value: A string like ``yes``, ``true``, ``1``, ``no``, etc.
+    :returns: ``True`` or ``False``.
+    """
+    return value.strip().lower() in ('1', 'yes', 'true', 'on')
+
 def create_configuration_directory():
     """
     Make sure Redock's local configuration directory exists.
@@ -0,0 +1,229 @@
+# Pools of pre-started containers for Redock.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: https://github.com/xolox/python-redock
+
+"""
+The :py:mod:`redock.warmpool` module implements pools of containers that are
+started ahead of time. Creating a container, starting Supervisor and waiting
+for the SSH server to come up takes a couple of seconds. When you create lots
+of short lived containers from the same image (for example on a continuous
+integration server) you can avoid this delay by keeping a few containers in
+reserve:
+
+.. code-block:: sh
+
+   $ redock --pool=3 start test
+
+The first time this starts the container as usual and then starts three more
+containers in a background process. The next time you start (a container with
+the same name and host name as) ``test`` one of the reserved containers is
+handed out immediately and the pool is refilled in the background.
+
+Because Docker doesn't support changing the host name of a container after it
+has been created, pools are keyed by the repository, tag *and* host name of
+the container. Reserved containers that were created from an older version of
+the image (because the image has since been committed to) are discarded.
+"""
+
+# Standard library modules.
+import fcntl
+import os
+import subprocess
+import sys
+
+# External dependencies.
+from humanfriendly import Timer
+from verboselogs import VerboseLogger
+
+# Modules included in our package.
+from redock.utils import REDOCK_CONFIG_DIR, create_configuration_directory, slug, summarize_id
+
+# Initialize a logger for this module.
+logger = VerboseLogger(__name__)
+
+# The absolute pathname of the log file of background processes that refill pools.
+WARM_POOL_LOG_FILE = os.path.join(REDOCK_CONFIG_DIR, 'warm-pool.log')
+
+class WarmPool(object):
+
+    """
+    A pool of pre-started containers that share the same image and host name.
+    The reserved containers are tracked in the runtime configuration (see
+    :py:class:`redock.utils.Config`) in the namespace ``pool``.
+    """
+
+    def __init__(self, container, size=1):
+        """
+        Initialize a :py:class:`WarmPool`.
+
+        :param container: The :py:class:`redock.api.Container` for which
+                          containers should be reserved.
+        :param size: The number of containers to keep in reserve.
+        """
+        self.container = container
+        self.size = size
+        self.logger = logger
+
+    @property
+    def key(self):
+        """
+        Get a tuple with the repository, tag and host name that identifies the
+        pool.
+        """
+        return (self.container.image.repository,
+                self.container.image.tag,
+                self.container.hostname)
+
+    @property
+    def name(self):
+        """
+        Get the human readable name of the pool (a string).
+        """
+        return "%s (%s)" % (self.container.image.name, self.container.hostname)
+
+    def claim(self):
+        """
+        Hand out one of the reserved containers by associating it with the
+        :py:class:`redock.api.Container` given to the constructor. Reserved
+        containers that are no longer running or that were created from an
+        outdated image are discarded.
+
+        :returns: ``True`` if a container was claimed, ``False`` if the pool
+                  is empty.
+        """
+        source = self.container.find_image(self.container.image) or self.container.find_image(self.container.base)
+        # Fetch the list of running containers before we lock the configuration.
+        self.container.inventory.containers()
+        config = self.container.config
+        with config.transaction():
+            entries = config.get('pool', self.key, [])
+            claimed = None
+            stale = []
+            while entries and not claimed:
+                entry = entries.pop(0)
+                if not self.container.inventory.is_running(entry['container_id']):
+                    self.logger.verbose("Reserved container %s is no longer running.",
+                                        summarize_id(entry['container_id']))
+                elif not (source and source.id == entry['image_id']):
+                    self.logger.verbose("Reserved container %s was created from an outdated image.",
+                                        summarize_id(entry['container_id']))
+                    stale.append(entry['container_id'])
+                else:
+                    claimed = entry
+            config.set('pool', self.key, entries)
+            if claimed:
+                config.set('containers', self.container.image.key, claimed['container_id'])
+        for container_id in stale:
+            self.discard(container_id)
+        if claimed:
+            self.logger.info("Claimed pre-started container %s from warm pool of %s.",
+                             summarize_id(claimed['container_id']), self.name)
+            self.container.session.container_id = claimed['container_id']
+            self.container.session.ssh_endpoint = tuple(claimed['ssh_endpoint'])
+            return True
+        self.logger.verbose("Warm pool of %s is empty.", self.name)
+        return False
+
+    def fill(self):
+        """
+        Start containers until the pool contains the requested number of
+        containers. When the pool contains more containers than requested the
+        surplus is killed. If another process is already refilling the pool
+        this method returns immediately.
+        """
+        create_configuration_directory()
+        with open(self.lock_file, 'w') as handle:
+            try:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                self.logger.verbose("Warm pool of %s is already being refilled.", self.name)
+                return
+            timer = Timer()
+            available = self.prune()
+            while available < self.size:
+                self.logger.info("Starting container %i/%i for warm pool of %s ..",
+                                 available + 1, self.size, self.name)
+                reserve = self.container.__class__(image=self.container.image,
+                                                   hostname=self.container.hostname,
+                                                   timeout=self.container.timeout)
+                image = reserve.ensure_image()
+                reserve.start_supervisor(register=False, attach=False)
+                try:
+                    entry = dict(container_id=reserve.session.container_id,
+                                 image_id=image.id,
+                                 ssh_endpoint=reserve.ssh_endpoint)
+                except Exception:
+                    # Don't leave broken containers lying around.
+                    self.discard(reserve.session.container_id)
+                    raise
+                config = self.container.config
+                with config.transaction():
+                    config.set('pool', self.key, config.get('pool', self.key, []) + [entry])
+                available += 1
+            config = self.container.config
+            with config.transaction():
+                entries = config.get('pool', self.key, [])
+                surplus = entries[self.size:]
+                config.set('pool', self.key, entries[:self.size])
+            for entry in surplus:
+                self.discard(entry['container_id'])
+            self.logger.info("Warm pool of %s contains %i containers (took %s).",
+                             self.name, self.size, timer)
+
+    def prune(self):
+        """
+        Remove containers that are no longer running from the pool.
+
+        :returns: The number of containers in the pool.
+        """
+        self.container.inventory.invalidate(images=False)
+        self.container.inventory.containers()
+        config = self.container.config
+        with config.transaction():
+            entries = [e for e in config.get('pool', self.key, [])
+                       if self.container.inventory.is_running(e['container_id'])]
+            config.set('pool', self.key, entries)
+        return len(entries)
+
+    def discard(self, container_id):
+        """
+        Kill and remove a reserved container.
+
+        :param container_id: The id of the container (a string).
+        """
+        self.logger.verbose("Discarding reserved container %s ..", summarize_id(container_id))
+        try:
+            self.container.client.kill(container_id)
+            self.container.client.remove_container(container_id)
+        except Exception, e:
+            self.logger.warn("Failed to discard reserved container %s! (%s)",
+                             summarize_id(container_id), e)
+        self.container.inventory.invalidate(images=False)
+
+    def replenish_in_background(self):
+        """
+        Refill the pool using a detached ``redock`` process so that the caller
+        doesn't have to wait for the new containers to start. The output of
+        the background process is logged to ``~/.redock/warm-pool.log``.
+        """
+        create_configuration_directory()
+        command = [sys.executable, '-m', 'redock.cli',
+                   '--pool=%i' % self.size,
+                   '--hostname=%s' % self.container.hostname,
+                   'fill', self.container.image.name]
+        self.logger.verbose("Refilling warm pool of %s in the background ..", self.name)
+        with open(WARM_POOL_LOG_FILE, 'a') as handle:
+            subprocess.Popen(command, stdin=open(os.devnull), stdout=handle,
+                             stderr=subprocess.STDOUT, close_fds=True,
+                             preexec_fn=os.setsid)
+
+    @property
+    def lock_file(self):
+        """
+        Get the pathname of the lock file used by :py:func:`fill()`.
+        """
+        return os.path.join(REDOCK_CONFIG_DIR, 'warm-pool-%s.lock' % slug(':'.join(self.key)))
+
+# vim: ts=4 sw=4 et
@@ -38,6 +38,7 @@ setup(name='redock',
       author='Peter Odding',
       author_email='peter@peterodding.com',
       packages=find_packages(),
-      entry_points=dict(console_scripts=['redock = redock.cli:main']),
+      entry_points=dict(console_scripts=['redock = redock.cli:main',
+                                         'redockd = redock.daemon:main']),
       install_requires=requirements,
       test_suite='redock.tests')